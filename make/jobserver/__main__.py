@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""Command line interface to the make jobserver.
+
+    python -m make.jobserver run [--learn] -- cmd args...
+        Wait for a token, run the command and give the token back.
+
+    python -m make.jobserver xargs [--learn] -- cmd args...
+        Run the command once for each line on stdin (appended as the last
+        argument), as many at once as there are tokens.
+
+    python -m make.jobserver serve -j N [--learn] -- cmd args...
+        Run the command under a new top level jobserver with N jobs.
+
+    python -m make.jobserver serve --attach [--socket PATH] [--quota Q]
+            [--learn] -- cmd args...
+        Run the command with tokens from the host-wide daemon (at most Q at
+        once) rather than a pool of its own.
+
+    python -m make.jobserver daemon [-j N] [--quota Q] [--socket PATH]
+        Run the host-wide jobserver daemon with N tokens, builds get at most
+        Q of them each. The socket defaults to $MAKE_JOBSERVER_DAEMON (or
+        one in $XDG_RUNTIME_DIR).
+
+    python -m make.jobserver proxy [--isolate|--passthrough] [--learn] -- cmd
+        Run the command under a proxy of the current jobserver, so tokens
+        the command leaks are given back when it exits. Below a proxy (or
+        serve) which already does this the jobserver is just passed through
+        unless --isolate is given.
+
+    With --learn the resources each command used are recorded, and later
+    runs charge it as many tokens as it keeps cores busy (xargs also starts
+    the longest commands first). See history.py.
+
+    python -m make.jobserver stat
+        Show the state of the current jobserver.
+
+    python -m make.jobserver top [--once] [--interval SECONDS]
+        Watch every jobserver on the host which publishes its status (run
+        with MAKE_JOBSERVER_STATUS=1), also installed as jobtop.
+
+These are exec'd a lot from recipes, so only what each command needs is
+imported (run only needs the lite client).
+"""
+
+import os
+import sys
+
+
+USAGE = __doc__.split("\n\n")[1:-1]
+
+
+# Set for children of a proxy (or serve) which gives back leaked tokens, to
+# the jobserver the children were given.
+ISOLATED_ENV = "MAKE_JOBSERVER_ISOLATED"
+
+
+def log(msg):
+    sys.stderr.write("make.jobserver: {}\n".format(msg))
+    sys.stderr.flush()
+
+
+def _history(args):
+    """History to learn from, if --learn was given."""
+    if not args.learn:
+        return None
+    from . import history
+    return history.History()
+
+
+def _jobs():
+    from . import utils
+    return utils.parse_make_flags().jobs
+
+
+def cmd_run(args):
+    from . import lite
+
+    learn = _history(args)
+    if learn is None:
+        return lite.run(args.command)
+
+    from . import history
+    return history.run(args.command, learn, limit=_jobs())
+
+
+def cmd_xargs(args):
+    import select
+    from . import lite
+
+    command = args.command
+    jobserver = lite.parse()[1]
+    fds = lite._open(jobserver) if jobserver is not None else None
+
+    learn = _history(args)
+    lines = (line.rstrip("\n") for line in sys.stdin)
+    if learn is not None:
+        import time
+        from . import history
+
+        limit = _jobs()
+        lines = list(lines)
+        sigs = {}
+        for line in lines:
+            sigs[line] = history.signature(command + [line])
+        lines = iter(learn.order(lines, key=sigs.get))
+        # pid -> (signature, start time, extra tokens)
+        started = {}
+
+    # pid -> token, the job running on our own token has None.
+    running = {}
+    retcode = 0
+    line = next(lines, None)
+    while line is not None or running:
+        wait = 0
+        if line is not None:
+            token = None
+            if None in running.values():
+                token = lite.acquire(block=False)
+            if token is not None or None not in running.values():
+                pid = lite._spawn(command + [line])
+                running[pid] = token
+                if learn is not None:
+                    extra = []
+                    while len(extra) + 1 < learn.weight(sigs[line], limit):
+                        extra_token = lite.acquire(block=False)
+                        if extra_token is None:
+                            break
+                        extra.append(extra_token)
+                    started[pid] = (sigs[line], time.time(), extra)
+                line = next(lines, None)
+                continue
+            if fds is not None:
+                # Check for finished jobs at least every 50ms while waiting
+                # for a token to turn up.
+                select.select([fds[0]], [], [], 0.05)
+                wait = os.WNOHANG
+
+        pid, status, rusage = os.wait4(-1, wait)
+        if pid:
+            lite.release(running.pop(pid))
+            retcode = max(retcode, lite._exitcode(status))
+            if learn is not None:
+                sig, start, extra = started.pop(pid)
+                for extra_token in extra:
+                    lite.release(extra_token)
+                learn.record(
+                    sig, time.time() - start, history.cpu_time(rusage),
+                    rusage.ru_maxrss)
+
+    if learn is not None:
+        learn.save()
+    return retcode
+
+
+def _jobserver_id(make_flags=None):
+    """Identify the jobserver, None if it isn't one we can use.
+
+    Other jobservers end up on the same fd numbers, so a pipe is known by its
+    inode.
+    """
+    from . import utils
+
+    make_flags = utils.parse_make_flags(make_flags)
+    if make_flags.jobserver_fifo:
+        return "fifo:" + make_flags.jobserver_fifo
+    if make_flags.jobserver_fds is None:
+        return None
+    try:
+        return "pipe:{}".format(os.fstat(make_flags.jobserver_fds[0]).st_ino)
+    except OSError:
+        return None
+
+
+def _run_under(jobserver, command, isolated=True, learn=None, jobs=None):
+    import subprocess
+    from . import utils
+
+    childid, pass_fds = jobserver.create_client()
+    env = dict(os.environ)
+    env["MAKEFLAGS"] = utils.replace_jobserver(
+        utils.get_make_flags(), pass_fds)
+    env.pop(ISOLATED_ENV, None)
+    if isolated:
+        env[ISOLATED_ENV] = _jobserver_id(env["MAKEFLAGS"])
+    try:
+        p = subprocess.Popen(command, env=env, pass_fds=pass_fds)
+    except OSError as e:
+        log("{}: {}".format(command[0], e.strerror))
+        p = None
+    for fileno in pass_fds:
+        os.close(fileno)
+    if p is None:
+        jobserver.cleanup_client(childid, allow_tokens=True)
+        return 127
+    jobserver.describe_client(childid, p.pid, os.path.basename(command[0]))
+
+    if childid not in jobserver.cid2tokens:
+        # Passed straight through, we can't see the tokens it takes.
+        learn = None
+    if learn is not None:
+        import resource
+        import time
+        from . import history
+
+        sig = history.signature(command)
+        if jobs:
+            jobserver.charge(childid, learn.weight(sig, jobs - 1))
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    retcode = None
+    while retcode is None:
+        jobserver.poll(timeout=0.1)
+        try:
+            retcode = p.wait(0.01)
+        except subprocess.TimeoutExpired:
+            pass
+    jobserver.poll(timeout=0)
+
+    if learn is not None:
+        # Only the one child has been waited for since.
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall = time.time() - start
+        learn.record(
+            sig, wall, history.cpu_time(after) - history.cpu_time(before),
+            after.ru_maxrss,
+            jobserver.token_seconds(childid) / wall if wall > 0 else 0.0)
+        learn.save()
+
+    jobserver.cleanup_client(childid, allow_tokens=True)
+    return retcode
+
+
+def cmd_serve(args):
+    from . import server
+    from . import utils
+
+    if utils.has_jobserver():
+        log("a jobserver already exists, use proxy instead")
+        return 2
+    if args.attach:
+        return _serve_attached(args)
+
+    jobs = args.jobs or os.cpu_count()
+
+    # The command gets one job slot for free, like make does.
+    jobserver = server.JobServer(jobs - 1)
+    try:
+        return _run_under(
+            jobserver, args.command, learn=_history(args), jobs=jobs)
+    finally:
+        jobserver.close()
+
+
+def _serve_attached(args):
+    import select
+    import socket
+    from . import client
+    from . import daemon
+    from . import proxy
+    from . import server
+
+    quota = args.quota
+    try:
+        conn, daemon_fds = daemon.attach(args.socket, quota)
+    except socket.error as e:
+        log("no daemon to attach to: {}".format(e))
+        return 2
+
+    jobclient = client.JobServerClient(server.JobServer.flags(daemon_fds))
+    jobproxy = None
+    try:
+        # Unlike a build started by make nothing covers the job the command
+        # runs without a token, so a daemon token is held for it. Holding
+        # the client's free token as well means the proxy only hands out
+        # daemon tokens.
+        jobclient.get_token()
+        while jobclient.get_token() is None:
+            if select.select([conn], [], [], 0)[0]:
+                # The daemon never writes after attaching, it has gone.
+                log("lost the daemon")
+                return 2
+
+        jobproxy = proxy.JobServerProxy(jobclient)
+        return _run_under(
+            jobproxy, args.command, learn=_history(args), jobs=quota)
+    finally:
+        if jobproxy is not None:
+            jobproxy.close()
+        jobclient.cleanup()
+        # Everything we still held goes back to the pool.
+        conn.close()
+
+
+def cmd_daemon(args):
+    import signal
+    from . import daemon
+
+    try:
+        jobdaemon = daemon.JobServerDaemon(
+            args.jobs or os.cpu_count(), path=args.socket, quota=args.quota)
+    except daemon.DaemonRunningError as e:
+        log(str(e))
+        return 1
+    log("serving {} tokens on {}".format(jobdaemon.num_tokens, jobdaemon.path))
+
+    # Exit through the finally, so the socket is removed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        jobdaemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        jobdaemon.close()
+    return 0
+
+
+def cmd_proxy(args):
+    from . import client
+    from . import proxy
+    from . import utils
+
+    if not utils.has_jobserver():
+        log("no jobserver to proxy")
+        return 2
+    jobserver_id = _jobserver_id()
+    if jobserver_id is None:
+        log("can't use jobserver {}".format(
+            utils.parse_make_flags().jobserver_auth))
+        return 2
+
+    # Leaked tokens only need recovering once, by the outermost proxy.
+    isolated = os.environ.get(ISOLATED_ENV, None) == jobserver_id
+    if args.isolate:
+        passthrough = False
+    elif args.passthrough:
+        passthrough = True
+    else:
+        passthrough = isolated
+
+    jobclient = client.JobServerClient()
+    jobproxy = proxy.JobServerProxy(jobclient, passthrough=passthrough)
+    try:
+        return _run_under(
+            jobproxy, args.command, isolated or not passthrough,
+            learn=_history(args), jobs=utils.parse_make_flags().jobs)
+    finally:
+        jobproxy.close()
+        jobclient.cleanup()
+
+
+def cmd_stat(args):
+    from . import _support
+    from . import utils
+
+    make_flags = utils.parse_make_flags()
+    print("MAKEFLAGS: {}".format(make_flags))
+    print("dry run: {}".format(make_flags.dry_run))
+    print("jobs: {}".format(make_flags.jobs))
+    if not make_flags.has_jobserver:
+        print("jobserver: none")
+        return 0
+
+    if make_flags.jobserver_fifo:
+        print("jobserver: fifo {}".format(make_flags.jobserver_fifo))
+    elif make_flags.jobserver_fds:
+        print("jobserver: pipe {},{}".format(*make_flags.jobserver_fds))
+    else:
+        print("jobserver unusable: {}".format(make_flags.jobserver_auth))
+        return 1
+
+    try:
+        job_rd, job_wr = utils.fds_for_jobserver(make_flags.make_flags)
+    except (OSError, IOError) as e:
+        print("jobserver unavailable: {}".format(e))
+        return 1
+    print("tokens free: {}".format(_support.output_waiting(job_rd)))
+    return 0
+
+
+def cmd_top(args):
+    from . import status
+
+    status_args = ["--interval", str(args.interval)]
+    if args.once:
+        status_args.append("--once")
+    return status.main(status_args)
+
+
+def _positive(value):
+    import argparse
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            "expected a positive number, not {!r}".format(value))
+    return number
+
+
+def _parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m make.jobserver",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n\n".join(USAGE))
+    commands = parser.add_subparsers(dest="name", metavar="COMMAND")
+    # Not an argument of add_subparsers before python 3.7.
+    commands.required = True
+
+    def add(name, func, help, command=True):
+        sub = commands.add_parser(name, help=help)
+        sub.set_defaults(func=func)
+        if command:
+            sub.add_argument(
+                "--learn", action="store_true",
+                help="record what each command uses, and charge it for that")
+            sub.add_argument(
+                "command", nargs=argparse.REMAINDER,
+                help="command to run (after --)")
+        return sub
+
+    add("run", cmd_run, "run a command once a token is free")
+    add("xargs", cmd_xargs, "run a command for each line of stdin")
+
+    serve = add("serve", cmd_serve, "run a command under a new jobserver")
+    serve.add_argument("-j", "--jobs", type=_positive)
+    serve.add_argument(
+        "--attach", action="store_true",
+        help="take tokens from the host-wide daemon")
+    serve.add_argument("--socket", help="daemon socket (with --attach)")
+    serve.add_argument(
+        "--quota", type=_positive, help="most daemon tokens (with --attach)")
+
+    daemon = add("daemon", cmd_daemon, "run the host-wide jobserver daemon",
+                 command=False)
+    daemon.add_argument("-j", "--jobs", type=_positive)
+    daemon.add_argument("--socket")
+    daemon.add_argument(
+        "--quota", type=_positive, help="most tokens given to each build")
+
+    proxy = add("proxy", cmd_proxy,
+                "run a command under a proxy of the current jobserver")
+    mode = proxy.add_mutually_exclusive_group()
+    mode.add_argument("--isolate", action="store_true")
+    mode.add_argument("--passthrough", action="store_true")
+
+    add("stat", cmd_stat, "show the current jobserver", command=False)
+
+    top = add("top", cmd_top, "watch every jobserver on the host",
+              command=False)
+    top.add_argument("--once", action="store_true")
+    top.add_argument("--interval", type=float, default=1.0)
+    return parser, commands.choices
+
+
+def main(args=None):
+    parser, commands = _parser()
+    args = parser.parse_args(args)
+    if "command" in args:
+        if args.command[:1] == ["--"]:
+            args.command = args.command[1:]
+        if not args.command:
+            commands[args.name].error("no command given")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
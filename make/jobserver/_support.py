@@ -3,6 +3,7 @@
 import fcntl
 import os
 import select
+import socket
 import struct
 import sys
 import termios
@@ -88,6 +89,12 @@ EPOLL_NAMES = {
 }
 
 
+def _is_closed(fileobj):
+    if isinstance(fileobj, socket.socket):
+        return fileobj.fileno() == -1
+    return fileobj.closed
+
+
 class Poller:
     def __init__(self):
         self.epoll = select.epoll()
@@ -97,7 +104,7 @@ class Poller:
     def _cleanup(self):
         toremove = []
         for fd, fileobj in self.mapping.items():
-            if fileobj.closed:
+            if _is_closed(fileobj):
                 toremove.append(fd)
         for fd in toremove:
             self.closed.append(self.mapping[fd])
@@ -111,16 +118,22 @@ class Poller:
         )
         self.mapping[fileobj.fileno()] = fileobj
 
+        # Sockets have no mode, they can always be read and written.
+        mode = getattr(fileobj, "mode", "rw")
         if select.EPOLLIN & flags:
-            assert "r" in fileobj.mode, fileobj
+            assert "r" in mode, fileobj
         if select.EPOLLOUT & flags:
-            assert "w" in fileobj.mode, fileobj
+            assert "w" in mode, fileobj
 
         self.epoll.register(fileobj, flags)
 
+    def modify(self, fileobj, flags):
+        assert fileobj.fileno() in self.mapping, (fileobj, self.mapping)
+        self.epoll.modify(fileobj, flags)
+
     def unregister(self, fileobj):
         self._cleanup()
-        if fileobj.closed:
+        if _is_closed(fileobj):
             assert fileobj in self.closed
             self.closed.remove(fileobj)
         else:
@@ -128,6 +141,11 @@ class Poller:
             self.epoll.unregister(fileobj)
             del self.mapping[fileobj.fileno()]
 
+    def close(self):
+        self.epoll.close()
+        self.mapping.clear()
+        self.closed = []
+
     def poll(self, *args, **kw):
         for fileno, event in self.epoll.poll(*args, **kw):
             self._cleanup()
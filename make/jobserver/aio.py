@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""asyncio versions of JobServer and JobServerProxy.
+
+The client pipes are watched by the running event loop, so an asyncio
+program can serve tokens (and run its children with asyncio's subprocess
+support) in a single thread without calling poll().
+
+    jobserver = aio.AsyncJobServer(8)
+    retcodes = await asyncio.gather(
+        *(jobserver.run("make", "-C", d) for d in dirs))
+    jobserver.close()
+
+Returned tokens are handed straight on to a waiting client. Taking a token
+out of a pipe can't be seen by the server, so while there are free tokens
+the pipes of clients which haven't taken the one waiting for them are
+checked again, every `interval` seconds backing off to 10 * `interval` while
+it isn't taken. Anything else only runs when a pipe is readable.
+"""
+
+import asyncio
+import os
+import signal
+
+from . import _support
+from . import proxy
+from . import server
+from . import utils
+
+
+async def reclaim(client):
+    """JobServerClient.reclaim(), waiting in the running event loop."""
+    if client._reclaim_reserved():
+        return True
+    loop = asyncio.get_event_loop()
+    fd = client._nonblocking_fd()
+    while not client._reclaim_read():
+        readable = loop.create_future()
+        loop.add_reader(
+            fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+    return True
+
+
+class yielding:
+    """Lend a job slot of client (a JobServerClient) for the duration of the
+    block.
+
+        async with aio.yielding(jobclient):
+            data = await fetch(url)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.yielded = False
+
+    async def __aenter__(self):
+        self.yielded = self.client.yield_token()
+
+    async def __aexit__(self, *exc_info):
+        if self.yielded:
+            await reclaim(self.client)
+
+
+class AsyncJobServer(server.JobServer):
+    """JobServer run by the event loop.
+
+    loop - Event loop to run in, defaults to the current loop.
+    """
+
+    def __init__(self, num_tokens=None, loop=None, interval=0.01, **kw):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.interval = interval
+        self._recheck = None
+        self._recheck_delay = interval
+        # Clients which haven't taken the token in their pipe yet.
+        self._pending = set()
+
+        # The event loop handles signals, keep its wakeup fd.
+        wakeup_fd = signal.set_wakeup_fd(-1)
+        try:
+            self._init_server(num_tokens, **kw)
+        finally:
+            signal.set_wakeup_fd(wakeup_fd)
+        self._clear_logger()
+
+    def _init_server(self, num_tokens, **kw):
+        server.JobServer.__init__(self, num_tokens, **kw)
+
+    def _add_client(self, cid, keep_fileobjs):
+        server.JobServer._add_client(self, cid, keep_fileobjs)
+        # Never block reading back tokens from a child which is gone but
+        # left the pipe open in a grandchild.
+        _support.set_nonblocking(keep_fileobjs.c2p_rd_fileobj)
+        self.loop.add_reader(
+            keep_fileobjs.c2p_rd_fileobj.fileno(), self._readable, cid)
+
+    def _readable(self, cid):
+        if cid not in self.cid2fileobjs:
+            return
+        fileobj = self.cid2fileobjs[cid].c2p_rd_fileobj
+        while True:
+            tokenbyte = fileobj.read(1)
+            if tokenbyte is None:
+                break
+            if tokenbyte == b"":
+                # Every child has closed its end, don't wake up for the EOF.
+                self.loop.remove_reader(fileobj.fileno())
+                break
+            self._log("Child {} return token ({})".format(
+                cid, repr(tokenbyte)))
+            self._unassign_token(cid)
+        self._hand_out()
+
+    def _hand_out(self):
+        """Give a token to every client with an empty pipe while there are
+        tokens free."""
+        self._offer(list(self.cid2fileobjs))
+        self._schedule_recheck(self.interval)
+
+    def _recheck_pending(self):
+        self._recheck = None
+        if self._offer(list(self._pending)):
+            delay = self.interval
+        else:
+            delay = min(self._recheck_delay * 2, self.interval * 10)
+        self._schedule_recheck(delay)
+
+    def _offer(self, cids):
+        """Offer tokens to clients cids, returns how many of them had taken
+        the token waiting for them."""
+        offers = [(cid, self.cid2fileobjs[cid].p2c_wr_fileobj)
+                  for cid in cids]
+        offers.sort(key=self._offer_order)
+        taken = 0
+        for cid, fileobj in offers:
+            if cid not in self.cid2fileobjs:
+                continue
+            if cid in self._pending:
+                if _support.output_waiting(fileobj):
+                    continue
+                self._pending.discard(cid)
+                taken += 1
+            if self._offer_token(cid, fileobj):
+                self._pending.add(cid)
+        return taken
+
+    def _schedule_recheck(self, delay):
+        if self._recheck is not None:
+            self._recheck.cancel()
+            self._recheck = None
+        self._recheck_delay = delay
+        if self._should_recheck():
+            self._recheck = self.loop.call_later(delay, self._recheck_pending)
+
+    def _should_recheck(self):
+        # A client which takes its waiting token may want another one.
+        return bool(self._tokens and self._pending)
+
+    def create_client(self, callback=None):
+        cid, pass_fds = server.JobServer.create_client(self, callback)
+        if cid is not None:
+            self.loop.call_soon(self._hand_out)
+        return cid, pass_fds
+
+    def cleanup_client(self, cid, allow_tokens=False, log=lambda msg: None):
+        self.loop.remove_reader(self.cid2fileobjs[cid].c2p_rd_fileobj.fileno())
+        self._pending.discard(cid)
+        server.JobServer.cleanup_client(self, cid, allow_tokens, log)
+        self._hand_out()
+
+    def poll(self, log=lambda msg: None, timeout=None):
+        raise RuntimeError("Tokens are handed out by the event loop")
+
+    def close(self, log=lambda msg: None):
+        server.JobServer.close(self, log)
+        if self._recheck is not None:
+            self._recheck.cancel()
+            self._recheck = None
+
+    async def run(self, *cmd, **kw):
+        """Run cmd as a client of the jobserver, returns the exit code."""
+        env = dict(kw.pop("env", os.environ))
+        cid, pass_fds = self.create_client()
+        env["MAKEFLAGS"] = utils.replace_jobserver(
+            utils.get_make_flags(env.get("MAKEFLAGS", "")), pass_fds)
+        try:
+            p = await asyncio.create_subprocess_exec(
+                *cmd, env=env, pass_fds=pass_fds, **kw)
+        except BaseException:
+            self.cleanup_client(cid, allow_tokens=True)
+            raise
+        finally:
+            for fileno in pass_fds:
+                os.close(fileno)
+
+        try:
+            return await p.wait()
+        finally:
+            self.cleanup_client(cid, allow_tokens=True)
+
+
+class AsyncJobServerProxy(AsyncJobServer, proxy.JobServerProxy):
+    """JobServerProxy run by the event loop.
+
+    Tokens are taken from the client's jobserver without blocking, when none
+    are free the event loop waits for one to appear.
+    """
+
+    def __init__(self, client, loop=None, interval=0.01, status=None):
+        self.client = client
+        AsyncJobServer.__init__(self, 0, loop, interval, status=status)
+
+        # Our own non-blocking read side, the one shared with make must stay
+        # blocking.
+        self._upstream = os.open(
+            "/proc/self/fd/{}".format(client.tokens_in.fileno()),
+            os.O_RDONLY | os.O_NONBLOCK)
+        self._upstream_waiting = False
+
+    def _init_server(self, num_tokens, **kw):
+        # Tokens are always relayed, create_client doesn't pass through.
+        proxy.JobServerProxy.__init__(self, self.client, **kw)
+
+    def _upstream_token(self):
+        if b"" not in self.client.tokens:
+            # Free token
+            return self.client.get_token()
+        try:
+            token = os.read(self._upstream, 1)
+        except BlockingIOError:
+            token = b""
+        if not token:
+            return None
+        self.client.tokens.append(token)
+        return token
+
+    def _upstream_readable(self):
+        self.loop.remove_reader(self._upstream)
+        self._upstream_waiting = False
+        self._hand_out()
+
+    def _grow_tokens(self):
+        tokenbyte = self._upstream_token()
+        if tokenbyte is None:
+            if not self._upstream_waiting:
+                self.loop.add_reader(self._upstream, self._upstream_readable)
+                self._upstream_waiting = True
+            return
+
+        tid = 0
+        while tid in self.token2bytes:
+            tid += 1
+        self.token2bytes[tid] = tokenbyte
+        self._tokens.append(tid)
+        self._log("_grow_tokens {} {} {}".format(
+            repr(tokenbyte), tid, self._tokens))
+        self._publish()
+
+    def _offer(self, cids):
+        taken = AsyncJobServer._offer(self, cids)
+        if len(self._tokens) > 1:
+            self._shrink_tokens()
+        return taken
+
+    def _should_recheck(self):
+        # Once a child takes its waiting token it may want another one from
+        # upstream.
+        return bool(self._pending)
+
+    def close(self, log=lambda msg: None):
+        AsyncJobServer.close(self, log)
+        if self._upstream_waiting:
+            self.loop.remove_reader(self._upstream)
+            self._upstream_waiting = False
+        os.close(self._upstream)
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""Share a jobserver token budget between machines.
+
+A BridgeCoordinator owns the global budget and leases blocks of tokens over
+TCP to a BridgeAgent running on each worker machine. The agent re-serves the
+leased tokens locally as an ordinary make jobserver, to the command it runs;
+
+    sys.exit(bridge.run_agent("coordinator:7000", ["make", "-j", "all"]))
+
+The agent is a JobServerProxy in front of a BridgeClient (which looks like a
+JobServerClient). It also holds a leased token for the job make runs without
+asking for one, and keeps the lease renewed while the command runs.
+
+The protocol is line based;
+
+    agent -> coordinator
+      ACQUIRE <n>   Ask for up to n more tokens.
+      RELEASE <n>   Give n tokens back.
+      RENEW         Keep the lease alive.
+
+    coordinator -> agent
+      GRANT <n> <lease>   n tokens have been added to the lease, which must
+                          be renewed within lease seconds.
+
+Tokens are requested and returned in blocks, so a job starting or finishing
+on an agent normally doesn't need a network round trip. When a lease isn't
+renewed in time, or the connection is lost, all the tokens leased to that
+agent go back to the pool.
+"""
+
+import errno
+import os
+import select
+import socket
+import subprocess
+import time
+
+from . import _support
+from . import proxy
+from . import utils
+
+
+def _parse_address(address):
+    if isinstance(address, tuple):
+        return address
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class _Connection:
+    """Line buffered, non-blocking TCP connection."""
+
+    # No line of the protocol is anywhere near this long.
+    MAX_LINE = 256
+
+    def __init__(self, sock):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.inbuf = b""
+        self.lost = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def closed(self):
+        return self.sock.fileno() == -1
+
+    def send(self, *words):
+        line = " ".join(str(w) for w in words) + "\n"
+        try:
+            self.sock.sendall(line.encode("ascii"))
+        except socket.error:
+            self.lost = True
+
+    def lines(self):
+        """Return all the complete lines received so far."""
+        while not self.lost:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                data = b""
+            if not data:
+                self.lost = True
+                break
+            self.inbuf += data
+
+        lines = self.inbuf.split(b"\n")
+        self.inbuf = lines.pop()
+        if len(self.inbuf) > self.MAX_LINE:
+            # Not talking our protocol, don't keep buffering it.
+            self.inbuf = b""
+            self.lost = True
+        return [line.decode("ascii", "replace").split() for line in lines]
+
+    def close(self):
+        self.lost = True
+        self.sock.close()
+
+
+class _Lease:
+    def __init__(self, conn, lease_time):
+        self.conn = conn
+        self.tokens = []
+        self.wanted = 0
+        self.asked = 0
+        self.expires = time.time() + lease_time
+
+
+class BridgeCoordinator:
+    """Lease tokens to BridgeClients connecting over TCP.
+
+    num_tokens - Size of the global budget (ignored if client is given).
+    client     - JobServerClient to take the budget from, so a coordinator
+                 running under make shares make's tokens.
+    address    - (host, port) to listen on, port 0 picks a free port.
+    lease_time - Seconds an agent has to renew its lease.
+    """
+
+    def __init__(self, num_tokens=None, client=None,
+                 address=("127.0.0.1", 0), lease_time=10.0):
+        self.client = client
+        if client is None:
+            assert num_tokens is not None
+            self._tokens = [b"+"] * num_tokens
+        else:
+            self._tokens = []
+        self.lease_time = lease_time
+
+        self.poller = _support.Poller()
+        self.leases = {}
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(_parse_address(address))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.poller.register(self.listener, select.EPOLLIN)
+
+        self._clear_logger()
+
+    def _clear_logger(self):
+        self._log = lambda msg: None
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def leased(self):
+        return sum(len(lease.tokens) for lease in self.leases.values())
+
+    def _accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except socket.error:
+            return
+        conn = _Connection(sock)
+        self.leases[conn] = _Lease(conn, self.lease_time)
+        self.poller.register(conn, select.EPOLLIN | select.EPOLLHUP)
+        self._log("Agent {} connected".format(addr))
+
+    def _expire(self, conn):
+        lease = self.leases.pop(conn)
+        self._log("Lease {} ended with {} tokens".format(
+            conn.fileno(), len(lease.tokens)))
+        self._tokens.extend(lease.tokens)
+        self.poller.unregister(conn)
+        conn.close()
+
+    def _malformed(self, conn, words):
+        self._log("Malformed request {} from {}".format(words, conn.fileno()))
+        # Dropped (and its tokens returned) by poll.
+        conn.lost = True
+
+    def _handle(self, conn):
+        lease = self.leases[conn]
+        for words in conn.lines():
+            if not words:
+                continue
+            cmd, args = words[0], words[1:]
+            if cmd in ("ACQUIRE", "RELEASE"):
+                try:
+                    (count,) = args
+                    count = int(count)
+                except ValueError:
+                    count = 0
+                if count <= 0:
+                    self._malformed(conn, words)
+                    break
+
+            if cmd == "ACQUIRE":
+                if not lease.wanted:
+                    lease.asked = time.time()
+                lease.wanted += count
+            elif cmd == "RELEASE":
+                count = min(count, len(lease.tokens))
+                for i in range(count):
+                    self._tokens.append(lease.tokens.pop())
+                lease.wanted = 0
+            elif cmd == "RENEW":
+                pass
+            else:
+                self._log("Unknown request {} from {}".format(
+                    words, conn.fileno()))
+            lease.expires = time.time() + self.lease_time
+
+    def _grant(self):
+        wanting = [
+            lease for lease in self.leases.values() if lease.wanted > 0]
+        if self.client is not None:
+            wanted = sum(lease.wanted for lease in wanting)
+            while len(self._tokens) < wanted:
+                token = self.client.get_token()
+                if token is None:
+                    break
+                self._tokens.append(token)
+
+        # Hand out tokens one at a time round robin, agents holding the least
+        # first, so a single agent asking for a big block (or asking again
+        # straight after releasing) doesn't starve the others.
+        wanting.sort(key=lambda lease: (len(lease.tokens), lease.asked))
+        granted = {}
+        while self._tokens and wanting:
+            for lease in list(wanting):
+                if not self._tokens:
+                    break
+                lease.tokens.append(self._tokens.pop())
+                lease.wanted -= 1
+                granted[lease] = granted.get(lease, 0) + 1
+                if lease.wanted == 0:
+                    wanting.remove(lease)
+
+        for lease, count in granted.items():
+            lease.conn.send("GRANT", count, self.lease_time)
+            lease.expires = time.time() + self.lease_time
+            self._log("Granted {} tokens to {} (holding {})".format(
+                count, lease.conn.fileno(), len(lease.tokens)))
+
+        # Don't sit on tokens nobody wants.
+        if self.client is not None and not wanting:
+            while self._tokens:
+                self.client.return_token(self._tokens.pop())
+
+    def poll(self, log=lambda msg: None, timeout=None):
+        self._log = log
+
+        if timeout is None:
+            timeout = -1
+        for fileobj, events in self.poller.poll(timeout):
+            if fileobj is self.listener:
+                self._accept()
+            else:
+                self._handle(fileobj)
+
+        now = time.time()
+        for conn, lease in list(self.leases.items()):
+            # Only a lease holding tokens needs renewing.
+            if conn.lost or (lease.tokens and lease.expires < now):
+                self._expire(conn)
+
+        self._grant()
+        self._clear_logger()
+
+    def serve_forever(self, log=lambda msg: None):
+        while True:
+            self.poll(log=log, timeout=1.0)
+
+    def close(self):
+        for conn in list(self.leases):
+            self._expire(conn)
+        self.poller.unregister(self.listener)
+        self.listener.close()
+        if self.client is not None:
+            while self._tokens:
+                self.client.return_token(self._tokens.pop())
+
+
+class BridgeClient:
+    """JobServerClient look-alike which gets its tokens from a coordinator.
+
+    batch       - Number of tokens asked for at a time, and the number of
+                  unused tokens kept before any are given back.
+    idle_return - Seconds an unused token is kept before it is released.
+
+    Unlike a JobServerClient there is no free token, every job on the agent
+    is covered by the global budget.
+    """
+
+    def __init__(self, address, batch=4, idle_return=0.5):
+        self.batch = batch
+        self.idle_return = idle_return
+
+        sock = socket.create_connection(_parse_address(address))
+        self.conn = _Connection(sock)
+
+        self.tokens = []
+        self._spare = []
+        self._pending = 0
+        self._idle_since = time.time()
+        self.lease_time = None
+        self._renewed = time.time()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    @property
+    def connected(self):
+        return not self.conn.lost
+
+    def pump(self):
+        """Process any grants and keep the lease alive."""
+        for words in self.conn.lines():
+            if words and words[0] == "GRANT":
+                count = int(words[1])
+                self.lease_time = float(words[2])
+                self._spare.extend([b"+"] * count)
+                self._idle_since = time.time()
+                self._pending = max(0, self._pending - count)
+
+        if self.conn.lost:
+            # The lease is gone, so are the tokens.
+            self._spare = []
+            self._pending = 0
+            return
+
+        now = time.time()
+        if self._spare and now - self._idle_since > self.idle_return:
+            self._release(len(self._spare))
+
+        if self.lease_time and now - self._renewed > self.lease_time / 3.0:
+            self.conn.send("RENEW")
+            self._renewed = now
+
+    def _release(self, count):
+        del self._spare[:count]
+        self.conn.send("RELEASE", count)
+        self._pending = 0
+        self._renewed = time.time()
+
+    def get_token(self):
+        self.pump()
+        if not self._spare:
+            if not self._pending and self.connected:
+                self.conn.send("ACQUIRE", self.batch)
+                self._pending = self.batch
+                self._renewed = time.time()
+            return None
+
+        token = self._spare.pop()
+        self.tokens.append(token)
+        return token
+
+    def return_token(self, token):
+        assert isinstance(token, bytes), repr(token)
+        beforelen = len(self.tokens)
+        self.tokens.remove(token)
+        assert beforelen - 1 == len(self.tokens)
+
+        if not self.connected:
+            return
+        self._spare.append(token)
+        self._idle_since = time.time()
+        if len(self._spare) > self.batch:
+            self._release(len(self._spare) - self.batch)
+
+    def cleanup(self):
+        while self.tokens:
+            self.return_token(self.tokens[0])
+        if self.connected:
+            if self._spare:
+                self._release(len(self._spare))
+            self.conn.close()
+
+    def __str__(self):
+        return "BridgeClient(fd={}, tokens={}, spare={})".format(
+            self.conn.fileno(), len(self.tokens), len(self._spare))
+
+
+class BridgeAgent:
+    """Run commands under a local jobserver of tokens leased from a
+    coordinator.
+
+    interval - Seconds between checks of the lease (and the command) while
+               waiting, must be well below the coordinator's lease_time.
+
+    The other arguments are passed on to BridgeClient.
+    """
+
+    def __init__(self, address, batch=4, idle_return=0.5, interval=0.05):
+        self.interval = interval
+        self.client = BridgeClient(address, batch, idle_return)
+        self.proxy = None
+        # Covers the job slot make gives the command without a token.
+        self.slot = None
+
+    def poll(self, log=lambda msg: None, timeout=None):
+        if timeout is None or timeout < 0 or timeout > self.interval:
+            timeout = self.interval
+        if self.proxy is not None:
+            self.proxy.poll(log=log, timeout=timeout)
+        else:
+            select.select([self.client], [], [], timeout)
+        self.client.pump()
+
+    def start(self, log=lambda msg: None):
+        """Wait until the slot token has been leased."""
+        while self.slot is None:
+            if not self.client.connected:
+                raise ConnectionError("Lost the coordinator")
+            self.slot = self.client.get_token()
+            if self.slot is None:
+                self.poll(log)
+        self.proxy = proxy.JobServerProxy(self.client)
+
+    def run(self, command, log=lambda msg: None, **kw):
+        """Run command (a subprocess.Popen argv) under the leased tokens,
+        returns its exit code."""
+        if self.proxy is None:
+            self.start(log)
+
+        childid, pass_fds = self.proxy.create_client()
+        env = dict(kw.pop("env", os.environ))
+        env["MAKEFLAGS"] = utils.replace_jobserver(
+            env.get("MAKEFLAGS", ""), pass_fds)
+        try:
+            p = subprocess.Popen(command, env=env, pass_fds=pass_fds, **kw)
+        finally:
+            for fileno in pass_fds:
+                os.close(fileno)
+
+        retcode = None
+        while retcode is None:
+            self.poll(log)
+            retcode = p.poll()
+        self.proxy.poll(log=log, timeout=0)
+        self.proxy.cleanup_client(childid, allow_tokens=True, log=log)
+        return retcode
+
+    def close(self, log=lambda msg: None):
+        if self.proxy is not None:
+            self.proxy.cleanup(log=log)
+            self.proxy = None
+        if self.slot is not None:
+            self.client.return_token(self.slot)
+            self.slot = None
+        self.client.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_agent(address, command, log=lambda msg: None, **kw):
+    """Run command with tokens leased from the coordinator at address."""
+    with BridgeAgent(address) as agent:
+        return agent.run(command, log, **kw)
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 """Simple client for the make jobserver."""
 
+import contextlib
+import os
+import select
 import signal
+import threading
+import time
 
 from . import utils
 
@@ -14,20 +19,55 @@ except NameError:
 
 
 class JobServerClient:
-    def __init__(self, make_flags=None):
+    """Client for an existing make jobserver.
+
+    prefetch     - Number of tokens to keep in reserve while work is queued
+                   (see prefetch_tokens), 0 disables prefetching.
+    idle_timeout - Seconds a reserved token is kept unused before it is
+                   given back to the jobserver (by a timer, so also while
+                   the client isn't being called).
+
+    With prefetching a token returned while work is still queued is kept in
+    the reserve rather than written straight back, so the next task doesn't
+    have to wait on the pipe (and can't lose the token to another process in
+    between).
+
+    A job blocked on I/O can lend its job slot to other jobs with
+    yield_token() / reclaim() (or the yielding() context, or AutoYield).
+    aio.yielding() does the same from asyncio code.
+    """
+
+    def __init__(self, make_flags=None, prefetch=0, idle_timeout=0.05):
         self.tokens = []
+
+        self.prefetch = prefetch
+        self.idle_timeout = idle_timeout
+        # List of (token, time reserved, was it prefetched)
+        self._reserve = []
+        self.prefetched = 0
+        self.prefetch_unused = 0
+        # Pieces of work waiting for a token, as prefetch_tokens() (or
+        # return_token()) was last told, less the tokens taken since.
+        self._queued = 0
+        self._timer = None
+        self._lock = threading.RLock()
+
         job_rd_fd, job_wr_fd = utils.fds_for_jobserver(make_flags)
 
         self.tokens_in = job_rd_fd
         self.tokens_out = job_wr_fd
 
+        # Number of job slots given back by yield_token().
+        self.yielded = 0
+        self._nonblocking_rd = None
+
     def _sig_alarm(self, *args):
         raise InterruptedError(*args)
 
-    def _read_with_timeout(self):
+    def _read_with_timeout(self, timeout=0.1):
         oldhandler = signal.signal(signal.SIGALRM, self._sig_alarm)
         try:
-            signal.setitimer(signal.ITIMER_REAL, 0.1)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
             data = self.tokens_in.read(1)
             if len(data) == 0:
                 return None
@@ -46,35 +86,236 @@ class JobServerClient:
                     pass
             signal.signal(signal.SIGALRM, oldhandler)
 
-    def get_token(self):
+    def _take_held(self):
+        """The free token or a reserved one, None if we have neither."""
         if b"" not in self.tokens:
             # Free token
-            token = b""
-        else:
-            # Get token from jobserver
-            token = self._read_with_timeout()
-            assert token is None or len(token) == 1, token
+            return b""
+        if self._reserve:
+            # Reserved token
+            token, _, _ = self._reserve.pop()
+            return token
+        return None
 
-        if token is not None:
-            assert isinstance(token, bytes), repr(token)
-            self.tokens.append(token)
+    def _add_token(self, token):
+        assert isinstance(token, bytes), repr(token)
+        self.tokens.append(token)
+        self._queued = max(self._queued - 1, 0)
+        self._trim_reserve()
+
+    def get_token(self):
+        with self._lock:
+            self.release_idle()
+            token = self._take_held()
+            if token is not None:
+                self._add_token(token)
+                return token
 
+        # Get token from jobserver
+        token = self._read_with_timeout()
+        assert token is None or len(token) == 1, token
+        if token is not None:
+            with self._lock:
+                self._add_token(token)
         return token
 
-    def return_token(self, token):
+    def get_token_nowait(self):
+        """get_token() which never waits, None if no token is free.
+
+        Doesn't use signals, so can be called outside the main thread.
+        """
+        with self._lock:
+            token = self._take_held()
+            if token is None:
+                try:
+                    token = os.read(self._nonblocking_fd(), 1)
+                except BlockingIOError:
+                    return None
+                if not token:
+                    return None
+            self._add_token(token)
+            return token
+
+    def return_token(self, token, queued=None):
+        """Give back a token from get_token().
+
+        With prefetching the token is kept for the next piece of work if any
+        are still queued, queued defaults to the number prefetch_tokens() was
+        last given less the tokens taken since.
+        """
         assert isinstance(token, bytes), repr(token)
 
-        if token != b"":
-            # Return the token to jobserver
-            self.tokens_out.write(token)
+        with self._lock:
+            if queued is not None:
+                self._queued = queued
+            if token != b"":
+                if len(self._reserve) < min(self.prefetch, self._queued):
+                    # Keep the token for the next piece of work
+                    self._reserve.append((token, time.time(), False))
+                    self._schedule_release()
+                else:
+                    # Return the token to jobserver
+                    self.tokens_out.write(token)
 
-        beforelen = len(self.tokens)
-        self.tokens.remove(token)
-        assert beforelen - 1 == len(self.tokens)
+            beforelen = len(self.tokens)
+            self.tokens.remove(token)
+            assert beforelen - 1 == len(self.tokens)
+
+            self.release_idle()
+
+    def prefetch_tokens(self, queued):
+        """Top up the reserve of tokens for queued pieces of work.
+
+        Only tokens which can be read without waiting are taken, at most one
+        token is reserved per queued piece of work (on top of the free token)
+        and never more than the prefetch limit.
+        """
+        with self._lock:
+            self._queued = queued
+            self.release_idle()
+            self._trim_reserve()
+
+            wanted = min(self.prefetch, queued - (b"" not in self.tokens))
+            while len(self._reserve) < wanted:
+                readable, _, _ = select.select([self.tokens_in], [], [], 0)
+                if not readable:
+                    break
+                # Another process can still beat us to the token.
+                token = self._read_with_timeout(0.001)
+                if token is None:
+                    break
+                self._reserve.append((token, time.time(), True))
+                self.prefetched += 1
+            self._schedule_release()
+
+    def yield_token(self):
+        """Lend one of our job slots to the jobserver while we are blocked.
+
+        A token is written to the jobserver (one of ours if we hold any, or
+        a new one standing in for our free token), reclaim() takes one back
+        and drops it. The tokens we hold are left as they are, so they can
+        be returned as normal. Returns False if we hold nothing (more) to
+        lend.
+        """
+        with self._lock:
+            if self.yielded >= len(self.tokens):
+                return False
+            real = [token for token in self.tokens if token != b""]
+            self.tokens_out.write(real[-1] if real else b"+")
+            self.yielded += 1
+            return True
+
+    def _reclaim_reserved(self):
+        with self._lock:
+            assert self.yielded > 0, "Nothing yielded"
+            # Our own reserve goes to the slot we lent before anything else.
+            if not self._reserve:
+                return False
+            self._reserve.pop()
+            self.yielded -= 1
+            return True
+
+    def _nonblocking_fd(self):
+        """Our own non-blocking read side, usable outside the main thread."""
+        if self._nonblocking_rd is None:
+            self._nonblocking_rd = os.open(
+                "/proc/self/fd/{}".format(self.tokens_in.fileno()),
+                os.O_RDONLY | os.O_NONBLOCK)
+        return self._nonblocking_rd
+
+    def _reclaim_read(self):
+        with self._lock:
+            try:
+                token = os.read(self._nonblocking_fd(), 1)
+            except BlockingIOError:
+                return False
+            assert len(token) == 1, token
+            self.yielded -= 1
+            return True
+
+    def reclaim(self, timeout=None):
+        """Take back a job slot lent by yield_token(), waiting for a token.
+
+        Returns False if none turned up within timeout seconds.
+        """
+        if self._reclaim_reserved():
+            return True
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if self._reclaim_read():
+                return True
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    return False
+            select.select([self._nonblocking_fd()], [], [], wait)
+
+    @contextlib.contextmanager
+    def yielding(self):
+        """Lend a job slot for the duration of the block.
+
+            with client.yielding():
+                data = download(url)
+        """
+        yielded = self.yield_token()
+        try:
+            yield
+        finally:
+            if yielded:
+                self.reclaim()
+
+    def release_idle(self, force=False):
+        """Give back reserved tokens which haven't been used recently."""
+        with self._lock:
+            now = time.time()
+            while self._reserve:
+                if not force and now - self._reserve[0][1] < self.idle_timeout:
+                    break
+                self._release_reserved()
+
+    def _release_reserved(self):
+        token, _, prefetched = self._reserve.pop(0)
+        if prefetched:
+            self.prefetch_unused += 1
+        self.tokens_out.write(token)
+
+    def _trim_reserve(self):
+        """Only keep a token in reserve for each piece of queued work."""
+        while len(self._reserve) > self._queued:
+            self._release_reserved()
+
+    def _schedule_release(self):
+        """Make sure the reserve is given back once it has been idle, even
+        if the client isn't called again."""
+        if self._timer is not None or not self._reserve:
+            return
+        delay = self._reserve[0][1] + self.idle_timeout - time.time()
+        self._timer = threading.Timer(max(delay, 0), self._release_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _release_timer(self):
+        with self._lock:
+            self._timer = None
+            self.release_idle()
+            self._schedule_release()
 
     def cleanup(self):
+        while self.yielded:
+            self.reclaim()
         while self.tokens:
             self.return_token(self.tokens[0])
+        with self._lock:
+            self.release_idle(force=True)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._nonblocking_rd is not None:
+            os.close(self._nonblocking_rd)
+            self._nonblocking_rd = None
 
     def __str__(self):
         return "JobServer(in_tokens={}, out_tokens={})".format(
@@ -83,3 +324,157 @@ class JobServerClient:
 
     def __del__(self):
         self.cleanup()
+
+
+def _stat(pid):
+    with open("/proc/{}/stat".format(pid), "rb") as f:
+        stat = f.read()
+    # The command name can contain spaces, the fields start after it.
+    return stat[stat.rindex(b")") + 2:].split()
+
+
+class _ProcessTree:
+    """Process pid and the processes below it.
+
+    The parent of every process on the host is remembered between samples,
+    so only the processes started since the last one and the ones in the
+    tree are read from /proc.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.parents = {}
+
+    def _update(self):
+        pids = set(int(name) for name in os.listdir("/proc") if name.isdigit())
+        for pid in set(self.parents) - pids:
+            del self.parents[pid]
+        for pid in pids - set(self.parents):
+            try:
+                self.parents[pid] = int(_stat(pid)[1])
+            except OSError:
+                # Exited while we were looking.
+                pass
+
+    def cpu_ticks(self):
+        self._update()
+        below = {}
+        for pid, ppid in self.parents.items():
+            below.setdefault(ppid, []).append(pid)
+
+        ticks = 0
+        todo = [(self.pid, None)]
+        while todo:
+            pid, ppid = todo.pop()
+            try:
+                fields = _stat(pid)
+            except OSError:
+                if ppid is None:
+                    raise
+                continue
+            if ppid is not None and int(fields[1]) != ppid:
+                # Reparented (or the pid was reused), no longer below us.
+                self.parents[pid] = int(fields[1])
+                continue
+            # utime, stime, cutime, cstime
+            ticks += sum(int(field) for field in fields[11:15])
+            todo.extend((child, pid) for child in below.get(pid, ()))
+        return ticks
+
+
+def cpu_ticks(pid=None, children=True):
+    """User + system CPU time used by process pid, in clock ticks.
+
+    With children the time of every process below pid is included, the ones
+    still running as well as the ones which have exited (and been waited
+    for).
+    """
+    if pid is None:
+        pid = os.getpid()
+    if children:
+        return _ProcessTree(pid).cpu_ticks()
+    fields = _stat(pid)
+    return int(fields[11]) + int(fields[12])
+
+
+class AutoYield:
+    """Lend a job slot whenever the process is (mostly) not using the CPU.
+
+    A thread samples the CPU use of process pid (ourselves by default) and,
+    with children, every process started below it, every interval seconds.
+    So a driver waiting on a busy subprocess isn't seen as idle. The slot is
+    lent once it drops below idle (a fraction of one core) and taken back
+    once it reaches busy. The process carries on running while the slot is
+    lent, so the jobserver can be over-subscribed by one until the next
+    sample after the process becomes busy again.
+
+    The client can still be used by other threads while the slot is lent,
+    the client's state is guarded by its lock.
+
+        with AutoYield(client):
+            process_assets()
+    """
+
+    def __init__(self, client, pid=None, interval=0.5, idle=0.1, busy=0.5,
+                 children=True):
+        self.client = client
+        self.pid = pid
+        self.children = children
+        self.interval = interval
+        self.idle = idle
+        self.busy = busy
+        self.lent = False
+        self.yields = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._tree = None
+        if children:
+            self._tree = _ProcessTree(os.getpid() if pid is None else pid)
+
+    def _cpu_ticks(self):
+        if self._tree is not None:
+            return self._tree.cpu_ticks()
+        return cpu_ticks(self.pid, children=False)
+
+    def _sample(self, last):
+        ticks = self._cpu_ticks()
+        now = time.time()
+        used = (ticks - last[0]) / os.sysconf("SC_CLK_TCK") / (now - last[1])
+        return used, (ticks, now)
+
+    def _run(self):
+        last = (self._cpu_ticks(), time.time())
+        while not self._stop.wait(self.interval):
+            try:
+                used, last = self._sample(last)
+            except (OSError, ValueError):
+                # The process has gone.
+                break
+            if not self.lent and used < self.idle:
+                self.lent = self.client.yield_token()
+                self.yields += int(self.lent)
+            elif self.lent and used >= self.busy:
+                self.lent = not self.client.reclaim(self.interval)
+        if self.lent:
+            self.client.reclaim()
+            self.lent = False
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="AutoYield", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling, taking back the slot if it is lent."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Host-wide jobserver shared by independent builds.
+
+A single long running JobServerDaemon owns the token pool for the whole
+machine. Top-level builds connect to its Unix socket, receive a pair of
+jobserver pipes (passed with SCM_RIGHTS) and then run make exactly as if they
+had been started under a normal jobserver.
+
+Each build keeps the connection open for its whole life, when the connection
+is closed (even by the build being killed) every token the build was holding
+is returned to the pool.
+
+    python -m make.jobserver daemon -j 16 --quota 8 &
+    python -m make.jobserver serve --attach -- make all
+"""
+
+import array
+import os
+import select
+import socket
+import struct
+import tempfile
+import time
+
+from . import _support
+from . import server
+
+
+def default_path():
+    """Return the well-known path of the daemon's socket."""
+    path = os.environ.get("MAKE_JOBSERVER_DAEMON", None)
+    if path:
+        return path
+    rundir = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+    return os.path.join(
+        rundir, "make-jobserver-{}.sock".format(os.getuid()))
+
+
+class DaemonRunningError(Exception):
+    pass
+
+
+class JobServerDaemon(server.JobServer):
+    """JobServer serving tokens to builds connecting over a Unix socket.
+
+    num_tokens - Size of the host wide token pool.
+    path       - Socket path, defaults to default_path().
+    quota      - Maximum number of tokens a single build may hold.
+    interval   - How often (in seconds) client pipes are checked for a
+                 consumed token. Pipes give no notification when the other
+                 end reads from them so this can't be purely event driven.
+
+    When more than one build is attached the tokens are shared fairly, a
+    build can only go over its fair share while no other build is waiting
+    for a token.
+    """
+
+    STATUS_KIND = "daemon"
+
+    def __init__(self, num_tokens=None, path=None, quota=None,
+                 interval=0.01):
+        server.JobServer.__init__(self, num_tokens)
+        self.num_tokens = len(self._tokens)
+        self.quota = quota
+        self.interval = interval
+
+        if path is None:
+            path = default_path()
+        self.path = path
+
+        self.cid2conn = {}
+        self.cid2quota = {}
+        self._armed = True
+        self._last_armed = time.time()
+        self._gone = []
+
+        self.listener = self._listen(path)
+        self.fileobj2cid[self.listener] = "listen"
+        self.poller.register(self.listener, select.EPOLLIN)
+
+    @staticmethod
+    def _listen(path):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Left behind by a daemon which didn't exit cleanly.
+                os.unlink(path)
+            else:
+                raise DaemonRunningError(
+                    "Daemon already running on {}".format(path))
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(64)
+        listener.setblocking(False)
+        return listener
+
+    def _client_may_take(self, cid):
+        held = len(self.cid2tokens[cid])
+        quota = self.cid2quota[cid]
+        if quota and held >= quota:
+            return False
+
+        share = max(1, -(-self.num_tokens // len(self.cid2quota)))
+        if held < share:
+            return True
+
+        # Only go over the fair share while every other build which is under
+        # its share can still get a token.
+        hungry = 0
+        for other in self.cid2quota:
+            if other != cid and len(self.cid2tokens[other]) < share:
+                hungry += 1
+        return len(self._tokens) > hungry
+
+    def _arm(self, armed):
+        """Enable / disable the "pipe is writable" events for all clients."""
+        if armed == self._armed:
+            return
+        flags = select.EPOLLHUP
+        if armed:
+            flags |= select.EPOLLOUT
+            self._last_armed = time.time()
+        for fileobjs in self.cid2fileobjs.values():
+            self.poller.modify(fileobjs.p2c_wr_fileobj, flags)
+        self._armed = armed
+
+    def _accept(self):
+        try:
+            conn, _ = self.listener.accept()
+        except socket.error:
+            return
+        conn.setblocking(False)
+        self.fileobj2cid[conn] = "conn"
+        self.poller.register(conn, select.EPOLLIN | select.EPOLLHUP)
+
+    def _attach(self, conn):
+        try:
+            request = conn.recv(128)
+        except socket.error:
+            return
+        if not request:
+            self._drop_conn(conn)
+            return
+
+        words = request.decode("ascii", "replace").split()
+        quota = self.quota
+        if len(words) > 1 and words[0] == "attach" and words[1].isdigit():
+            wanted = int(words[1])
+            if wanted and (not quota or wanted < quota):
+                quota = wanted
+
+        cid, pass_fds = self.create_client()
+
+        # The pipe is only read by the build, never block on reading back
+        # tokens from a build which has gone away.
+        _support.set_nonblocking(self.cid2fileobjs[cid].c2p_rd_fileobj)
+        if not self._armed:
+            self.poller.modify(
+                self.cid2fileobjs[cid].p2c_wr_fileobj, select.EPOLLHUP)
+
+        self.cid2conn[cid] = conn
+        self.cid2quota[cid] = quota
+        pid, _, _ = struct.unpack("3i", conn.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        self.describe_client(cid, pid, "build")
+        self.fileobj2cid[conn] = ("build", cid)
+
+        try:
+            conn.sendmsg(
+                [("ok {}\n".format(cid)).encode("ascii")],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                  array.array("i", pass_fds))])
+        except socket.error:
+            self._gone.append(cid)
+        finally:
+            for fileno in pass_fds:
+                os.close(fileno)
+        self._log("Attached build {} with quota {}".format(cid, quota))
+
+    def _drop_conn(self, conn):
+        self.poller.unregister(conn)
+        del self.fileobj2cid[conn]
+        conn.close()
+
+    def _handle_event(self, cid, fileobj, events):
+        if cid == "listen":
+            self._accept()
+        elif cid == "conn":
+            self._attach(fileobj)
+        else:
+            # The build has closed the connection (or died), it is cleaned up
+            # after this poll as its pipes may still have pending events.
+            _, cid = cid
+            assert cid in self.cid2conn, (cid, self.cid2conn)
+            if cid not in self._gone:
+                self._gone.append(cid)
+
+    def _detach(self, cid):
+        self._log("Detaching build {} (holding {})".format(
+            cid, self.cid2tokens[cid]))
+        self._drop_conn(self.cid2conn.pop(cid))
+        del self.cid2quota[cid]
+        self.cleanup_client(cid, allow_tokens=True, log=self._log)
+
+    def cleanup_client(self, cid, allow_tokens=False, log=lambda msg: None):
+        if cid in self.cid2conn:
+            self._log = log
+            self._detach(cid)
+            return
+        server.JobServer.cleanup_client(self, cid, allow_tokens, log)
+
+    def poll(self, log=lambda msg: None, timeout=None):
+        if timeout is None or timeout < 0 or timeout > self.interval:
+            timeout = self.interval
+        before = len(self._tokens)
+
+        waited = time.time() - self._last_armed
+        self._arm(self._armed or waited >= self.interval)
+        server.JobServer.poll(self, log, timeout)
+
+        self._log = log
+        while self._gone:
+            self._detach(self._gone.pop(0))
+
+        # Check again straight away if tokens came back, otherwise wait for
+        # the next interval before looking at the client pipes again.
+        self._arm(len(self._tokens) > before)
+        self._clear_logger()
+
+    def serve_forever(self, log=lambda msg: None):
+        while True:
+            self.poll(log=log)
+
+    def close(self, log=lambda msg: None):
+        for cid in list(self.cid2conn):
+            self.cleanup_client(cid, allow_tokens=True, log=log)
+        self.poller.unregister(self.listener)
+        del self.fileobj2cid[self.listener]
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server.JobServer.close(self, log)
+
+
+def attach(path=None, quota=None):
+    """Attach to the daemon listening on path.
+
+    Returns the connection (which must be kept open while the build is
+    running) and the pass_fds for the jobserver pipes.
+    """
+    if path is None:
+        path = default_path()
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    conn.sendall("attach {}\n".format(quota or 0).encode("ascii"))
+
+    fds = array.array("i")
+    msg, ancdata, flags, addr = conn.recvmsg(
+        128, socket.CMSG_LEN(2 * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    assert msg.startswith(b"ok") and len(fds) == 2, (msg, list(fds))
+
+    return conn, server.JobServer.pass_fds(*fds)
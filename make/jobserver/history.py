@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Resource use of earlier runs of commands, to weight and order them by.
+
+Every command costs one token, however many cores it keeps busy. With
+learning on (the `--learn` option of run, xargs, serve and proxy) the CPU
+time, wall time and peak memory of each command (from wait4) are recorded
+against a signature of its command line and directory. Later runs charge the
+command the number of job slots it used beyond the tokens it took from the
+jobserver itself, and xargs starts the longest commands first.
+
+The history is a single small JSON file (MAKE_JOBSERVER_HISTORY, defaults to
+under $XDG_CACHE_HOME) of at most `max_entries` commands, the least recently
+run are dropped when it is full.
+"""
+
+from collections import namedtuple
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+
+MAX_ENTRIES = 1000
+
+# Weight of the newest run in the averages.
+ALPHA = 0.5
+
+# runs, mean wall time (s), mean CPU time (s), peak RSS (KiB), mean extra
+# tokens taken from the jobserver while running, last run (time.time()).
+Entry = namedtuple("Entry", ["runs", "wall", "cpu", "rss", "tokens", "last"])
+
+
+def history_path():
+    path = os.environ.get("MAKE_JOBSERVER_HISTORY", None)
+    if path:
+        return path
+    cache = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache, "make-jobserver", "history.json")
+
+
+def signature(command, cwd=None):
+    """Key of command (an argv list) run in cwd."""
+    if cwd is None:
+        cwd = os.getcwd()
+    data = "\0".join([cwd] + list(command)).encode("utf-8", "replace")
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def cpu_time(rusage):
+    return rusage.ru_utime + rusage.ru_stime
+
+
+class History:
+    """Recorded runs of commands, loaded from (and saved to) path."""
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES,
+                 mem_per_token=None):
+        """
+        mem_per_token = Charge commands using more memory than this (in
+                        bytes) per job slot for the memory instead, defaults
+                        to MAKE_JOBSERVER_MEM_PER_TOKEN (in MiB).
+        """
+        if path is None:
+            path = history_path()
+        if mem_per_token is None:
+            mib = os.environ.get("MAKE_JOBSERVER_MEM_PER_TOKEN", "")
+            if mib:
+                mem_per_token = int(mib) * 1024 * 1024
+        self.path = path
+        self.max_entries = max_entries
+        self.mem_per_token = mem_per_token
+        self.entries = self._load()
+        # Runs recorded since loading, (sig, wall, cpu, rss, tokens, when).
+        self._runs = []
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        entries = {}
+        for sig, values in data.items():
+            try:
+                entries[sig] = Entry(*values)
+            except TypeError:
+                # Written by an incompatible version.
+                continue
+        return entries
+
+    def get(self, sig):
+        return self.entries.get(sig, None)
+
+    def duration(self, sig, default=None):
+        """Expected wall time of the command, default if never run."""
+        entry = self.get(sig)
+        if entry is None:
+            return default
+        return entry.wall
+
+    def weight(self, sig, limit=None):
+        """Number of job slots (at most limit) to charge the command.
+
+        The cores it kept busy on average, less the tokens it took from the
+        jobserver itself.
+        """
+        entry = self.get(sig)
+        if entry is None or entry.wall <= 0:
+            return 1
+        weight = int(round(entry.cpu / entry.wall - entry.tokens))
+        if self.mem_per_token:
+            weight = max(weight, -(-entry.rss * 1024 // self.mem_per_token))
+        weight = max(weight, 1)
+        if limit is not None:
+            weight = min(weight, max(limit, 1))
+        return weight
+
+    def order(self, items, key=lambda item: item):
+        """Sort items longest first, never seen ones before all the rest.
+
+        key(item) gives the signature of an item.
+        """
+        def expected(item):
+            return -self.duration(key(item), float("inf"))
+        return sorted(items, key=expected)
+
+    def _update(self, entries, sig, wall, cpu, rss, tokens, when):
+        old = entries.get(sig, None)
+        if old is not None:
+            wall = old.wall + ALPHA * (wall - old.wall)
+            cpu = old.cpu + ALPHA * (cpu - old.cpu)
+            rss = max(int(old.rss + ALPHA * (rss - old.rss)), 0)
+            tokens = old.tokens + ALPHA * (tokens - old.tokens)
+        runs = old.runs + 1 if old is not None else 1
+        entries[sig] = Entry(runs, wall, cpu, rss, tokens, when)
+
+    def record(self, sig, wall, cpu, rss, tokens=0.0):
+        """Record a run taking wall seconds, cpu seconds and rss KiB.
+
+        tokens is the mean number of tokens the command took from the
+        jobserver while it ran (on top of the one it was started on).
+        """
+        run = (sig, wall, cpu, rss, tokens, time.time())
+        self._runs.append(run)
+        self._update(self.entries, *run)
+
+    def _evict(self, entries):
+        if len(entries) <= self.max_entries:
+            return
+        oldest = sorted(entries, key=lambda sig: entries[sig].last)
+        for sig in oldest[:len(entries) - self.max_entries]:
+            del entries[sig]
+
+    def save(self):
+        """Merge the runs recorded since loading into the file."""
+        if not self._runs:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Other processes are recording too, reload under the lock.
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._load()
+            for run in self._runs:
+                self._update(entries, *run)
+            self._evict(entries)
+
+            tmp = "{}.{}".format(self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(entries, f, separators=(",", ":"))
+            os.replace(tmp, self.path)
+
+        self.entries = entries
+        self._runs = []
+
+
+def run(argv, history, make_flags=None, limit=None):
+    """lite.run, charging argv its weight from history and recording it.
+
+    The first token is waited for, extra tokens are only taken while they are
+    free (so commands waiting for their weight can't deadlock). Returns the
+    exit code.
+    """
+    from . import lite
+
+    sig = signature(argv)
+    tokens = [lite.acquire(make_flags)]
+    try:
+        if tokens[0] is not None:
+            for i in range(history.weight(sig, limit) - 1):
+                token = lite.acquire(make_flags, block=False)
+                if token is None:
+                    break
+                tokens.append(token)
+
+        start = time.time()
+        pid = lite._spawn(argv)
+        _, status, rusage = os.wait4(pid, 0)
+    finally:
+        for token in tokens:
+            lite.release(token, make_flags)
+
+    history.record(
+        sig, time.time() - start, cpu_time(rusage), rusage.ru_maxrss)
+    history.save()
+    return lite._exitcode(status)
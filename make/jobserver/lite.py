@@ -0,0 +1,192 @@
+"""Minimal, fast starting jobserver client.
+
+For tools which are exec'd thousands of times per build (compiler wrappers,
+code generators) where the import and setup cost of the full client is paid
+on every exec. Only `os` is imported, MAKEFLAGS is parsed with plain string
+operations (once per value) and nothing is opened until a token is actually
+wanted.
+
+    from make.jobserver import lite
+    jobs = [lite.start(["gen", f]) for f in inputs]
+    sys.exit(max(job.wait() for job in jobs))
+"""
+
+import os
+
+_JOBSERVER_PREFIXES = ("--jobserver-auth=", "--jobserver-fds=")
+
+_parsed = {}
+_fds = {}
+
+
+def parse(make_flags=None):
+    """Parse MAKEFLAGS into (dry_run, jobserver).
+
+    jobserver is None, a (read fd, write fd) tuple or a fifo path string.
+    """
+    if make_flags is None:
+        make_flags = os.environ.get("MAKEFLAGS", "")
+    try:
+        return _parsed[make_flags]
+    except KeyError:
+        pass
+
+    dry_run = False
+    jobserver = None
+    words = make_flags.split()
+    for i, word in enumerate(words):
+        if word == "--":
+            break
+        if i == 0 and not word.startswith("-"):
+            # The single letter flags come first, without a dash.
+            dry_run = "n" in word or "q" in word
+        elif word.startswith(_JOBSERVER_PREFIXES):
+            value = word.split("=", 1)[1]
+            if value.startswith("fifo:"):
+                jobserver = value[5:]
+            else:
+                rd, _, wr = value.partition(",")
+                if rd.isdigit() and wr.isdigit():
+                    jobserver = (int(rd), int(wr))
+        elif word == "-n" or word == "-q":
+            dry_run = True
+
+    _parsed[make_flags] = (dry_run, jobserver)
+    return dry_run, jobserver
+
+
+def should_run(make_flags=None):
+    return not parse(make_flags)[0]
+
+
+def _path(jobserver):
+    if isinstance(jobserver, tuple):
+        return "/proc/self/fd/{}".format(jobserver[0])
+    return jobserver
+
+
+def _open(jobserver):
+    """Return (read fd, write fd) for the jobserver, or None if it's gone.
+
+    The read side is always reopened, which gives a separate file description
+    from the one shared with every other process. Make (4.3) can leave the
+    shared one non-blocking and changing it back would upset make.
+    """
+    try:
+        return _fds[jobserver]
+    except KeyError:
+        pass
+    try:
+        rd = os.open(_path(jobserver), os.O_RDONLY)
+        if isinstance(jobserver, tuple):
+            wr = jobserver[1]
+            os.fstat(wr)
+        else:
+            wr = os.open(jobserver, os.O_WRONLY)
+        fds = (rd, wr)
+    except OSError:
+        # Make didn't pass the jobserver on (not a recursive make rule).
+        fds = None
+    _fds[jobserver] = fds
+    return fds
+
+
+def acquire(make_flags=None, block=True):
+    """Take a token from the jobserver.
+
+    Returns the token, or None when there is no jobserver (the caller runs on
+    the token make gave it) or, if block is False, no token is free.
+    """
+    jobserver = parse(make_flags)[1]
+    if jobserver is None:
+        return None
+    fds = _open(jobserver)
+    if fds is None:
+        return None
+
+    if not block:
+        fd = os.open(_path(jobserver), os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            return os.read(fd, 1) or None
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+    return os.read(fds[0], 1) or None
+
+
+def release(token, make_flags=None):
+    if token is None:
+        return
+    _, wr = _open(parse(make_flags)[1])
+    os.write(wr, token)
+
+
+def _exitcode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _spawn(argv):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvp(argv[0], argv)
+        except OSError as e:
+            os.write(2, "{}: {}\n".format(argv[0], e.strerror).encode())
+        finally:
+            os._exit(127)
+    return pid
+
+
+class Job:
+    """A command started by start()."""
+
+    def __init__(self, pid, token, make_flags):
+        self.pid = pid
+        self.token = token
+        self.make_flags = make_flags
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            try:
+                _, status = os.waitpid(self.pid, 0)
+                self.returncode = _exitcode(status)
+            finally:
+                release(self.token, self.make_flags)
+                self.token = None
+        return self.returncode
+
+
+def start(argv, make_flags=None):
+    """Start argv in parallel if a token is free, otherwise run it now.
+
+    Without a free token (or without a jobserver) the command is run on the
+    caller's own token, so this returns once it has finished.
+    """
+    token = acquire(make_flags, block=False)
+    try:
+        job = Job(_spawn(argv), token, make_flags)
+    except BaseException:
+        release(token, make_flags)
+        raise
+    if token is None:
+        job.wait()
+    return job
+
+
+def run(argv, make_flags=None):
+    """Run argv while holding a token, waiting for one to be free.
+
+    Without a jobserver the command is just run. Returns the exit code.
+    """
+    token = acquire(make_flags)
+    try:
+        job = Job(_spawn(argv), token, make_flags)
+    except BaseException:
+        release(token, make_flags)
+        raise
+    return job.wait()
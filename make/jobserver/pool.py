@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""multiprocessing.Pool which only runs tasks while holding jobserver tokens.
+
+multiprocessing.Pool() starts os.cpu_count() workers whatever make's -j says.
+This Pool takes a token for every task it runs at once (the first runs on
+our own job slot, like make does) and gives it back once there is nothing
+more to run.
+
+    from make.jobserver import pool
+    with pool.Pool() as p:
+        results = p.map(work, items)
+
+Workers are started (up to `processes`) as tokens are taken for queued
+tasks, and parked when their token is given back until the pool takes
+another one. Without a jobserver the tasks are run one at a time, in the
+calling process.
+
+The pool's client must not be used by anything else while the pool runs.
+"""
+
+from collections import deque
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+
+from . import client as _client
+from . import utils
+
+
+RUN = "run"
+CLOSE = "close"
+TERMINATE = "terminate"
+
+
+def _worker(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        job, func, chunk = task
+        try:
+            result = (True, [func(*args, **kw) for args, kw in chunk])
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send((job, result))
+        except Exception as e:
+            # The result (or exception) couldn't be pickled.
+            conn.send((job, (False, RuntimeError(
+                "Error sending result: {!r}".format(e)))))
+    conn.close()
+
+
+def _own_client():
+    """JobServerClient using copies of the MAKEFLAGS jobserver fds, so
+    closing it doesn't take the jobserver away from the rest of the
+    process."""
+    flags = utils.parse_make_flags()
+    if not flags.jobserver_fds:
+        return _client.JobServerClient()
+
+    rd, wr = [os.dup(fd) for fd in flags.jobserver_fds]
+    try:
+        client = _client.JobServerClient(
+            utils.replace_jobserver(flags.make_flags, (rd, wr)))
+    except BaseException:
+        os.close(rd)
+        os.close(wr)
+        raise
+    if client.tokens_in.fileno() != rd:
+        # Reopened as it was non-blocking.
+        os.close(rd)
+    return client
+
+
+class AsyncResult:
+    """Result of apply_async (like multiprocessing.pool.AsyncResult)."""
+
+    def __init__(self, callback=None, error_callback=None):
+        self._callback = callback
+        self._error_callback = error_callback
+        self._event = threading.Event()
+        self._success = None
+        self._value = None
+
+    def _set(self, success, value):
+        self._success = success
+        self._value = value
+        if success and self._callback is not None:
+            self._callback(value)
+        if not success and self._error_callback is not None:
+            self._error_callback(value)
+        self._event.set()
+
+    def _set_chunk(self, index, success, values):
+        self._set(success, values[0] if success else values)
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        if not self.ready():
+            raise ValueError("{!r} not ready".format(self))
+        return self._success
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready():
+            raise multiprocessing.TimeoutError
+        if self._success:
+            return self._value
+        raise self._value
+
+
+class MapResult(AsyncResult):
+    """Result of map_async, set once every chunk is done."""
+
+    def __init__(self, chunks, callback=None, error_callback=None):
+        AsyncResult.__init__(self, callback, error_callback)
+        self._chunks = [None] * chunks
+        self._left = chunks
+        self._lock = threading.Lock()
+        if not chunks:
+            self._set(True, [])
+
+    def _set_chunk(self, index, success, values):
+        with self._lock:
+            if self.ready():
+                return
+            if not success:
+                self._set(False, values)
+                return
+            self._chunks[index] = values
+            self._left -= 1
+            if self._left:
+                return
+        self._set(True, [value for chunk in self._chunks for value in chunk])
+
+
+class _Worker:
+    def __init__(self, context, initializer, initargs):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker, args=(child_conn, initializer, initargs),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        # (result, chunk index) and token while running a task
+        self.task = None
+        self.token = None
+
+
+class Pool:
+    """Pool of worker processes sized by the jobserver.
+
+    processes - Most workers to run at once, defaults to make's -j (or the
+                number of CPUs).
+    client    - JobServerClient to take tokens from, by default one is
+                created for MAKEFLAGS.
+    context   - multiprocessing context to start workers with.
+    """
+
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 client=None, context=None):
+        if processes is None:
+            processes = utils.parse_make_flags().jobs or os.cpu_count()
+        if processes < 1:
+            raise ValueError("Number of processes must be at least 1")
+        self._processes = processes
+        self._initializer = initializer
+        self._initargs = initargs
+        self._context = context or multiprocessing.get_context()
+
+        self._own_client = False
+        if client is None and utils.has_jobserver():
+            try:
+                client = _own_client()
+                self._own_client = True
+            except (OSError, IOError):
+                # Make didn't pass the jobserver on to us.
+                client = None
+        self._client = client
+        self._state = RUN
+
+        # Without a jobserver the tasks are just run as they are submitted.
+        self.serial = client is None
+        if self.serial:
+            if initializer is not None:
+                initializer(*initargs)
+            return
+
+        self._lock = threading.Lock()
+        # (func, chunk, result, chunk index)
+        self._queue = deque()
+        self._next_job = 0
+        self._parked = []
+        self._running = {}
+        self._wake_rd, self._wake_wr = os.pipe()
+        self._thread = threading.Thread(
+            target=self._dispatch, name="jobserver.Pool", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<{} state={} processes={} serial={}>".format(
+            type(self).__name__, self._state, self._processes, self.serial)
+
+    # Dispatching, in the pool's thread.
+
+    def _wake(self):
+        os.write(self._wake_wr, b"x")
+
+    def _start_task(self, worker, task):
+        func, chunk, result, index = task
+        job = self._next_job
+        self._next_job += 1
+        worker.task = (result, index)
+        self._running[worker.conn] = worker
+        worker.conn.send((job, func, chunk))
+
+    def _start_tasks(self):
+        """Take tokens for queued tasks while they are free, returns if more
+        tokens are wanted."""
+        while True:
+            with self._lock:
+                if not self._queue or self._state == TERMINATE:
+                    return False
+                if len(self._running) >= self._processes:
+                    return False
+                token = self._client.get_token_nowait()
+                if token is None:
+                    return True
+                task = self._queue.popleft()
+
+            if self._parked:
+                worker = self._parked.pop()
+            else:
+                worker = _Worker(
+                    self._context, self._initializer, self._initargs)
+            worker.token = token
+            self._start_task(worker, task)
+
+    def _finished(self, worker):
+        del self._running[worker.conn]
+        try:
+            job, (success, value) = worker.conn.recv()
+        except (EOFError, OSError):
+            success = False
+            value = RuntimeError(
+                "Worker {} died".format(worker.process.pid))
+            worker.process.join()
+            worker.conn.close()
+            worker.conn = None
+
+        result, index = worker.task
+        worker.task = None
+        result._set_chunk(index, success, value)
+
+        with self._lock:
+            task = None
+            if self._queue and self._state != TERMINATE:
+                task = self._queue.popleft()
+        if task is not None and worker.conn is not None:
+            # Straight on to the next task, on the same token.
+            self._start_task(worker, task)
+            return
+
+        self._client.return_token(worker.token)
+        worker.token = None
+        if task is not None:
+            with self._lock:
+                self._queue.appendleft(task)
+        if worker.conn is not None:
+            self._parked.append(worker)
+
+    def _dispatch(self):
+        while True:
+            want_token = self._start_tasks()
+            with self._lock:
+                if self._state == TERMINATE:
+                    break
+                if self._state == CLOSE and not (
+                        self._queue or self._running):
+                    break
+
+            waiting = list(self._running) + [self._wake_rd]
+            if want_token:
+                waiting.append(self._client._nonblocking_fd())
+            for ready in multiprocessing.connection.wait(waiting):
+                if ready == self._wake_rd:
+                    os.read(self._wake_rd, 4096)
+                elif ready in self._running:
+                    self._finished(self._running[ready])
+
+        self._stop_workers()
+
+    def _stop_workers(self):
+        terminate = self._state == TERMINATE
+        for worker in list(self._running.values()) + self._parked:
+            if terminate:
+                worker.process.terminate()
+            else:
+                worker.conn.send(None)
+        for worker in list(self._running.values()) + self._parked:
+            worker.process.join()
+            worker.conn.close()
+            if worker.token is not None:
+                self._client.return_token(worker.token)
+            if worker.task is not None:
+                result, index = worker.task
+                result._set_chunk(index, False, RuntimeError(
+                    "Pool terminated"))
+        self._running = {}
+        self._parked = []
+        for task in self._queue:
+            task[2]._set_chunk(task[3], False, RuntimeError(
+                "Pool terminated"))
+        self._queue.clear()
+        if self._own_client:
+            self._client.cleanup()
+            self._client.tokens_in.close()
+            self._client.tokens_out.close()
+
+    # Submitting work.
+
+    def _submit(self, func, chunks, result):
+        if self._state != RUN:
+            raise ValueError("Pool not running")
+        if self.serial:
+            for index, chunk in enumerate(chunks):
+                try:
+                    values = [func(*args, **kw) for args, kw in chunk]
+                except Exception as e:
+                    result._set_chunk(index, False, e)
+                    break
+                result._set_chunk(index, True, values)
+            return result
+
+        with self._lock:
+            for index, chunk in enumerate(chunks):
+                self._queue.append((func, chunk, result, index))
+        self._wake()
+        return result
+
+    def _chunks(self, iterable, chunksize, star):
+        items = [(tuple(item) if star else (item,), {}) for item in iterable]
+        if chunksize is None:
+            chunksize, extra = divmod(len(items), self._processes * 4)
+            if extra:
+                chunksize += 1
+        chunksize = max(chunksize, 1)
+        return [items[i:i + chunksize]
+                for i in range(0, len(items), chunksize)]
+
+    def apply_async(self, func, args=(), kwds={}, callback=None,
+                    error_callback=None):
+        result = AsyncResult(callback, error_callback)
+        return self._submit(func, [[(tuple(args), dict(kwds))]], result)
+
+    def apply(self, func, args=(), kwds={}):
+        return self.apply_async(func, args, kwds).get()
+
+    def map_async(self, func, iterable, chunksize=None, callback=None,
+                  error_callback=None):
+        chunks = self._chunks(iterable, chunksize, False)
+        result = MapResult(len(chunks), callback, error_callback)
+        return self._submit(func, chunks, result)
+
+    def map(self, func, iterable, chunksize=None):
+        return self.map_async(func, iterable, chunksize).get()
+
+    def starmap_async(self, func, iterable, chunksize=None, callback=None,
+                      error_callback=None):
+        chunks = self._chunks(iterable, chunksize, True)
+        result = MapResult(len(chunks), callback, error_callback)
+        return self._submit(func, chunks, result)
+
+    def starmap(self, func, iterable, chunksize=None):
+        return self.starmap_async(func, iterable, chunksize).get()
+
+    # The work is submitted straight away, only the results are iterated.
+
+    def imap(self, func, iterable, chunksize=1):
+        results = [self._submit(func, [chunk], MapResult(1))
+                   for chunk in self._chunks(iterable, chunksize, False)]
+
+        def iterate():
+            for result in results:
+                for value in result.get():
+                    yield value
+        return iterate()
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        done = queue.Queue()
+        chunks = self._chunks(iterable, chunksize, False)
+        for chunk in chunks:
+            result = MapResult(
+                1, lambda values: done.put((True, values)),
+                lambda e: done.put((False, e)))
+            self._submit(func, [chunk], result)
+
+        def iterate():
+            for i in range(len(chunks)):
+                success, values = done.get()
+                if not success:
+                    raise values
+                for value in values:
+                    yield value
+        return iterate()
+
+    # Shutting down.
+
+    def close(self):
+        if self._state == RUN:
+            self._state = CLOSE
+            if not self.serial:
+                self._wake()
+
+    def terminate(self):
+        self._state = TERMINATE
+        if not self.serial:
+            self._wake()
+            self.join()
+
+    def join(self):
+        if self._state == RUN:
+            raise ValueError("Pool is still running")
+        if self.serial:
+            return
+        self._thread.join()
+        if self._wake_rd is not None:
+            os.close(self._wake_rd)
+            os.close(self._wake_wr)
+            self._wake_rd = self._wake_wr = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
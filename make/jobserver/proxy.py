@@ -1,13 +1,55 @@
 #!/usr/bin/env python3
 
+import os
+
 from . import server
 
 
 class JobServerProxy(server.JobServer):
-    def __init__(self, client):
+    """Serve the tokens of an existing jobserver to our own children.
+
+    passthrough - Give children the client's jobserver pipes directly, rather
+                  than relaying every token through our own pipes. Tokens the
+                  children leak aren't recovered when they exit, so this only
+                  makes sense below a proxy which isn't passing through.
+    """
+
+    STATUS_KIND = "proxy"
+
+    def __init__(self, client, passthrough=False, status=None):
         self.client = client
+        self.passthrough = passthrough
         self.token2bytes = {}
-        server.JobServer.__init__(self, 0)
+        # cid -> pass_fds of children using the client's pipes
+        self.passthrough_clients = {}
+        self.exited = 0
+        server.JobServer.__init__(self, 0, status=status)
+
+    def _status_upstream(self):
+        return getattr(self.client, "tokens_in", None)
+
+    def create_client(self, callback=None):
+        if not self.passthrough:
+            return server.JobServer.create_client(self, callback)
+
+        cid = -1 - len(self.passthrough_clients)
+        while cid in self.passthrough_clients:
+            cid -= 1
+        pass_fds = self.pass_fds(
+            os.dup(self.client.tokens_in.fileno()),
+            os.dup(self.client.tokens_out.fileno()))
+        self.passthrough_clients[cid] = pass_fds
+        return cid, pass_fds
+
+    def cleanup_client(self, cid, allow_tokens=False, log=lambda msg: None):
+        if cid not in self.passthrough_clients:
+            return server.JobServer.cleanup_client(
+                self, cid, allow_tokens, log)
+
+        # Nothing was relayed, all there is to do is note the child exited.
+        log("Passed through client {} exited".format(cid))
+        del self.passthrough_clients[cid]
+        self.exited += 1
 
     def _grow_tokens(self):
         tokenbyte = self.client.get_token()
@@ -26,16 +68,21 @@ class JobServerProxy(server.JobServer):
         self._tokens.append(tid)
         self._log("_grow_tokens {} {} {}".format(
             repr(tokenbyte), tid, self._tokens))
+        self._publish()
 
     def _shrink_tokens(self):
         tokens = list(self._tokens)
         for tid in tokens:
+            if tid in self._loans:
+                # Lent by one of our clients, not from upstream.
+                continue
             tokenbyte = self.token2bytes[tid]
             del self.token2bytes[tid]
             self.client.return_token(tokenbyte)
             self._tokens.remove(tid)
             self._log("_shrink_tokens {} {} {}".format(
                 repr(tokenbyte), tid, self._tokens))
+        self._publish()
 
     def _get_next_token(self):
         if len(self._tokens) == 0:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""pytest plugin keeping pytest-xdist within make's jobserver.
+
+Installed as a pytest11 entry point. Outside make it does nothing.
+
+ * `pytest -n auto` run by make starts one worker per job slot make allows
+   (its -j, never more than the CPUs) rather than one per CPU, and runs the
+   tests serially when make has no jobserver.
+ * Each test only runs while its worker holds a token, the first worker
+   runs on pytest's own job slot (pytest itself just waits on the workers).
+
+xdist starts its workers with every other file descriptor closed, so workers
+reopen make 4.3's jobserver pipe through the /proc entry of the pytest
+process.
+"""
+
+import os
+
+import pytest
+
+from . import lite
+from . import utils
+
+
+# pid of the pytest process the workers were started by.
+CONTROLLER_ENV = "MAKE_JOBSERVER_XDIST_PID"
+
+_worker = None
+
+
+def _under_make():
+    return "MAKELEVEL" in os.environ
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config):
+    if not _under_make():
+        return None
+    flags = utils.parse_make_flags()
+    if not flags.has_jobserver:
+        return 0
+    return min(flags.jobs or os.cpu_count(), os.cpu_count())
+
+
+def _reopen_jobserver(pid):
+    """Give a worker the jobserver pipe of the pytest process pid."""
+    flags = utils.parse_make_flags()
+    if not flags.jobserver_fds:
+        # A fifo jobserver only needs MAKEFLAGS.
+        return
+    rd, wr = flags.jobserver_fds
+    path = "/proc/{}/fd/{}".format(pid, rd)
+    try:
+        ino = os.stat(path).st_ino
+    except OSError:
+        # Not passed on to pytest either.
+        return
+    try:
+        if os.fstat(rd).st_ino == ino:
+            # We were given the pipe after all.
+            return
+    except OSError:
+        pass
+    # The fd numbers may well be in use for something else by now.
+    rd = os.open(path, os.O_RDONLY)
+    wr = os.open("/proc/{}/fd/{}".format(pid, wr), os.O_WRONLY)
+    os.environ["MAKEFLAGS"] = utils.replace_jobserver(
+        flags.make_flags, (rd, wr))
+
+
+def pytest_configure(config):
+    global _worker
+    if not _under_make() or not utils.has_jobserver():
+        return
+
+    _worker = os.environ.get("PYTEST_XDIST_WORKER", None)
+    if _worker is None:
+        # The controller (or a run without xdist).
+        os.environ[CONTROLLER_ENV] = str(os.getpid())
+        return
+    if CONTROLLER_ENV in os.environ:
+        _reopen_jobserver(int(os.environ[CONTROLLER_ENV]))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    token = None
+    if _worker not in (None, "gw0"):
+        token = lite.acquire()
+    try:
+        yield
+    finally:
+        lite.release(token)
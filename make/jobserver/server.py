@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+from collections import deque
 from collections import namedtuple
 
+import errno
 import os
 import select
 import signal
+import time
 
 if not hasattr(os, "cpu_count"):
     import multiprocessing
@@ -12,6 +15,7 @@ if not hasattr(os, "cpu_count"):
     os.cpu_count = multiprocessing.cpu_count
 
 from . import _support
+from . import status as _status
 
 try:
     BrokenPipeError
@@ -21,16 +25,39 @@ except NameError:
 
 class JobServer:
 
+    STATUS_KIND = "server"
+
     pass_fds = namedtuple("pass_fds", ["p2c_rd", "c2p_wr"])
     keep_fileobjs = namedtuple(
         "keep_fileobjs",
         ["c2p_rd_fileobj", "p2c_wr_fileobj", "p2c_rd_fileobj"]
     )
 
-    def __init__(self, num_tokens=None):
+    def __init__(self, num_tokens=None, recycle_clients=False, max_fds=None,
+                 status=None):
+        """
+        recycle_clients = Keep the pipes of cleaned up clients (once they are
+                          verified empty) and reuse them for new clients.
+        max_fds         = Budget for the file descriptors used by clients,
+                          once reached create_client requests are queued.
+        status          = Publish a status record for jobtop (see status.py),
+                          defaults to on if MAKE_JOBSERVER_STATUS is set.
+
+        Recycling is only safe when every process which was given a client's
+        file descriptors has exited before cleanup_client is called.
+        """
         if num_tokens is None:
             num_tokens = os.cpu_count()
 
+        self.recycle_clients = recycle_clients
+        self.max_fds = max_fds
+        # Our own copy of c2p_wr for clients which will be recycled.
+        self.cid2c2p_wr = {}
+        # Cleaned up clients ready for reuse, (cid, keep_fileobjs).
+        self._free_clients = []
+        # Callbacks waiting for the fd budget.
+        self._queued_clients = deque()
+
         self._tokens = [i for i in range(num_tokens)]
 
         self.poller = _support.Poller()
@@ -42,20 +69,186 @@ class JobServer:
         self.cid2tokens = {}
         self.token2cid = {}
 
+        # cid -> number of extra tokens the client is charged (see charge())
+        self.cid2charge = {}
+        # cid -> tokens held back for its charge
+        self.cid2charged = {}
+        # cid -> [token seconds, time of last change]
+        self.cid2usage = {}
+
+        # Job slots lent to us by clients (see JobServerClient.yield_token),
+        # negative token ids.
+        self._loans = set()
+        # cid -> number of job slots the client has lent us
+        self.cid2lent = {}
+        # Loans of cleaned up clients, dropped as they are given back.
+        self._dropped_loans = set()
+        # Tokens given back by clients which didn't have them (dropped).
+        self.over_returned = 0
+
         # Pipe to get signals on
         sig_rd, sig_wr = os.pipe()
         _support.set_nonblocking(sig_rd)
         _support.set_nonblocking(sig_wr)
         signal.set_wakeup_fd(sig_wr)
+        self._sig_wr = sig_wr
         self.signals = os.fdopen(sig_rd, "rb", buffering=0)
         self.fileobj2cid[self.signals] = "signal"
 
         self.poller.register(self.signals, select.EPOLLHUP | select.EPOLLIN)
 
+        self._clear_logger()
+
+        # Clients which wanted a token when none were free.
+        self._waiting = set()
+        if status is None:
+            status = _status.enabled()
+        self.status = None
+        if status:
+            self.status = _status.StatusBoard(
+                self.STATUS_KIND, _status.default_name(),
+                self._status_upstream())
+            self._publish()
+
     def _clear_logger(self):
         self._log = lambda msg: None
 
+    def _status_upstream(self):
+        """The jobserver pipe (or fd) we get our tokens from, if any."""
+        return None
+
+    def _publish(self, cid=None):
+        if self.status is None:
+            return
+        held = len(self.cid2tokens[cid]) if cid is not None else 0
+        self.status.tokens(
+            len(self._tokens) + len(self.token2cid), len(self._tokens),
+            len(self.token2cid), len(self._queued_clients),
+            len(self._waiting), cid, held, cid in self._waiting)
+
+    def describe_client(self, cid, pid=0, name=""):
+        """Record the process using client cid, for jobtop."""
+        if self.status is not None:
+            self.status.describe_client(cid, pid, name)
+
+    def _account(self, cid):
+        """Add up the time tokens were held by client cid."""
+        usage = self.cid2usage[cid]
+        now = time.monotonic()
+        usage[0] += len(self.cid2tokens[cid]) * (now - usage[1])
+        usage[1] = now
+
+    def token_seconds(self, cid):
+        """Total time tokens have been held by client cid, in seconds.
+
+        Includes the time tokens sat in the client's pipe before being taken.
+        """
+        self._account(cid)
+        return self.cid2usage[cid][0]
+
+    def charge(self, cid, weight):
+        """Charge client cid for weight job slots, not just the one it runs on.
+
+        weight - 1 tokens are held back (as they become free) for as long as
+        the client exists, before it is given any tokens of its own. For a
+        child which keeps more than one core busy without asking for tokens,
+        weight should be less than the number of tokens.
+        """
+        if cid not in self.cid2tokens:
+            return
+        self.cid2charge[cid] = max(weight - 1, 0)
+        self.cid2charged.setdefault(cid, [])
+        self._collect_charge(cid)
+
+    def _collect_charge(self, cid):
+        """Hold back tokens for client cid's charge, returns if it's paid."""
+        charged = self.cid2charged.get(cid, None)
+        if charged is None:
+            return True
+        while len(charged) < self.cid2charge[cid]:
+            token = self._get_next_token()
+            if token is None:
+                return False
+            self._tokens.remove(token)
+            self.token2cid[token] = cid
+            charged.append(token)
+            self._log("Child {} charged token {}".format(cid, token))
+            self._publish(cid)
+        return True
+
+    def _release_charge(self, cid):
+        self.cid2charge.pop(cid, None)
+        for token in self.cid2charged.pop(cid, []):
+            del self.token2cid[token]
+            self._put_back(token)
+        self._publish()
+
+    def _put_back(self, token):
+        """Make token free again, unless it's a loan which was dropped."""
+        if token in self._dropped_loans:
+            self._dropped_loans.remove(token)
+            self._loans.remove(token)
+        else:
+            self._tokens.append(token)
+
+    def _lend(self, cid):
+        """Client cid gave back a token it wasn't holding, its own job slot."""
+        loan = -1
+        while loan in self._loans:
+            loan -= 1
+        self._loans.add(loan)
+        self._tokens.append(loan)
+        self.cid2lent[cid] = self.cid2lent.get(cid, 0) + 1
+        self._log("Child {} lent a job slot ({})".format(cid, loan))
+        self._publish(cid)
+
+    def _retire(self, token):
+        """Take token out of circulation in place of a loan."""
+        if token in self._loans:
+            self._loans.remove(token)
+            return
+        loan = min(self._loans - self._dropped_loans)
+        self._loans.remove(loan)
+        # The loan's holder (or the free pool) gets token in its place, it
+        # can also be held back for a charge.
+        if loan in self._tokens:
+            self._tokens[self._tokens.index(loan)] = token
+            return
+        holder = self.token2cid.pop(loan)
+        self.token2cid[token] = holder
+        held = self.cid2tokens[holder]
+        if loan not in held:
+            held = self.cid2charged[holder]
+        held[held.index(loan)] = token
+
+    def _repay(self, cid, token):
+        """Client cid took back its lent job slot, token goes with it."""
+        self._tokens.remove(token)
+        self.cid2lent[cid] -= 1
+        if not self.cid2lent[cid]:
+            del self.cid2lent[cid]
+        self._retire(token)
+        self._waiting.discard(cid)
+        self._log("Child {} took back its job slot ({})".format(cid, token))
+        self._publish(cid)
+
+    def _drop_loans(self, cid):
+        """Client cid has gone without taking back its lent job slots."""
+        for i in range(self.cid2lent.pop(cid, 0)):
+            free = [t for t in self._tokens if t in self._loans]
+            if free:
+                self._tokens.remove(free[0])
+                self._loans.remove(free[0])
+            else:
+                self._dropped_loans.add(
+                    min(self._loans - self._dropped_loans))
+        self._publish()
+
     def _assign_token(self, cid, token):
+        if self.cid2lent.get(cid, 0):
+            self._repay(cid, token)
+            return
+
         self._log(
             "Child {} getting token {} (assigned: {}, available: {})".format(
                 cid, token, self.cid2tokens[cid], self._tokens
@@ -63,6 +256,7 @@ class JobServer:
         )
         assert token not in self.token2cid, (token, self.token2cid)
         self.token2cid[token] = cid
+        self._account(cid)
 
         assert cid in self.cid2tokens, (cid, self.cid2tokens)
         assert token not in self.cid2tokens[cid], (token, self.cid2tokens[cid])
@@ -70,9 +264,19 @@ class JobServer:
 
         assert token in self._tokens, (token, self._tokens)
         self._tokens.remove(token)
+        self._waiting.discard(cid)
+        self._publish(cid)
 
     def _unassign_token(self, cid):
-        assert len(self.cid2tokens) > 0, self.cid2tokens[cid]
+        if not self.cid2tokens[cid]:
+            # A client holding nothing can only lend its own job slot, once.
+            if not self.cid2lent.get(cid, 0):
+                self._lend(cid)
+                return
+            self.over_returned += 1
+            self._log("Child {} returned a token it didn't have".format(cid))
+            self._publish(cid)
+            return
         token = self.cid2tokens[cid][0]
 
         self._log(
@@ -84,13 +288,15 @@ class JobServer:
             token, self.token2cid[token], cid
         )
         del self.token2cid[token]
+        self._account(cid)
 
         assert cid in self.cid2tokens, (cid, self.cid2tokens)
         assert token in self.cid2tokens[cid], (token, self.cid2tokens[cid])
         self.cid2tokens[cid].remove(token)
 
         assert token not in self._tokens
-        self._tokens.append(token)
+        self._put_back(token)
+        self._publish(cid)
 
     def _add_client(self, cid, keep_fileobjs):
         """
@@ -113,6 +319,8 @@ class JobServer:
         )
 
         self.cid2tokens[cid] = []
+        self.cid2usage[cid] = [0.0, time.monotonic()]
+        self._status_add_client(cid)
 
     def _del_client(self, cid):
         assert cid in self.cid2tokens
@@ -121,9 +329,25 @@ class JobServer:
         in_fileobj, out_fileobj, client_fileobj = self.cid2fileobjs[cid]
         self.poller.unregister(in_fileobj)
         self.poller.unregister(out_fileobj)
+        del self.fileobj2cid[in_fileobj]
+        del self.fileobj2cid[out_fileobj]
 
         del self.cid2tokens[cid]
         del self.cid2fileobjs[cid]
+        del self.cid2usage[cid]
+        self._status_del_client(cid)
+
+    def _status_add_client(self, cid):
+        if self.status is not None:
+            self.status.add_client(cid, _status.pipe_ino(
+                self.cid2fileobjs[cid].p2c_wr_fileobj))
+            self._publish(cid)
+
+    def _status_del_client(self, cid):
+        self._waiting.discard(cid)
+        if self.status is not None:
+            self.status.remove_client(cid)
+            self._publish()
 
     def _get_next_token(self):
         if len(self._tokens) == 0:
@@ -131,11 +355,135 @@ class JobServer:
         else:
             return self._tokens[0]
 
+    def _client_may_take(self, cid):
+        """Should a free token be handed to client cid?"""
+        return True
+
+    def _handle_event(self, cid, fileobj, events):
+        """Handle events on a registered fileobj which isn't a client."""
+        raise AssertionError("Unexpected event {} on {} ({})".format(
+            events, fileobj, cid))
+
+    def _token_returned(self, cid, fileobj):
+        """Child is returning a token.."""
+        tokenbyte = fileobj.read(1)
+        assert len(tokenbyte) == 1, repr(tokenbyte)
+        self._log(
+            "Child {} return token ({})".format(
+                cid, repr(tokenbyte)
+            )
+        )
+        self._unassign_token(cid)
+
+    def _offer_token(self, cid, fileobj):
+        """Hand out a token to the child if it has none pending.
+
+        Returns True if a token was written to the child's pipe.
+        """
+        out = _support.output_waiting(fileobj)
+        if out > 0:
+            self._log("Child {} already has pending tokens".format(cid))
+            return False
+
+        if not self._client_may_take(cid):
+            self._log("Child {} is at its limit".format(cid))
+            return False
+
+        token = None
+        if self._collect_charge(cid):
+            token = self._get_next_token()
+        if token is None:
+            self._log("Unable to get token for {}".format(cid))
+            if cid not in self._waiting:
+                self._waiting.add(cid)
+                self._publish(cid)
+            return False
+        self._assign_token(cid, token)
+        self._log("Child {} given token {}".format(cid, token))
+        try:
+            fileobj.write(b"+")
+        except BrokenPipeError:
+            return False
+        return True
+
+    def _offer_order(self, offer):
+        # A client which lent its job slot has an empty pipe while it is
+        # blocked, it only gets priority once it's waiting to take it back.
+        cid = offer[0]
+        lent = cid in self.cid2lent
+        if cid in self._waiting:
+            return 0 if lent else 1
+        return 3 if lent else 2
+
     def tokens(self, cid):
         assert cid in self.cid2tokens
         return list(self.cid2tokens[cid])
 
-    def create_client(self):
+    def _client_fds(self):
+        """Number of file descriptors currently held for clients."""
+        clients = len(self.cid2fileobjs) + len(self._free_clients)
+        return clients * len(self.keep_fileobjs._fields) + len(self.cid2c2p_wr)
+
+    def _reuse_client(self):
+        cid, keep_objs = self._free_clients.pop()
+        c2p_rd_fileobj, p2c_wr_fileobj, p2c_rd_fileobj = keep_objs
+
+        self.cid2fileobjs[cid] = keep_objs
+        self.cid2tokens[cid] = []
+        self.cid2usage[cid] = [0.0, time.monotonic()]
+        self.poller.modify(c2p_rd_fileobj, select.EPOLLHUP | select.EPOLLIN)
+        self.poller.modify(p2c_wr_fileobj, select.EPOLLHUP | select.EPOLLOUT)
+
+        self._status_add_client(cid)
+
+        pass_fds = self.pass_fds(
+            os.dup(p2c_rd_fileobj.fileno()), os.dup(self.cid2c2p_wr[cid]))
+        return cid, pass_fds
+
+    def _park_client(self, cid):
+        """Keep a cleaned up client's pipes (and registrations) for reuse."""
+        keep_objs = self.cid2fileobjs.pop(cid)
+        del self.cid2tokens[cid]
+        del self.cid2usage[cid]
+        self.poller.modify(keep_objs.c2p_rd_fileobj, 0)
+        self.poller.modify(keep_objs.p2c_wr_fileobj, 0)
+        self._free_clients.append((cid, keep_objs))
+        self._status_del_client(cid)
+
+    def _close_free_clients(self):
+        while self._free_clients:
+            cid, keep_objs = self._free_clients.pop()
+            self.cid2fileobjs[cid] = keep_objs
+            self.cid2tokens[cid] = []
+            self.cid2usage[cid] = [0.0, time.monotonic()]
+            self._del_client(cid)
+            for fileobj in keep_objs:
+                fileobj.close()
+            os.close(self.cid2c2p_wr.pop(cid))
+
+    def create_client(self, callback=None):
+        """Create a new client, returns (cid, pass_fds).
+
+        If the max_fds budget has been reached and a callback is given, the
+        request is queued and (None, None) returned. callback(cid, pass_fds)
+        is called once an existing client has been cleaned up.
+        """
+        if self._free_clients:
+            return self._reuse_client()
+
+        if self.max_fds is not None:
+            # Our fds, our copy of c2p_wr and the two fds to pass on.
+            needed = len(self.keep_fileobjs._fields) + 2
+            needed += int(self.recycle_clients)
+            if self._client_fds() + needed > self.max_fds:
+                if callback is None:
+                    raise OSError(
+                        errno.EMFILE,
+                        "Jobserver fd budget ({}) used up".format(
+                            self.max_fds))
+                self._queued_clients.append(callback)
+                return None, None
+
         c2p_rd, c2p_wr = os.pipe()
         p2c_rd, p2c_wr = os.pipe()
 
@@ -149,6 +497,12 @@ class JobServer:
         # tokens in the pipe.
         p2c_rd_fileobj = os.fdopen(os.dup(p2c_rd), mode="rb", buffering=0)
 
+        if self.recycle_clients:
+            # The child's end never gets closed, so draining the pipe must
+            # not block.
+            self.cid2c2p_wr[cid] = os.dup(c2p_wr)
+            _support.set_nonblocking(c2p_rd_fileobj)
+
         keep_objs = self.keep_fileobjs(
             c2p_rd_fileobj, p2c_wr_fileobj, p2c_rd_fileobj
         )
@@ -158,6 +512,20 @@ class JobServer:
 
         return cid, pass_fds
 
+    def _create_queued_clients(self):
+        while self._queued_clients:
+            callback = self._queued_clients.popleft()
+            try:
+                cid, pass_fds = self.create_client(callback)
+            except BaseException:
+                self._queued_clients.appendleft(callback)
+                raise
+            if cid is None:
+                # Still no room, it has gone to the back of the queue.
+                self._queued_clients.rotate(1)
+                break
+            callback(cid, pass_fds)
+
     def cleanup_client(self, cid, allow_tokens=False, log=lambda msg: None):
         self._log = log
 
@@ -166,10 +534,14 @@ class JobServer:
         assert cid in self.cid2fileobjs
 
         in_fileobj, out_fileobj, client_fileobj = self.cid2fileobjs[cid]
+        recycle = cid in self.cid2c2p_wr
 
         # Get any tokens that might be pending on the returning token pathway.
         while True:
             tokenbytes = in_fileobj.read()
+            if tokenbytes is None:
+                # Non-blocking and the child side is still open somewhere.
+                tokenbytes = b""
             self._log("Input tokenbytes to return {} {}".format(
                 repr(tokenbytes), self.cid2tokens[cid]))
             if len(tokenbytes) > 0:
@@ -177,16 +549,23 @@ class JobServer:
                     self._unassign_token(cid)
                 continue
             assert tokenbytes == b"", repr(tokenbytes)
-            in_fileobj.close()
+            if not recycle:
+                in_fileobj.close()
             break
 
         # Open the read side of the pipe and read back anything still left in
         # it.
         out = _support.output_waiting(out_fileobj)
-        out_fileobj.close()
+        if not recycle:
+            out_fileobj.close()
 
         while out > 0:
-            tokenbytes = client_fileobj.read()
+            if recycle:
+                # Our end is still open, so only read what is there.
+                tokenbytes = client_fileobj.read(out)
+                out -= len(tokenbytes)
+            else:
+                tokenbytes = client_fileobj.read()
             self._log("Output tokenbytes to return {} {}".format(
                 repr(tokenbytes), self.cid2tokens[cid]))
             if len(tokenbytes) > 0:
@@ -197,7 +576,8 @@ class JobServer:
             assert tokenbytes == b"", repr(tokenbytes)
             break
 
-        client_fileobj.close()
+        if not recycle:
+            client_fileobj.close()
 
         # There should be no tokens currently left now (unless the client
         # forgot to return them...)
@@ -206,16 +586,52 @@ class JobServer:
             os.getpid(), cid, current_tokens)
         while current_tokens:
             self._unassign_token(cid)
+        self._release_charge(cid)
+        self._drop_loans(cid)
+
+        waiting = 0
+        if recycle:
+            waiting = _support.output_waiting(in_fileobj)
+            waiting += _support.output_waiting(out_fileobj)
+        if waiting:
+            # Something is still writing to the pipes, don't reuse them.
+            self._log("Not recycling {}, pipes aren't empty".format(cid))
+            for fileobj in (in_fileobj, out_fileobj, client_fileobj):
+                fileobj.close()
+            os.close(self.cid2c2p_wr.pop(cid))
+            recycle = False
+
+        if recycle:
+            self._park_client(cid)
+        else:
+            self._del_client(cid)
 
-        self._del_client(cid)
+        self._create_queued_clients()
 
         self._clear_logger()
 
     def cleanup(self, allow_tokens=True, log=lambda msg: None):
         for cid in list(self.cid2tokens):
             self.cleanup_client(cid, allow_tokens, log)
+        self._close_free_clients()
         assert len(self.cid2tokens) == 0, self.cid2tokens
 
+    def close(self, log=lambda msg: None):
+        """Clean up all the clients and release the server's own fds."""
+        self.cleanup(allow_tokens=True, log=log)
+        wakeup_fd = signal.set_wakeup_fd(-1)
+        if wakeup_fd != self._sig_wr:
+            # Someone else has taken over the wakeup fd since.
+            signal.set_wakeup_fd(wakeup_fd)
+        self.poller.unregister(self.signals)
+        del self.fileobj2cid[self.signals]
+        self.signals.close()
+        os.close(self._sig_wr)
+        self.poller.close()
+        if self.status is not None:
+            self.status.close()
+            self.status = None
+
     @staticmethod
     def flags(pass_fds):
         assert isinstance(pass_fds.p2c_rd, int)
@@ -227,7 +643,10 @@ class JobServer:
     def poll(self, log=lambda msg: None, timeout=None):
         self._log = log
 
-        for fileobj, events in self.poller.poll():
+        if timeout is None:
+            timeout = -1
+        offers = []
+        for fileobj, events in self.poller.poll(timeout):
             cid = self.fileobj2cid[fileobj]
             self._log(
                 "cid:{} events:{}".format(cid, events)
@@ -237,38 +656,22 @@ class JobServer:
                 sig = fileobj.read(1)
                 self._log("Signal {} {}".format(events, sig))
 
+            elif cid not in self.cid2fileobjs:
+                self._handle_event(cid, fileobj, events)
+
             else:
                 if "EPOLLIN" in events:
-                    # Child is returning a token..
-                    tokenbyte = fileobj.read(1)
-                    assert len(tokenbyte) == 1, repr(tokenbyte)
-                    self._log(
-                        "Child {} return token ({})".format(
-                            cid, repr(tokenbyte)
-                        )
-                    )
-                    self._unassign_token(cid)
+                    self._token_returned(cid, fileobj)
 
                 if "EPOLLOUT" in events:
-                    out = _support.output_waiting(fileobj)
-                    # Hand out a token?
-                    if out > 0:
-                        self._log(
-                            "Child already has pending tokens".format(
-                                cid, out
-                            )
-                        )
-                        continue
-
-                    token = self._get_next_token()
-                    if token is None:
-                        self._log("Unable to get token for {}".format(cid))
-                        continue
-                    self._assign_token(cid, token)
-                    self._log("Child {} given token {}".format(cid, token))
-                    try:
-                        fileobj.write(b"+")
-                    except BrokenPipeError:
-                        continue
+                    offers.append((cid, fileobj))
+
+        # Hand out tokens once all the returned ones are back, so a token
+        # returned in this poll can go straight back out. Clients which have
+        # been waiting go first.
+        offers.sort(key=self._offer_order)
+        for cid, fileobj in offers:
+            if cid in self.cid2fileobjs:
+                self._offer_token(cid, fileobj)
 
         self._clear_logger()
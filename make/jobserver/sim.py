@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""Deterministic jobserver simulator.
+
+Runs the real JobServer / JobServerProxy token logic (over real pipes, in
+process) against virtual make processes and a virtual clock, so scheduling
+and retention policies can be compared without running real builds.
+
+    python -m make.jobserver.sim [--proxy] [-j 1,2,4,8] graph.json ...
+    python -m make.jobserver.sim [--proxy] [-j 1,2,4,8] --synthetic SEED
+
+A job graph is a tree of jobs. A job with sub-jobs is a recursive make, the
+others are commands which run for `duration` seconds while holding `weight`
+tokens. `after` lists the names of jobs (run by the same make) which must
+finish first. As JSON;
+
+    {"name": "all", "jobs": [
+        {"name": "gen", "duration": 2.0},
+        {"name": "lib", "after": ["gen"], "jobs": [
+            {"name": "a.o", "duration": 1.5},
+            {"name": "b.o", "duration": 0.5, "weight": 2}
+        ]}
+    ]}
+
+Like make, each virtual make runs one job on the token it was started with
+and needs a token from the jobserver for every other job. A job with a
+weight above one waits until its make has collected all of its tokens (never
+more than the number of job slots). As with real tools which wait for extra
+tokens this can deadlock, which is reported in the results.
+"""
+
+from collections import namedtuple
+
+import json
+import os
+import random
+import sys
+
+from . import _support
+from . import proxy
+from . import server
+
+
+Job = namedtuple("Job", ["name", "duration", "weight", "jobs", "after"])
+
+
+def job(name, duration=0.0, weight=1, jobs=(), after=()):
+    return Job(name, duration, weight, tuple(jobs), tuple(after))
+
+
+def load(data):
+    """Create a job graph from its JSON form (a dict or a filename)."""
+    if not isinstance(data, dict):
+        with open(data) as f:
+            data = json.load(f)
+    return job(
+        data.get("name", ""),
+        duration=float(data.get("duration", 0.0)),
+        weight=int(data.get("weight", 1)),
+        jobs=[load(j) for j in data.get("jobs", [])],
+        after=data.get("after", []),
+    )
+
+
+def synthetic(seed=0, width=8, depth=2, duration=(0.1, 2.0), weight=(1, 1),
+              deps=0.2, name="all"):
+    """Create a random (but repeatable) job graph.
+
+    Each make has `width` jobs, one of which is a sub-make until `depth` is
+    reached. Each job depends on an earlier job with probability `deps`.
+    """
+    rand = random.Random(seed)
+
+    def make(name, depth):
+        jobs = []
+        submake = rand.randrange(width) if depth > 1 else None
+        for i in range(width):
+            jobname = "{}/{}".format(name, i)
+            after = ()
+            if jobs and rand.random() < deps:
+                after = (rand.choice(jobs).name,)
+            if i == submake:
+                jobs.append(make(jobname, depth - 1)._replace(after=after))
+            else:
+                jobs.append(job(
+                    jobname,
+                    duration=round(rand.uniform(*duration), 3),
+                    weight=rand.randint(*weight),
+                    after=after))
+        return job(name, jobs=jobs)
+
+    return make(name, depth)
+
+
+class _VirtualClient:
+    """Client end of a jobserver pipe pair, driven in process.
+
+    Like JobServerClient (including the free token) but never blocks.
+    """
+
+    def __init__(self, p2c_rd, c2p_wr):
+        self.tokens_in = p2c_rd
+        self.tokens_out = c2p_wr
+        self.tokens = []
+
+    def get_token(self):
+        if b"" not in self.tokens:
+            token = b""
+        else:
+            try:
+                token = os.read(self.tokens_in, 1)
+            except BlockingIOError:
+                return None
+            assert len(token) == 1, token
+        self.tokens.append(token)
+        return token
+
+    def return_token(self, token):
+        if token != b"":
+            os.write(self.tokens_out, token)
+        self.tokens.remove(token)
+
+    def cleanup(self):
+        while self.tokens:
+            self.return_token(self.tokens[0])
+
+
+class _Make:
+    """A virtual make process running the jobs of a sub-make."""
+
+    def __init__(self, sim, job, client, parent=None, jobproxy=None):
+        self.sim = sim
+        self.job = job
+        self.client = client
+        self.parent = parent
+        self.jobproxy = jobproxy
+
+        self.waiting = list(job.jobs)
+        self.finished = set()
+        self.running = 0
+        # Tokens collected for the job at the head of the queue.
+        self.collected = []
+        self.ready_since = {}
+        self._update_ready()
+
+    @property
+    def done(self):
+        return not self.waiting and self.running == 0
+
+    def _update_ready(self):
+        for j in self.waiting:
+            if j.name in self.ready_since:
+                continue
+            if all(a in self.finished for a in j.after):
+                self.ready_since[j.name] = self.sim.now
+
+    def ready(self):
+        return [j for j in self.waiting if j.name in self.ready_since]
+
+    def step(self):
+        """Start as many jobs as there are tokens for, returns if anything
+        changed."""
+        changed = False
+        for j in self.ready():
+            while len(self.collected) < self.sim.weight(j):
+                token = self.client.get_token()
+                if token is None:
+                    return changed
+                self.collected.append(token)
+                changed = True
+
+            self.waiting.remove(j)
+            self.running += 1
+            tokens, self.collected = self.collected, []
+            self.sim._start(self, j, tokens, self.ready_since.pop(j.name))
+        return changed
+
+    def finish(self, j, tokens):
+        self.running -= 1
+        self.finished.add(j.name)
+        for token in tokens:
+            self.client.return_token(token)
+        self._update_ready()
+
+
+class Simulation:
+    """Simulate running graph with `jobs` job slots (like make -j jobs).
+
+    proxy        - Run every sub-make under a proxy (like `python -m
+                   make.jobserver proxy -- $(MAKE)`) rather than passing the
+                   jobserver straight through.
+    server_class - JobServer (sub)class serving the top level tokens.
+    proxy_class  - JobServerProxy (sub)class used when proxy is True.
+    """
+
+    def __init__(self, graph, jobs, proxy=False,
+                 server_class=server.JobServer,
+                 proxy_class=proxy.JobServerProxy):
+        self.graph = graph
+        self.jobs = jobs
+        self.proxy = proxy
+        self.server_class = server_class
+        self.proxy_class = proxy_class
+
+        self.now = 0.0
+        self.servers = []
+        self.makes = []
+        # List of (end time, sequence, make, job, tokens)
+        self.events = []
+        self._seq = 0
+        # jobserver -> fds of the clients created on it
+        self._fds = {}
+
+        self.busy = 0
+        self.peak = 0
+        self.busy_time = 0.0
+        self.starved_time = 0.0
+        self.waits = []
+
+    def _client(self, jobserver):
+        cid, pass_fds = jobserver.create_client()
+        _support.set_nonblocking(pass_fds.p2c_rd)
+        self.servers.append(jobserver)
+        self._fds[jobserver] = pass_fds
+        return _VirtualClient(pass_fds.p2c_rd, pass_fds.c2p_wr)
+
+    def _close(self, jobserver):
+        self.servers.remove(jobserver)
+        for fd in self._fds.pop(jobserver):
+            os.close(fd)
+        jobserver.close()
+        if isinstance(jobserver, proxy.JobServerProxy):
+            jobserver.client.cleanup()
+
+    def weight(self, j):
+        """Number of tokens job j runs with."""
+        return min(max(j.weight, 1), self.jobs)
+
+    def _start(self, make, j, tokens, ready_since):
+        self.waits.append(self.now - ready_since)
+        if j.jobs:
+            pipes = make.client.tokens_in, make.client.tokens_out
+            if self.proxy:
+                jobproxy = self.proxy_class(_VirtualClient(*pipes))
+                client = self._client(jobproxy)
+            else:
+                # Make passes its jobserver straight on.
+                jobproxy = None
+                client = _VirtualClient(*pipes)
+            self.makes.append(
+                _Make(self, j, client, (make, j, tokens), jobproxy))
+            return
+
+        self.busy += len(tokens)
+        self.peak = max(self.peak, self.busy)
+        self._seq += 1
+        self.events.append((self.now + j.duration, self._seq, make, j, tokens))
+
+    def _finish(self, make, j, tokens):
+        if not j.jobs:
+            self.busy -= len(tokens)
+        make.finish(j, tokens)
+
+    def _state(self):
+        return [(len(s._tokens), len(s.token2cid)) for s in self.servers]
+
+    def _settle(self):
+        """Pass tokens around until nothing changes."""
+        while True:
+            before = self._state()
+            changed = False
+            for jobserver in self.servers:
+                jobserver.poll(timeout=0)
+            for make in list(self.makes):
+                changed |= make.step()
+                if make.done and make.parent is not None:
+                    # A finished sub-make gives back the token it ran on.
+                    self.makes.remove(make)
+                    if make.jobproxy is not None:
+                        self._close(make.jobproxy)
+                    self._finish(*make.parent)
+                    changed = True
+            if not changed and self._state() == before:
+                break
+
+    def run(self):
+        """Run the simulation, returns a dict of results."""
+        jobserver = self.server_class(max(self.jobs - 1, 0))
+        top = _Make(self, self.graph, self._client(jobserver))
+        self.makes.append(top)
+
+        deadlocked = False
+        try:
+            while True:
+                self._settle()
+                if top.done:
+                    break
+                if not self.events:
+                    deadlocked = True
+                    break
+
+                self.events.sort(key=lambda e: e[:2])
+                end = self.events[0][0]
+                elapsed = end - self.now
+                self.busy_time += self.busy * elapsed
+                if self.busy < self.jobs and any(
+                        m.ready() for m in self.makes):
+                    # Jobs waiting while tokens aren't being used.
+                    self.starved_time += elapsed
+                self.now = end
+
+                while self.events and self.events[0][0] == end:
+                    _, _, make, j, tokens = self.events.pop(0)
+                    self._finish(make, j, tokens)
+        finally:
+            for jobserver in reversed(self.servers):
+                self._close(jobserver)
+
+        waits = self.waits or [0.0]
+        return {
+            "jobs": self.jobs,
+            "proxy": self.proxy,
+            "makespan": self.now,
+            "utilization": (
+                self.busy_time / (self.jobs * self.now) if self.now else 0.0),
+            "peak": self.peak,
+            "wait_mean": sum(waits) / len(waits),
+            "wait_max": max(waits),
+            "starved": self.starved_time,
+            "deadlocked": deadlocked,
+        }
+
+
+def simulate(graph, jobs, **kw):
+    return Simulation(graph, jobs, **kw).run()
+
+
+def sweep(graph, jobs=(1, 2, 4, 8), proxies=(False, True), **kw):
+    """Simulate graph with each combination of settings."""
+    results = []
+    for proxy_setting in proxies:
+        for j in jobs:
+            results.append(simulate(graph, j, proxy=proxy_setting, **kw))
+    return results
+
+
+def main(args):
+    jobs = [os.cpu_count()]
+    proxies = [False]
+    graphs = []
+    args = list(args[1:])
+    while args:
+        arg = args.pop(0)
+        if arg == "-j":
+            jobs = [int(j) for j in args.pop(0).split(",")]
+        elif arg == "--proxy":
+            proxies = [False, True]
+        elif arg == "--synthetic":
+            seed = args.pop(0)
+            graphs.append((seed, synthetic(int(seed))))
+        else:
+            graphs.append((arg, load(arg)))
+
+    if not graphs:
+        sys.stderr.write(__doc__.split("\n\n")[2] + "\n")
+        return 2
+
+    for name, graph in graphs:
+        for result in sweep(graph, jobs, proxies):
+            result["graph"] = name
+            print(json.dumps(result, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Pass the jobserver on to subprocesses.
+
+subprocess closes every fd the child wasn't explicitly given (close_fds is
+on by default) so a make, ninja or cargo started from Python under make
+doesn't get the jobserver pipe and runs with its own unbounded pool. The
+Popen and run here add the jobserver fds to pass_fds (and MAKEFLAGS to the
+environment) automatically.
+
+    from make.jobserver import spawn
+    spawn.run(["make", "-C", "lib"], check=True)
+
+    # Every subprocess started inside the block, including by other
+    # libraries using subprocess.run / check_call / check_output.
+    with spawn.propagate():
+        build()
+
+The child normally runs on the job slot of the Python process. With a
+JobServerClient as `client` a token is taken for each child before it is
+started (waiting until one is free) and given back once it has exited, so
+several children can be run in parallel without going over the limit.
+"""
+
+import contextlib
+import os
+import subprocess
+
+from . import utils
+
+
+_Popen = subprocess.Popen
+
+
+def jobserver_env(env=None, jobserver=None):
+    """Return (env, pass_fds) giving a child the jobserver.
+
+    jobserver can be pass_fds, a fifo path or flags (like JobServer.flags()
+    returns) for a jobserver other than the one in MAKEFLAGS. The jobserver
+    in our own MAKEFLAGS is only used if env is None (an env without
+    MAKEFLAGS doesn't get one).
+    """
+    if env is None:
+        env = os.environ
+    env = dict(env)
+    make_flags = env.get("MAKEFLAGS", "")
+    if jobserver is not None:
+        make_flags = utils.replace_jobserver(make_flags, jobserver)
+
+    flags = utils.parse_make_flags(make_flags)
+    if not flags.has_jobserver:
+        return env, ()
+    env["MAKEFLAGS"] = make_flags
+
+    if flags.jobserver_fifo:
+        return env, ()
+    try:
+        for fd in flags.jobserver_fds:
+            os.fstat(fd)
+    except OSError:
+        # Make didn't pass the jobserver on to us (not a recursive make rule)
+        # so there is nothing to give the child.
+        return env, ()
+    return env, tuple(flags.jobserver_fds)
+
+
+def _wait_for_token(client):
+    while True:
+        token = client.get_token()
+        if token is not None:
+            return token
+
+
+class Popen(_Popen):
+    """subprocess.Popen which gives the child the jobserver.
+
+    client    - JobServerClient to take a token from for the child's job
+                slot, given back once the child has exited (noticed by
+                wait(), poll() or communicate()).
+    jobserver - Give the child this jobserver rather than our own (see
+                jobserver_env).
+    """
+
+    def __init__(self, args, *popenargs, client=None, jobserver=None, **kw):
+        kw["env"], pass_fds = jobserver_env(kw.get("env", None), jobserver)
+        kw["pass_fds"] = tuple(kw.get("pass_fds", ())) + pass_fds
+
+        self.jobserver_client = client
+        self.jobserver_token = None
+        if client is not None:
+            self.jobserver_token = _wait_for_token(client)
+        try:
+            _Popen.__init__(self, args, *popenargs, **kw)
+        except BaseException:
+            self._release_token()
+            raise
+
+    def _release_token(self):
+        if self.jobserver_token is not None:
+            self.jobserver_client.return_token(self.jobserver_token)
+            self.jobserver_token = None
+
+    def poll(self):
+        returncode = _Popen.poll(self)
+        if returncode is not None:
+            self._release_token()
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = _Popen.wait(self, timeout)
+        self._release_token()
+        return returncode
+
+
+def run(*popenargs, input=None, capture_output=False, timeout=None,
+        check=False, **kw):
+    """subprocess.run using Popen (so the child gets the jobserver)."""
+    if capture_output:
+        kw["stdout"] = subprocess.PIPE
+        kw["stderr"] = subprocess.PIPE
+
+    with Popen(*popenargs, **kw) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        except BaseException:
+            process.kill()
+            raise
+        returncode = process.poll()
+        if check and returncode:
+            raise subprocess.CalledProcessError(
+                returncode, process.args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(
+        process.args, returncode, stdout, stderr)
+
+
+@contextlib.contextmanager
+def propagate(client=None, jobserver=None):
+    """Give the jobserver to every subprocess started in the block.
+
+    Replaces subprocess.Popen (with a subclass of it) for the duration, so it
+    isn't thread safe.
+    """
+    class Propagating(Popen):
+        def __init__(self, *args, **kw):
+            kw.setdefault("client", client)
+            kw.setdefault("jobserver", jobserver)
+            Popen.__init__(self, *args, **kw)
+
+    subprocess.Popen = Propagating
+    try:
+        yield
+    finally:
+        subprocess.Popen = _Popen
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Live status of every jobserver on the host, in memory mapped files.
+
+A JobServer created with status=True (or with MAKE_JOBSERVER_STATUS=1 in the
+environment) keeps a fixed layout record of its tokens and clients in a
+small file under status_dir(). The record is updated in place, so the
+servers don't make any extra syscalls while handing out tokens, and `jobtop`
+reads every record without talking to the servers.
+
+    jobtop [--once] [--interval SECONDS]
+
+Clients and servers are linked by the inode of the pipe between them, so a
+proxy shows up below the client slot (of its parent server) it is using.
+
+Writers bump `seq` to an odd number before changing a record and back to an
+even number afterwards, readers retry until they get a stable copy.
+"""
+
+from collections import namedtuple
+
+import atexit
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+
+MAGIC = b"MJSB"
+VERSION = 1
+MAX_CLIENTS = 64
+
+KINDS = ["server", "proxy", "daemon"]
+
+HEADER = struct.Struct("=4sHHIiiQdiiiiii32s")
+Header = namedtuple("Header", [
+    "magic", "version", "kind", "seq", "pid", "ppid", "upstream_ino",
+    "started", "tokens_total", "tokens_free", "tokens_in_use", "clients",
+    "queued", "waiting", "name"])
+
+CLIENT = struct.Struct("=BBHiiiQ32s")
+Client = namedtuple("Client", [
+    "used", "waiting", "pad", "cid", "pid", "held", "ino", "name"])
+
+SIZE = HEADER.size + MAX_CLIENTS * CLIENT.size
+
+# Offsets of the fields updated on their own.
+_SEQ = struct.calcsize("=4sHH")
+_TOKENS = struct.calcsize("=4sHHIiiQd")
+_SEQ_FIELD = struct.Struct("=I")
+_TOKENS_FIELDS = struct.Struct("=iiiiii")
+_WAITING_FIELD = struct.Struct("=B")
+_INT_FIELD = struct.Struct("=i")
+
+
+def status_dir():
+    path = os.environ.get("MAKE_JOBSERVER_STATUS_DIR", None)
+    if path:
+        return path
+    rundir = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+    return os.path.join(rundir, "make-jobserver-{}".format(os.getuid()))
+
+
+def enabled():
+    return os.environ.get("MAKE_JOBSERVER_STATUS", "") not in ("", "0")
+
+
+def default_name():
+    name = os.path.basename(sys.argv[0])
+    if name == "__main__.py":
+        # python -m package
+        name = os.path.basename(os.path.dirname(sys.argv[0]))
+    return name
+
+
+def pipe_ino(fileobj):
+    if not isinstance(fileobj, int):
+        fileobj = fileobj.fileno()
+    return os.fstat(fileobj).st_ino
+
+
+def _name(name):
+    return name.encode("utf-8", "replace")[:32]
+
+
+class StatusBoard:
+    """Writer side of a status record."""
+
+    def __init__(self, kind, name="", upstream=None, path=None):
+        if path is None:
+            directory = status_dir()
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            path = os.path.join(directory, "{}-{}.status".format(
+                os.getpid(), id(self)))
+        self.path = path
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.mmap = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+
+        # Don't leave the record behind if the server is never closed.
+        self.pid = os.getpid()
+        atexit.register(self.close)
+
+        self.seq = 0
+        self.slots = {}
+        self.free_slots = list(reversed(range(MAX_CLIENTS)))
+        HEADER.pack_into(
+            self.mmap, 0, MAGIC, VERSION, KINDS.index(kind), self.seq,
+            os.getpid(), os.getppid(),
+            pipe_ino(upstream) if upstream is not None else 0,
+            time.time(), 0, 0, 0, 0, 0, 0, _name(name))
+
+    def _begin(self):
+        self.seq += 1
+        _SEQ_FIELD.pack_into(self.mmap, _SEQ, self.seq)
+
+    def _end(self):
+        self.seq += 1
+        _SEQ_FIELD.pack_into(self.mmap, _SEQ, self.seq)
+
+    def tokens(self, total, free, in_use, queued=0, waiting=0,
+               cid=None, held=0, client_waiting=False):
+        """Update the token counts, and the holdings of client cid."""
+        self._begin()
+        _TOKENS_FIELDS.pack_into(
+            self.mmap, _TOKENS,
+            total, free, in_use, len(self.slots), queued, waiting)
+        if cid in self.slots:
+            offset = self._client_offset(self.slots[cid])
+            _WAITING_FIELD.pack_into(self.mmap, offset + 1, client_waiting)
+            _INT_FIELD.pack_into(self.mmap, offset + 12, held)
+        self._end()
+
+    def _client_offset(self, slot):
+        return HEADER.size + slot * CLIENT.size
+
+    def add_client(self, cid, ino, pid=0, name=""):
+        if not self.free_slots:
+            # Still counted in the header, just not shown.
+            return
+        slot = self.free_slots.pop()
+        self.slots[cid] = slot
+        self._begin()
+        CLIENT.pack_into(
+            self.mmap, self._client_offset(slot),
+            1, 0, 0, cid, pid, 0, ino, _name(name))
+        self._end()
+
+    def describe_client(self, cid, pid, name):
+        if cid not in self.slots:
+            return
+        offset = self._client_offset(self.slots[cid])
+        self._begin()
+        _INT_FIELD.pack_into(self.mmap, offset + 8, pid)
+        self.mmap[offset + 24:offset + 56] = _name(name).ljust(32, b"\0")
+        self._end()
+
+    def remove_client(self, cid):
+        if cid not in self.slots:
+            return
+        slot = self.slots.pop(cid)
+        self._begin()
+        self.mmap[self._client_offset(slot)] = 0
+        self._end()
+        self.free_slots.append(slot)
+
+    def close(self):
+        if self.mmap.closed or os.getpid() != self.pid:
+            return
+        atexit.unregister(self.close)
+        self.mmap.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def read(path):
+    """Return (header, [clients]) for the record at path, None if it isn't
+    one (or its server has gone)."""
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size != SIZE:
+                return None
+            data = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        for i in range(100):
+            seq = struct.unpack_from("=I", data, _SEQ)[0]
+            if seq % 2:
+                continue
+            copy = data[:]
+            if struct.unpack_from("=I", data, _SEQ)[0] == seq:
+                break
+        else:
+            return None
+    finally:
+        data.close()
+
+    header = Header(*HEADER.unpack_from(copy, 0))
+    if header.magic != MAGIC or header.version != VERSION:
+        return None
+    clients = []
+    for slot in range(MAX_CLIENTS):
+        client = Client(*CLIENT.unpack_from(
+            copy, HEADER.size + slot * CLIENT.size))
+        if client.used:
+            clients.append(client)
+    return header, clients
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_all(directory=None):
+    """Return the records of every running server, removing stale ones."""
+    if directory is None:
+        directory = status_dir()
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+
+    records = []
+    for name in names:
+        if not name.endswith(".status"):
+            continue
+        path = os.path.join(directory, name)
+        record = read(path)
+        if record is None:
+            continue
+        if not _alive(record[0].pid):
+            # Left behind by a server which didn't exit cleanly.
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        records.append(record)
+    return records
+
+
+def _decode(name):
+    return name.rstrip(b"\0").decode("utf-8", "replace")
+
+
+def render(records):
+    """Format records as a tree, servers below the client slot they use."""
+    by_ino = {}
+    for record in records:
+        for client in record[1]:
+            by_ino[client.ino] = client
+
+    children = {}
+    roots = []
+    for record in records:
+        if record[0].upstream_ino in by_ino:
+            children.setdefault(record[0].upstream_ino, []).append(record)
+        else:
+            roots.append(record)
+
+    lines = []
+
+    def show(record, indent):
+        header, clients = record
+        lines.append(
+            "{}{} {} {} - tokens {} free {} in use {} queued {} "
+            "waiting {}".format(
+                indent, KINDS[header.kind], header.pid, _decode(header.name),
+                header.tokens_total, header.tokens_free, header.tokens_in_use,
+                header.queued, header.waiting))
+        for client in sorted(clients, key=lambda c: c.cid):
+            lines.append("{}  client {} pid {} {} - holding {}{}".format(
+                indent, client.cid, client.pid, _decode(client.name),
+                client.held, " (waiting)" if client.waiting else ""))
+            for child in children.get(client.ino, []):
+                show(child, indent + "    ")
+
+    for record in roots:
+        show(record, "")
+    return "\n".join(lines)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    once = "--once" in args
+    interval = 1.0
+    if "--interval" in args:
+        interval = float(args[args.index("--interval") + 1])
+
+    try:
+        while True:
+            output = render(read_all()) or "No jobservers running"
+            if once:
+                print(output)
+                return 0
+            sys.stdout.write("\x1b[H\x1b[J" + output + "\n")
+            sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
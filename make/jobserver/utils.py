@@ -2,7 +2,6 @@
 """Helpful utils for working with Make's jobserver."""
 
 import os
-import re
 
 
 def get_make(make=None):
@@ -19,6 +18,159 @@ def get_make_flags(make_flags=None):
     return make_flags
 
 
+class MakeFlags:
+    """Parsed contents of the MAKEFLAGS environment variable.
+
+    Understands the jobserver options used by every version of make;
+
+     * make 3.8x - 4.1: --jobserver-fds=R,W
+     * make 4.2 - 4.3:  --jobserver-auth=R,W
+     * make 4.4+:       --jobserver-auth=fifo:PATH
+
+    >>> f = MakeFlags("ks -j8 --jobserver-auth=3,4 -- V=1")
+    >>> f.letters, f.jobs, f.jobserver_fds, f.variables
+    ('ks', 8, (3, 4), 'V=1')
+    >>> f.dry_run, f.has_jobserver
+    (False, True)
+    >>> MakeFlags("-j4 --jobserver-auth=fifo:/tmp/GMfifo1").jobserver_fifo
+    '/tmp/GMfifo1'
+    >>> MakeFlags(" --jobserver-fds=3,4 -j").jobs
+    0
+
+    The child_flags method produces the MAKEFLAGS for a child of a new
+    jobserver (or proxy), keeping everything else.
+
+    >>> f.child_flags((6, 7))
+    'ks -j8 --jobserver-auth=6,7 -- V=1'
+    >>> MakeFlags("w").child_flags((6, 7))
+    'w -j --jobserver-fds=6,7'
+    """
+
+    JOBSERVER_OPTIONS = ("--jobserver-auth=", "--jobserver-fds=")
+
+    def __init__(self, make_flags=""):
+        assert isinstance(make_flags, str), repr(make_flags)
+        self.make_flags = make_flags
+
+        # Single letter flags, make puts them first without a dash.
+        self.letters = ""
+        # Number given to -j, 0 for -j without a number, None for no -j.
+        self.jobs = None
+        self.jobserver_option = None
+        self.jobserver_auth = None
+        # Everything else, in order.
+        self.options = []
+        # Variable overrides (after the --), left as is.
+        self.variables = ""
+
+        words = make_flags.split(" ")
+        for i, word in enumerate(words):
+            if not word:
+                continue
+            if word == "--":
+                self.variables = " ".join(words[i + 1:]).strip()
+                break
+            elif not word.startswith("-"):
+                self.letters += word
+            elif word.startswith(self.JOBSERVER_OPTIONS):
+                option, value = word.split("=", 1)
+                self.jobserver_option = option
+                self.jobserver_auth = value
+            elif word == "-j" or word == "--jobs":
+                self.jobs = 0
+            elif word.startswith("-j") and word[2:].isdigit():
+                self.jobs = int(word[2:])
+            elif word.startswith("--jobs=") and word[7:].isdigit():
+                self.jobs = int(word[7:])
+            else:
+                self.options.append(word)
+
+    @property
+    def dry_run(self):
+        """Is this a dry run (-n) or question (-q)?"""
+        return "n" in self.letters or "q" in self.letters
+
+    @property
+    def has_jobserver(self):
+        return self.jobserver_auth is not None
+
+    @property
+    def jobserver_fds(self):
+        """(read fd, write fd) of a pipe based jobserver, otherwise None."""
+        if self.jobserver_auth is None:
+            return None
+        rd, _, wr = self.jobserver_auth.partition(",")
+        if not (rd.isdigit() and wr.isdigit()):
+            return None
+        return int(rd), int(wr)
+
+    @property
+    def jobserver_fifo(self):
+        """Path of a fifo based jobserver, otherwise None."""
+        if self.jobserver_auth is None:
+            return None
+        if not self.jobserver_auth.startswith("fifo:"):
+            return None
+        return self.jobserver_auth[len("fifo:"):]
+
+    def child_flags(self, jobserver, jobs=None):
+        """Return MAKEFLAGS for a child using a different jobserver.
+
+        jobserver - pass_fds / (read fd, write fd) or the path to a fifo.
+        jobs      - Value for -j, defaults to the current one.
+        """
+        if isinstance(jobserver, str):
+            option = "--jobserver-auth"
+            auth = "fifo:" + jobserver
+        else:
+            rd, wr = jobserver
+            assert isinstance(rd, int) and isinstance(wr, int), jobserver
+            # Stick to the style make is already using, old versions of make
+            # only understand --jobserver-fds.
+            option = self.jobserver_option or "--jobserver-fds"
+            auth = "{},{}".format(rd, wr)
+
+        if jobs is None:
+            jobs = self.jobs or 0
+
+        words = []
+        if self.letters:
+            words.append(self.letters)
+        if jobs:
+            words.append("-j{}".format(jobs))
+        else:
+            words.append("-j")
+        words.append("{}={}".format(option, auth))
+        words.extend(self.options)
+        if self.variables:
+            words.append("--")
+            words.append(self.variables)
+        return " ".join(words)
+
+    def __str__(self):
+        return self.make_flags
+
+    def __repr__(self):
+        return "MakeFlags({!r})".format(self.make_flags)
+
+
+_make_flags_cache = {}
+
+
+def parse_make_flags(make_flags=None):
+    """Return the (cached) MakeFlags for make_flags (or $MAKEFLAGS)."""
+    make_flags = get_make_flags(make_flags)
+    try:
+        return _make_flags_cache[make_flags]
+    except KeyError:
+        pass
+    if len(_make_flags_cache) > 64:
+        _make_flags_cache.clear()
+    parsed = MakeFlags(make_flags)
+    _make_flags_cache[make_flags] = parsed
+    return parsed
+
+
 def should_run_submake(make_flags=None):
     """Check if make_flags indicate that we should execute things.
 
@@ -70,62 +222,61 @@ def should_run_submake(make_flags=None):
     >>> should_run_submake('--quiant')
     True
     """
-    make_flags = get_make_flags(make_flags)
-
-    r = re.search(r"(?:^|\s)[^-]*(n|q)[^\s]*(\s|$)", make_flags)
-    if not r:
-        return True
-    return not bool(r.groups()[0])
-
-
-_JOBSERVER_REGEX = "--jobserver-fds=([0-9]+),([0-9]+)"
+    return not parse_make_flags(make_flags).dry_run
 
 
 def has_jobserver(make_flags=None):
-    make_flags = get_make_flags(make_flags)
-    return "--jobserver" in make_flags
+    return parse_make_flags(make_flags).has_jobserver
 
 
 def replace_jobserver(make_flags, new_jobserver):
-    """
+    """Return make_flags changed to use a new jobserver.
+
+    new_jobserver can be pass_fds, a fifo path or flags containing the new
+    jobserver (like JobServer.flags() returns).
 
     >>> replace_jobserver(
-    ...     "random --jobserver-fds=4,5 stuff",
+    ...     "k --jobserver-fds=4,5 -j --no-print-directory",
     ...     "--jobserver-fds=6,7",
     ... )
-    "random --jobserver-fds=6,7 stuff"
+    'k -j --jobserver-fds=6,7 --no-print-directory'
+    >>> replace_jobserver("w -j4 --jobserver-auth=3,4", (6, 7))
+    'w -j4 --jobserver-auth=6,7'
+    >>> replace_jobserver("", "-j --jobserver-fds=6,7")
+    '-j --jobserver-fds=6,7'
 
     """
-    if not has_jobserver(make_flags):
-        return make_flags
-    else:
-        new_make_flags = re.sub(_JOBSERVER_REGEX, new_jobserver, make_flags)
-        assert new_jobserver in new_make_flags, (
-            make_flags,
-            new_jobserver,
-            new_make_flags,
-        )
-        return new_make_flags
+    if isinstance(new_jobserver, str) and new_jobserver.startswith("-"):
+        new_flags = parse_make_flags(new_jobserver)
+        assert new_flags.has_jobserver, new_jobserver
+        new_jobserver = new_flags.jobserver_fds or new_flags.jobserver_fifo
+        assert new_jobserver, new_flags
+    return parse_make_flags(make_flags).child_flags(new_jobserver)
 
 
 def fds_for_jobserver(make_flags=None):
-    make_flags = get_make_flags(make_flags)
+    make_flags = parse_make_flags(make_flags)
 
-    if not has_jobserver(make_flags):
+    if not make_flags.has_jobserver:
         return None, None
 
-    job_re = re.search(_JOBSERVER_REGEX, make_flags)
-    assert job_re, make_flags
-    job_rd, job_wr = job_re.groups()
+    fifo = make_flags.jobserver_fifo
+    if fifo is not None:
+        return open(fifo, "rb", 0), open(fifo, "wb", 0)
 
-    job_rd = int(job_rd)
-    job_wr = int(job_wr)
+    assert make_flags.jobserver_fds, make_flags
+    job_rd, job_wr = make_flags.jobserver_fds
     assert job_rd > 2, (job_rd, job_wr, make_flags)
     assert job_wr > 2, (job_rd, job_wr, make_flags)
 
+    # Make 4.3 leaves the shared pipe non-blocking, reopening it gives us our
+    # own (blocking) file description without changing it for everyone else.
+    if not os.get_blocking(job_rd):
+        job_rd = os.open("/proc/self/fd/{}".format(job_rd), os.O_RDONLY)
+
     # Make sure the file descriptors exist..
-    job_rd_fd = os.fdopen(int(job_rd), "rb", 0)
+    job_rd_fd = os.fdopen(job_rd, "rb", 0)
     assert job_rd_fd
-    job_wr_fd = os.fdopen(int(job_wr), "wb", 0)
+    job_wr_fd = os.fdopen(job_wr, "wb", 0)
     assert job_wr_fd
     return job_rd_fd, job_wr_fd
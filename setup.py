@@ -51,11 +51,15 @@ setup(
         'test': ['coverage'],
     },
 
-    # entry_points={
-    #     'console_scripts': [
-    #         'sample=sample:main',
-    #     ],
-    # },
+    entry_points={
+        'console_scripts': [
+            'make-jobserver=make.jobserver.__main__:main',
+            'jobtop=make.jobserver.status:main',
+        ],
+        'pytest11': [
+            'make_jobserver=make.jobserver.pytest_plugin',
+        ],
+    },
 
     project_urls={
         'Bug Reports': 'https://github.com/mithro/python-make-jobserver/issues',  # noqa
@@ -1,4 +1,5 @@
 #!/bin/bash
 which python
+python -m doctest make/jobserver/utils.py || exit 1
 cd tests
 make || exit 1
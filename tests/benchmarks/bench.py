@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""Benchmarks for the jobserver.
+
+    bench.py [--quick] [--output results.json] [name ...]
+    bench.py --compare old.json new.json
+
+Everything runs locally (no network). Results are written as JSON so runs
+from different commits can be compared with --compare.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, TOP)
+sys.path.insert(0, os.path.join(TOP, "tests", "utils"))
+
+from make.jobserver import client
+from make.jobserver import server
+from make.jobserver import utils
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def _env(**kw):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = TOP
+    env.pop("MAKEFLAGS", None)
+    env.pop("MFLAGS", None)
+    env.update(kw)
+    return env
+
+
+def _fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def _rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def bench_latency(quick):
+    """Acquire / release round trip through JobServer and JobServerClient."""
+    cycles = 200 if quick else 2000
+    jobserver = server.JobServer(1)
+    cid, pass_fds = jobserver.create_client()
+    result_rd, result_wr = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        jobclient = client.JobServerClient(jobserver.flags(pass_fds))
+        free = jobclient.get_token()
+        samples = []
+        while len(samples) < cycles:
+            start = time.perf_counter()
+            token = jobclient.get_token()
+            if token is None:
+                continue
+            jobclient.return_token(token)
+            samples.append(time.perf_counter() - start)
+        jobclient.return_token(free)
+        samples.sort()
+        os.write(result_wr, json.dumps({
+            "median_us": samples[len(samples) // 2] * 1e6,
+            "p99_us": samples[int(len(samples) * 0.99)] * 1e6,
+            "mean_us": sum(samples) / len(samples) * 1e6,
+        }).encode())
+        os._exit(0)
+
+    for fileno in pass_fds:
+        os.close(fileno)
+    os.close(result_wr)
+    while os.waitpid(pid, os.WNOHANG) == (0, 0):
+        jobserver.poll(timeout=0.01)
+    jobserver.cleanup_client(cid, allow_tokens=True)
+    with os.fdopen(result_rd) as f:
+        result = json.load(f)
+    result["cycles"] = cycles
+    return result
+
+
+def bench_throughput(quick):
+    """Tokens per second through a JobServer with 1 - 1000 clients.
+
+    The clients are simulated in process, each client takes any token it is
+    given and hands it straight back.
+    """
+    sizes = [1, 10, 100] if quick else [1, 10, 100, 1000]
+    duration = 0.5 if quick else 2.0
+    results = {}
+    for size in sizes:
+        jobserver = server.JobServer(size)
+        clients = []
+        for i in range(size):
+            cid, pass_fds = jobserver.create_client()
+            rd = os.fdopen(pass_fds.p2c_rd, "rb", buffering=0)
+            os.set_blocking(pass_fds.p2c_rd, False)
+            wr = os.fdopen(pass_fds.c2p_wr, "wb", buffering=0)
+            clients.append((cid, rd, wr))
+
+        tokens = 0
+        start = time.time()
+        cpu = _cpu()
+        while time.time() - start < duration:
+            jobserver.poll(timeout=0)
+            for cid, rd, wr in clients:
+                token = rd.read(1)
+                if token:
+                    wr.write(token)
+                    tokens += 1
+        elapsed = time.time() - start
+        cpu = _cpu() - cpu
+
+        for cid, rd, wr in clients:
+            rd.close()
+            wr.close()
+            jobserver.cleanup_client(cid, allow_tokens=True)
+        results[str(size)] = {
+            "tokens_per_sec": tokens / elapsed,
+            "cpu_per_token_us": cpu / max(tokens, 1) * 1e6,
+        }
+    return results
+
+
+def bench_footprint(quick):
+    """File descriptors and RSS per client in the server process."""
+    size = 200 if quick else 1000
+    jobserver = server.JobServer(1)
+    fds = _fds()
+    rss = _rss_kb()
+    cids = []
+    for i in range(size):
+        cid, pass_fds = jobserver.create_client()
+        for fileno in pass_fds:
+            os.close(fileno)
+        cids.append(cid)
+    result = {
+        "clients": size,
+        "fds_per_client": (_fds() - fds) / float(size),
+        "rss_kb_per_client": (_rss_kb() - rss) / float(size),
+    }
+    jobserver.cleanup(allow_tokens=True)
+    return result
+
+
+def bench_churn(quick):
+    """create_client / cleanup_client cycles per second, with and without
+    recycling of the client pipes.
+    """
+    cycles = 1000 if quick else 10000
+    results = {}
+    for name, recycle in (("new", False), ("recycled", True)):
+        jobserver = server.JobServer(1, recycle_clients=recycle)
+        start = time.time()
+        for i in range(cycles):
+            cid, pass_fds = jobserver.create_client()
+            for fileno in pass_fds:
+                os.close(fileno)
+            jobserver.cleanup_client(cid)
+        results[name] = {"cycles_per_sec": cycles / (time.time() - start)}
+        jobserver.cleanup()
+    return results
+
+
+def bench_idle_cpu(quick):
+    """CPU used by a server whose clients are idle, polled like the drivers.
+
+    Nothing but poll(timeout=...) is run in the loop, so a server which
+    doesn't block in poll shows up as busy (and polls_per_sec is high).
+    """
+    duration = 0.5 if quick else 2.0
+    results = {}
+
+    jobserver = server.JobServer(4)
+    cid, pass_fds = jobserver.create_client()
+    p = subprocess.Popen(
+        ["sleep", str(duration)], pass_fds=pass_fds, close_fds=True)
+    for fileno in pass_fds:
+        os.close(fileno)
+    cpu = _cpu()
+    start = time.time()
+    polls = 0
+    while p.poll() is None:
+        jobserver.poll(timeout=0.1)
+        polls += 1
+    elapsed = time.time() - start
+    results["server_cpu_percent"] = (_cpu() - cpu) / elapsed * 100
+    results["server_polls_per_sec"] = polls / elapsed
+    jobserver.cleanup_client(cid, allow_tokens=True)
+
+    from make.jobserver import daemon
+    path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+    jobdaemon = daemon.JobServerDaemon(4, path=path)
+    p = subprocess.Popen([
+        sys.executable, "-m", "make.jobserver", "serve", "--attach",
+        "--socket", path, "--", "sleep", str(duration)],
+        stdout=subprocess.DEVNULL, env=_env())
+    while not jobdaemon.cid2conn:
+        jobdaemon.poll()
+    cpu = _cpu()
+    start = time.time()
+    polls = 0
+    while p.poll() is None:
+        jobdaemon.poll(timeout=0.1)
+        polls += 1
+    elapsed = time.time() - start
+    results["daemon_cpu_percent"] = (_cpu() - cpu) / elapsed * 100
+    results["daemon_polls_per_sec"] = polls / elapsed
+    jobdaemon.close()
+    shutil.rmtree(os.path.dirname(path))
+    return results
+
+
+LEAF = """
+import sys, time
+from make.jobserver import client
+jobclient = client.JobServerClient()
+free = jobclient.get_token()
+samples = []
+while len(samples) < {cycles}:
+    start = time.perf_counter()
+    token = jobclient.get_token()
+    if token is None:
+        continue
+    jobclient.return_token(token)
+    samples.append(time.perf_counter() - start)
+jobclient.return_token(free)
+samples.sort()
+print(samples[len(samples) // 2])
+"""
+
+
+def bench_proxy_depth(quick):
+    """Token round trip latency under a chain of proxies.
+
+    With every proxy relaying tokens (isolate) and with the default, where
+    proxies below serve just pass the jobserver through (auto).
+    """
+    depths = [0, 1, 2] if quick else [0, 1, 2, 3, 4, 5]
+    cycles = 20 if quick else 100
+    cli = [sys.executable, "-m", "make.jobserver"]
+    leaf = [sys.executable, "-c", LEAF.format(cycles=cycles)]
+
+    results = {}
+    for mode, options in (("isolate", ["--isolate"]), ("auto", [])):
+        results[mode] = {}
+        for depth in depths:
+            cmd = cli + ["serve", "-j", "2", "--"]
+            for i in range(depth):
+                cmd += cli + ["proxy"] + options + ["--"]
+            start = time.time()
+            output = subprocess.check_output(cmd + leaf, env=_env())
+            results[mode][str(depth)] = {
+                "median_us": float(output.split()[-1]) * 1e6,
+                "wall_s": time.time() - start,
+            }
+    return results
+
+
+TREE_TOP = """
+all: {subs}
+{subs}:
+\t+{wrap}$(MAKE) -f {sub}
+"""
+
+TREE_SUB = """
+all: {jobs}
+{jobs}:
+\t@sleep {duration}
+"""
+
+
+def bench_makespan(quick):
+    """Makespan of a synthetic recursive make tree.
+
+    Run with make's own jobserver and with a JobServer / JobServerProxy at
+    each level.
+    """
+    width = 4 if quick else 8
+    jobs = 4 if quick else 8
+    duration = 0.05
+    tmpdir = tempfile.mkdtemp()
+    sub = os.path.join(tmpdir, "sub.mk")
+    with open(sub, "w") as f:
+        names = " ".join("job{}".format(i) for i in range(jobs))
+        f.write(TREE_SUB.format(jobs=names, duration=duration))
+
+    cli = "{} -m make.jobserver ".format(sys.executable)
+    subs = " ".join("sub{}".format(i) for i in range(width))
+    results = {}
+    try:
+        for name, wrap, top in (
+                ("make", "", ["make", "-j4"]),
+                ("proxy", cli + "proxy -- ",
+                 cli.split() + ["serve", "-j", "4", "--", "make"])):
+            top_mk = os.path.join(tmpdir, "{}.mk".format(name))
+            with open(top_mk, "w") as f:
+                f.write(TREE_TOP.format(subs=subs, wrap=wrap, sub=sub))
+            start = time.time()
+            subprocess.check_call(
+                top + ["-s", "-f", top_mk], env=_env(), cwd=tmpdir)
+            elapsed = time.time() - start
+            ideal = width * jobs * duration / 4
+            results[name] = {"makespan_s": elapsed, "ideal_s": ideal}
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def bench_startup(quick):
+    """Import time of the clients."""
+    import startup
+    runs = 3 if quick else 10
+    results = {}
+    for module in ("make.jobserver.lite", "make.jobserver.client"):
+        results[module + "_us"] = startup.importtime(module, runs)[0]
+    return results
+
+
+def bench_simulate(quick):
+    """Simulated configurations per second."""
+    from make.jobserver import sim
+    graph = sim.synthetic(0, width=16, depth=3)
+    jobs = range(1, 9 if quick else 33)
+    start = time.time()
+    results = sim.sweep(graph, jobs)
+    return {"configs_per_sec": len(results) / (time.time() - start)}
+
+
+BENCHMARKS = [
+    ("latency", bench_latency),
+    ("throughput", bench_throughput),
+    ("footprint", bench_footprint),
+    ("churn", bench_churn),
+    ("idle_cpu", bench_idle_cpu),
+    ("proxy_depth", bench_proxy_depth),
+    ("makespan", bench_makespan),
+    ("startup", bench_startup),
+    ("simulate", bench_simulate),
+]
+
+
+def _flatten(data, prefix=""):
+    for key, value in sorted(data.items()):
+        if isinstance(value, dict):
+            for item in _flatten(value, prefix + key + "."):
+                yield item
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = dict(_flatten(json.load(f)["results"]))
+    with open(new_path) as f:
+        new = dict(_flatten(json.load(f)["results"]))
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] else float("inf")
+        print("{:50} {:>14.3f} {:>14.3f} {:>8.2f}x".format(
+            key, old[key], new[key], ratio))
+    return 0
+
+
+def main(args):
+    if args[1:2] == ["--compare"]:
+        return compare(args[2], args[3])
+
+    quick = "--quick" in args
+    output = None
+    if "--output" in args:
+        output = args[args.index("--output") + 1]
+    names = [a for a in args[1:] if not a.startswith("-") and a != output]
+
+    # Benchmarks run at the top level, outside any make.
+    if utils.has_jobserver():
+        os.environ.pop("MAKEFLAGS")
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = {}
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        log("Running {}".format(name))
+        results[name] = func(quick)
+        log("{}: {}".format(name, json.dumps(results[name], sort_keys=True)))
+
+    data = {
+        "commit": subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=TOP,
+            universal_newlines=True).strip(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "quick": quick,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    else:
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Run children under an AsyncJobServer (or AsyncJobServerProxy when there
+is already a jobserver) while checking the event loop never stalls."""
+
+from __future__ import print_function
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import aio
+from make.jobserver import client
+from make.jobserver import utils
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+async def ticker(stalls):
+    while True:
+        start = time.time()
+        await asyncio.sleep(0.01)
+        stalls.append(time.time() - start - 0.01)
+
+
+async def idle(jobserver):
+    """Count the token offers made while a client sits on its token."""
+    offers = []
+    offer = jobserver._offer
+
+    def counting(cids):
+        offers.append(cids)
+        return offer(cids)
+
+    jobserver._offer = counting
+    cid, pass_fds = jobserver.create_client()
+    await asyncio.sleep(1.0)
+    jobserver.cleanup_client(cid, allow_tokens=True)
+    for fileno in pass_fds:
+        os.close(fileno)
+    del jobserver._offer
+    return len(offers)
+
+
+async def run(args):
+    jobclient = None
+    if utils.has_jobserver():
+        jobclient = client.JobServerClient()
+        jobserver = aio.AsyncJobServerProxy(jobclient)
+        # Set up like any other proxy.
+        if jobserver.passthrough or jobserver.passthrough_clients:
+            log("ERROR: Proxy not initialised: {}".format(vars(jobserver)))
+            return -1
+    else:
+        jobserver = aio.AsyncJobServer(num_tokens=3)
+    log("Created jobserver: {}".format(jobserver))
+
+    errors = []
+    asyncio.get_event_loop().set_exception_handler(
+        lambda loop, context: errors.append(context))
+
+    # The token waiting in an idle client's pipe is only checked on now and
+    # then.
+    offers = await idle(jobserver)
+    log("{} offers in 1s to an idle client".format(offers))
+    if offers > 20:
+        log("ERROR: Busy while a client was idle")
+        return -1
+
+    stalls = []
+    tick = asyncio.ensure_future(ticker(stalls))
+    retcodes = await asyncio.gather(
+        *(jobserver.run(*args[1:]) for i in range(4)))
+    tick.cancel()
+    jobserver.close()
+    if jobclient is not None:
+        jobclient.cleanup()
+
+    log("Children finished with {}, longest stall {:.3f}s".format(
+        retcodes, max(stalls)))
+    if errors:
+        log("ERROR: Exceptions in the event loop: {}".format(errors))
+        return -1
+    if max(stalls) > 0.1:
+        log("ERROR: Event loop stalled")
+        return -1
+    return sum(retcodes)
+
+
+def main(args):
+    # Should run things?
+    if not utils.should_run_submake():
+        return 0
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
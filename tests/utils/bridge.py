@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import bridge
+from make.jobserver import utils
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def check_malformed(coord):
+    """Agents sending nonsense are dropped, the coordinator keeps going."""
+    ok = True
+    for data in [b"ACQUIRE\n", b"ACQUIRE -3\n", b"RELEASE x\n",
+                 b"ACQUIRE 1 2\n", b"A" * 4096]:
+        sock = socket.create_connection(coord.address)
+        sock.sendall(data)
+        for i in range(10):
+            coord.poll(timeout=0.05, log=log)
+        sock.settimeout(1.0)
+        try:
+            closed = sock.recv(1) == b""
+        except socket.timeout:
+            closed = False
+        except socket.error:
+            closed = True
+        sock.close()
+        if not closed or coord.leases:
+            log("ERROR: Agent sending {!r} wasn't dropped!".format(data[:20]))
+            ok = False
+    return ok
+
+
+def coordinator(args):
+    num_tokens = int(args[0])
+    num_agents = int(args[1])
+    cmd = args[2:]
+
+    coord = bridge.BridgeCoordinator(num_tokens, lease_time=2.0)
+    address = "{}:{}".format(*coord.address)
+    log("Coordinator listening on {}".format(address))
+    if not check_malformed(coord):
+        return -1
+
+    agents = []
+    for i in range(num_agents):
+        agents.append(subprocess.Popen(
+            [sys.executable, __file__, "agent", address] + cmd))
+
+    max_leased = 0
+    retcodes = [None] * num_agents
+    while None in retcodes:
+        coord.poll(timeout=0.05, log=log)
+        max_leased = max(max_leased, coord.leased())
+        for i, p in enumerate(agents):
+            if retcodes[i] is None:
+                retcodes[i] = p.poll()
+
+    start_time = time.time()
+    while coord.leases and time.time() - start_time < 10:
+        coord.poll(timeout=0.05, log=log)
+
+    log("Agents finished with {}, at most {} tokens leased".format(
+        retcodes, max_leased))
+    leftover = coord.leased()
+    coord.close()
+    if leftover or len(coord._tokens) != num_tokens:
+        log("ERROR: Tokens not returned to the coordinator!")
+        return -1
+    if max_leased > num_tokens:
+        log("ERROR: Leased more tokens than the budget!")
+        return -1
+    return sum(retcodes)
+
+
+def agent(args):
+    address = args[0]
+    cmd = args[1:]
+
+    with bridge.BridgeAgent(address, batch=2) as agent:
+        log("Connected to coordinator: {}".format(agent.client))
+        try:
+            agent.start(log=log)
+        except ConnectionError:
+            log("ERROR: Lost the coordinator!")
+            return -1
+        log("Running '{}'".format(" ".join(cmd)))
+        retcode = agent.run(cmd, log=log)
+
+    log("Command finished with {}".format(retcode))
+    return retcode
+
+
+def main(args):
+    # Should run things?
+    if not utils.should_run_submake():
+        return 0
+
+    if args[1] == "agent":
+        return agent(args[2:])
+    return coordinator(args[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Run many short lived children through a recycling JobServer.
+
+Only enough fds for two clients are allowed, so the rest of the children
+are queued until a client slot is recycled.
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import utils
+from make.jobserver import server
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def main(args):
+    # Should run things?
+    if not utils.should_run_submake():
+        return 0
+
+    if utils.has_jobserver():
+        log("ERROR: Jobserver already exists!")
+        return -1
+
+    children = 12
+    jobserver = server.JobServer(
+        num_tokens=2, recycle_clients=True, max_fds=10)
+    log("Created jobserver: {}".format(jobserver))
+    fds = len(os.listdir("/proc/self/fd"))
+
+    processes = {}
+    cids = set()
+
+    def start(childid, pass_fds):
+        env = dict(os.environ)
+        env["MAKEFLAGS"] = utils.replace_jobserver(
+            utils.get_make_flags(), pass_fds)
+        p = subprocess.Popen(args[1:], shell=False, env=env, pass_fds=pass_fds)
+        for fileno in pass_fds:
+            os.close(fileno)
+        log("Child {} - Started {}".format(childid, p.pid))
+        processes[childid] = p
+        cids.add(childid)
+
+    for i in range(children):
+        childid, pass_fds = jobserver.create_client(start)
+        if childid is not None:
+            start(childid, pass_fds)
+
+    retcodes = []
+    while len(retcodes) < children:
+        jobserver.poll(timeout=0.1, log=log)
+
+        for childid, p in list(processes.items()):
+            try:
+                retcode = p.wait(0.01)
+            except subprocess.TimeoutExpired:
+                continue
+            log("Child {} - Finished with {}".format(childid, retcode))
+            retcodes.append(retcode)
+            del processes[childid]
+            jobserver.cleanup_client(childid, log=log)
+
+    if len(cids) > 2:
+        log("ERROR: Client slots weren't recycled: {}".format(cids))
+        return -1
+
+    jobserver.cleanup()
+    if len(os.listdir("/proc/self/fd")) > fds:
+        log("ERROR: Leaked fds")
+        return -1
+    return sum(retcodes)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Check the output and exit codes of python -m make.jobserver."""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+JOBSERVER = [sys.executable, "-m", "make.jobserver"]
+
+sys.path.insert(0, TOP)
+
+from make.jobserver import __main__ as cli_main
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def cli(args, stdin=None, make_flags=None, env=None, pass_fds=()):
+    """Return (exit code, stdout + stderr) of the command line tool."""
+    env = dict(os.environ, **(env or {}))
+    env["PYTHONPATH"] = TOP
+    env.pop("MAKEFLAGS", None)
+    env.pop("MFLAGS", None)
+    if make_flags is not None:
+        env["MAKEFLAGS"] = make_flags
+    p = subprocess.Popen(
+        JOBSERVER + args, env=env, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, pass_fds=pass_fds)
+    output, _ = p.communicate(stdin)
+    return p.returncode, output
+
+
+def check(args, retcode, expected, **kw):
+    """Fail unless the command exits with retcode and prints expected."""
+    got, output = cli(args, **kw)
+    log("{}: {} (expected {} and {!r})".format(
+        " ".join(args), got, retcode, expected))
+    if got != retcode or expected not in output:
+        log(output)
+        raise AssertionError("{} didn't exit with {} and print {!r}".format(
+            " ".join(args), retcode, expected))
+
+
+def test_errors():
+    check([], 2, "usage:")
+    check(["bogus"], 2, "invalid choice: 'bogus'")
+    check(["run"], 2, "no command given")
+    check(["run", "--"], 2, "no command given")
+    check(["run", "--bogus", "--", "true"], 2, "unrecognized arguments")
+    check(["serve", "-j", "x", "--", "true"], 2, "positive number")
+    check(["serve", "-j0", "--", "true"], 2, "positive number")
+    check(["daemon", "--quota=abc"], 2, "positive number")
+    check(["daemon", "stray"], 2, "unrecognized arguments")
+    check(["top", "--interval", "soon"], 2, "invalid float value")
+    check(["proxy", "--isolate", "--passthrough", "--", "true"], 2,
+          "not allowed with")
+
+    check(["proxy", "--", "true"], 2, "no jobserver to proxy")
+    check(["proxy", "--", "true"], 2, "can't use jobserver weird",
+          make_flags="-j4 --jobserver-auth=weird")
+    check(["stat"], 1, "jobserver unusable: weird",
+          make_flags="-j4 --jobserver-auth=weird")
+    check(["stat"], 0, "jobserver: none")
+    check(["run", "--", "nonexistent-command"], 127, "nonexistent-command")
+
+
+def test_commands():
+    check(["serve", "-j", "3", "--", "sh", "-c", "exit 3"], 3, "")
+    check(["serve", "-j3", "--"] + JOBSERVER + ["stat"], 0, "jobserver: pipe")
+    check(["serve", "-j", "2", "--"] + JOBSERVER + ["serve", "--", "true"],
+          2, "a jobserver already exists")
+    check(["serve", "--jobs=2", "--"] + JOBSERVER + ["run", "echo", "ran"],
+          0, "ran")
+    proxy = JOBSERVER + ["proxy", "--isolate", "--"] + JOBSERVER
+    check(["serve", "-j", "2", "--"] + proxy + ["run", "echo", "ran"],
+          0, "ran")
+    xargs = JOBSERVER + ["xargs", "--"]
+    check(["serve", "-j", "2", "--"] + xargs + ["echo"],
+          0, "line2", stdin="line1\nline2\n")
+    check(["serve", "-j", "2", "--"] + xargs + ["sh", "-c", "exit $0"],
+          5, "", stdin="0\n5\n1\n")
+    check(["top", "--once"], 0, "")
+
+
+def test_isolation():
+    """Proxies pass through only below the jobserver the marker was set
+    for, not another one using the same fds."""
+    fds = os.pipe()
+    make_flags = "-j2 --jobserver-auth={},{}".format(*fds)
+    stale = cli_main._jobserver_id(make_flags)
+    for fd in fds:
+        os.close(fd)
+    if os.pipe() != fds:
+        raise AssertionError("new pipe isn't on fds {}".format(fds))
+    current = cli_main._jobserver_id(make_flags)
+
+    show = ["proxy", "--", "sh", "-c", "echo marker $" + cli_main.ISOLATED_ENV]
+    try:
+        # Passed through, the child has the same jobserver.
+        check(show, 0, "marker " + current, make_flags=make_flags,
+              env={cli_main.ISOLATED_ENV: current}, pass_fds=fds)
+        got, output = cli(show, make_flags=make_flags,
+                          env={cli_main.ISOLATED_ENV: stale}, pass_fds=fds)
+        log("marker {} for {}: {}".format(stale, current, output.strip()))
+        if got != 0 or "marker " not in output or current in output:
+            raise AssertionError("proxy passed through on a stale marker")
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def main(args):
+    test_errors()
+    test_commands()
+    test_isolation()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path.insert(0, ROOT)
+# For the python -m make.jobserver commands.
+os.environ["PYTHONPATH"] = os.path.abspath(ROOT)
+
+from make.jobserver import daemon
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def read_jobs(path):
+    """Return [(time, +1 / -1, build)] for the jobs logged to path."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            build, what, when = line.split()
+            events.append((float(when), 1 if what == "start" else -1, build))
+    os.unlink(path)
+    # Jobs finishing at the same moment another starts didn't overlap.
+    events.sort()
+    return events
+
+
+def most_running(events, build=None, start=0, end=float("inf")):
+    """Most jobs (of build) running at once between start and end."""
+    running = most = 0
+    for when, change, job_build in events:
+        if build is not None and job_build != build:
+            continue
+        running += change
+        if start <= when < end:
+            most = max(most, running)
+    return most
+
+
+def check_jobs(events, builds, num_tokens, quota=None):
+    """Fail unless the builds stayed within the daemon's limits."""
+    errors = []
+    most = most_running(events)
+    log("At most {} jobs at once, {} tokens".format(most, num_tokens))
+    if most > num_tokens:
+        errors.append("{} jobs ran at once with {} tokens".format(
+            most, num_tokens))
+
+    # While every build is running, none gets more than its fair share.
+    share = -(-num_tokens // len(builds))
+    if quota:
+        share = min(share, quota)
+    first_ends = []
+    last_starts = []
+    for build in builds:
+        times = [when for when, _, job_build in events if job_build == build]
+        last_starts.append(min(times))
+        first_ends.append(max(times))
+    for build in builds:
+        limit = quota or num_tokens
+        build_most = most_running(events, build)
+        shared_most = most_running(
+            events, build, max(last_starts), min(first_ends))
+        log("Build {} ran at most {} jobs at once, {} while sharing".format(
+            build, build_most, shared_most))
+        if build_most > limit:
+            errors.append("build {} ran {} jobs with a quota of {}".format(
+                build, build_most, limit))
+        if shared_most > share:
+            errors.append("build {} ran {} jobs with a fair share of {}"
+                          .format(build, shared_most, share))
+
+    for error in errors:
+        log("ERROR: {}".format(error))
+    return not errors
+
+
+def standalone(args):
+    """Run builds against the daemon started from the command line."""
+    num_tokens = int(args[0])
+    cmd = args[1:]
+
+    path = os.path.abspath("standalone.sock")
+    jobdaemon = subprocess.Popen(
+        [sys.executable, "-m", "make.jobserver", "daemon",
+         "-j", str(num_tokens), "--quota", "2", "--socket", path])
+    start_time = time.time()
+    while not os.path.exists(path) and time.time() - start_time < 10:
+        time.sleep(0.01)
+
+    joblog = os.path.abspath("standalone.jobs")
+    if os.path.exists(joblog):
+        os.unlink(joblog)
+    attach = [sys.executable, "-m", "make.jobserver", "serve", "--attach",
+              "--socket", path, "--quota", "2", "--"]
+    builds = []
+    for i in range(2):
+        env = dict(os.environ, BUILD=str(i), JOBLOG=joblog)
+        builds.append(subprocess.Popen(attach + cmd, env=env))
+    retcodes = [p.wait() for p in builds]
+    log("Builds finished with {}".format(retcodes))
+
+    jobdaemon.terminate()
+    if jobdaemon.wait() != 0 or os.path.exists(path):
+        log("ERROR: Daemon didn't exit cleanly!")
+        return -1
+    if not check_jobs(read_jobs(joblog), ["0", "1"], num_tokens, 2):
+        return -1
+    return sum(retcodes)
+
+
+def main(args):
+    if args[1] == "standalone":
+        return standalone(args[2:])
+
+    num_tokens = int(args[1])
+    num_builds = int(args[2])
+    cmd = args[3:]
+
+    path = os.path.abspath("daemon.sock")
+    jobdaemon = daemon.JobServerDaemon(num_tokens, path=path)
+    log("Created daemon on {}".format(path))
+
+    attach = [sys.executable, "-m", "make.jobserver", "serve", "--attach",
+              "--socket", path, "--"]
+    joblog = os.path.abspath("daemon.jobs")
+    if os.path.exists(joblog):
+        os.unlink(joblog)
+
+    # A build which gets killed without returning anything, in a process
+    # group of its own so the command it is running is killed too.
+    killed = subprocess.Popen(attach + ["sleep", "60"], start_new_session=True)
+    builds = []
+    for i in range(num_builds):
+        env = dict(os.environ, BUILD=str(i), JOBLOG=joblog)
+        builds.append(subprocess.Popen(attach + cmd, env=env))
+
+    start_time = time.time()
+    retcodes = [None] * num_builds
+    while None in retcodes or killed is not None:
+        jobdaemon.poll(timeout=0.1, log=log)
+
+        if killed is not None and time.time() - start_time > 1:
+            log("Killing build {}".format(killed.pid))
+            os.killpg(killed.pid, signal.SIGKILL)
+            killed.wait()
+            killed = None
+
+        for i, p in enumerate(builds):
+            if retcodes[i] is None:
+                retcodes[i] = p.poll()
+
+    # Let the daemon notice the last builds going away.
+    while jobdaemon.cid2conn and time.time() - start_time < 60:
+        jobdaemon.poll(timeout=0.1, log=log)
+
+    log("Builds finished with {}, tokens {}".format(
+        retcodes, jobdaemon._tokens))
+    leftover = len(jobdaemon.cid2conn)
+    jobdaemon.close(log=log)
+    if leftover or len(jobdaemon._tokens) != num_tokens:
+        log("ERROR: Tokens not returned to the daemon!")
+        return -1
+    if not check_jobs(read_jobs(joblog),
+                      [str(i) for i in range(num_builds)], num_tokens):
+        return -1
+    return sum(retcodes)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
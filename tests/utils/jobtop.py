@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Watch a serve / proxy tree through the status records while it runs."""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import status
+from make.jobserver import utils
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def main(args):
+    # Should run things?
+    if not utils.should_run_submake():
+        return 0
+
+    directory = tempfile.mkdtemp()
+    os.environ["MAKE_JOBSERVER_STATUS"] = "1"
+    os.environ["MAKE_JOBSERVER_STATUS_DIR"] = directory
+    os.environ.pop("MAKEFLAGS", None)
+    os.environ.pop("MFLAGS", None)
+
+    cli = [sys.executable, "-m", "make.jobserver"]
+    p = subprocess.Popen(cli + ["serve", "-j", "3", "--"] + args[1:])
+
+    seen = None
+    deadline = time.time() + 10
+    while p.poll() is None and time.time() < deadline:
+        records = status.read_all(directory)
+        output = status.render(records)
+        kinds = [header.kind for header, clients in records]
+        held = sum(c.held for header, clients in records for c in clients)
+        if kinds.count(status.KINDS.index("proxy")) == 2 and held >= 1:
+            if output.count("\n    proxy") == 2:
+                seen = output
+                break
+        time.sleep(0.05)
+
+    if seen is None:
+        log("ERROR: Never saw the proxies below the server")
+    else:
+        log("jobtop:\n{}".format(seen))
+        subprocess.check_call(cli + ["top", "--once"])
+
+    retcode = p.wait()
+    left = os.listdir(directory)
+    shutil.rmtree(directory)
+    if left:
+        log("ERROR: Status records left behind {}".format(left))
+        return -1
+    if seen is None:
+        return -1
+    return retcode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
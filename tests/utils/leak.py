@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Take count tokens from the jobserver, then either exit still holding them
+(leak) or give them back (take). Fails if the tokens don't turn up."""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import lite
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def main(args):
+    mode = args[1]
+    count = int(args[2])
+
+    log("{} {} tokens, MAKEFLAGS='{}'".format(
+        mode, count, os.environ.get("MAKEFLAGS", "")))
+    tokens = []
+    deadline = time.time() + 5
+    while len(tokens) < count and time.time() < deadline:
+        token = lite.acquire(block=False)
+        if token is None:
+            time.sleep(0.01)
+            continue
+        tokens.append(token)
+
+    if len(tokens) < count:
+        log("ERROR: Only got {} of {} tokens".format(len(tokens), count))
+        return -1
+
+    log("Got {} tokens".format(len(tokens)))
+    if mode == "take":
+        for token in tokens:
+            lite.release(token)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
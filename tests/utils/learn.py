@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Check the rusage history (weights, ordering, eviction and merging), the
+JobServer charging a client for its weight, and run / xargs --learn using
+the history."""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import history
+from make.jobserver import lite
+from make.jobserver import server
+from make.jobserver import spawn
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def check(what, got, expected):
+    log("{}: {} (expected {})".format(what, got, expected))
+    if got != expected:
+        raise AssertionError("{} was {}, not {}".format(what, got, expected))
+
+
+def test_history(directory):
+    path = os.path.join(directory, "history.json")
+    h = history.History(path, max_entries=3)
+    h.record("cores4", 1.0, 4.0, 1000)
+    h.record("serial", 2.0, 1.8, 1000)
+    h.record("submake", 3.0, 9.0, 1000, tokens=2.0)
+    h.save()
+
+    h = history.History(path, max_entries=3)
+    check("weight cores4", h.weight("cores4"), 4)
+    check("weight cores4 limited", h.weight("cores4", 3), 3)
+    check("weight serial", h.weight("serial"), 1)
+    check("weight submake", h.weight("submake"), 1)
+    check("weight unknown", h.weight("unknown"), 1)
+    check("order", h.order(["serial", "cores4", "unknown", "submake"]),
+          ["unknown", "submake", "serial", "cores4"])
+
+    h.mem_per_token = 512 * 1024
+    check("weight serial by memory", h.weight("serial"), 2)
+
+    # Runs saved by someone else in between are kept.
+    other = history.History(path, max_entries=3)
+    other.record("serial", 2.0, 1.8, 1000)
+    other.save()
+    h.record("cores4", 1.0, 4.0, 1000)
+    h.save()
+    check("serial runs", history.History(path).get("serial").runs, 2)
+
+    # The least recently run is dropped.
+    h.record("new", 1.0, 1.0, 1000)
+    h.save()
+    check("entries", sorted(history.History(path).entries),
+          ["cores4", "new", "serial"])
+
+
+def test_charge():
+    jobserver = server.JobServer(3)
+    cid, pass_fds = jobserver.create_client()
+    jobserver.charge(cid, 3)
+    check("free after charge", len(jobserver._tokens), 1)
+    jobserver.poll(timeout=0)
+    check("client tokens", len(jobserver.tokens(cid)), 1)
+    check("free after poll", len(jobserver._tokens), 0)
+
+    token = os.read(pass_fds.p2c_rd, 1)
+    os.write(pass_fds.c2p_wr, token)
+    jobserver.poll(timeout=0)
+    for fd in pass_fds:
+        os.close(fd)
+    held = jobserver.token_seconds(cid)
+    log("Token seconds {}".format(held))
+    if held <= 0:
+        raise AssertionError("Token time not counted")
+
+    jobserver.cleanup_client(cid)
+    check("free after cleanup", len(jobserver._tokens), 3)
+    jobserver.close()
+
+
+def free_tokens():
+    """Run as a child, print how many tokens are free."""
+    tokens = []
+    while True:
+        token = lite.acquire(block=False)
+        if token is None:
+            break
+        tokens.append(token)
+    for token in tokens:
+        lite.release(token)
+    print(len(tokens), flush=True)
+    return 0
+
+
+def test_run(directory):
+    path = os.path.join(directory, "run.json")
+    env = dict(os.environ, MAKE_JOBSERVER_HISTORY=path)
+    child = [sys.executable, os.path.abspath(__file__), "free"]
+    cmd = [sys.executable, "-m", "make.jobserver", "run", "--learn", "--"]
+    cwd = os.path.join(os.path.dirname(__file__), "..", "..")
+
+    def run():
+        return int(spawn.run(
+            cmd + child, env=env, cwd=cwd, stdout=subprocess.PIPE,
+            check=True).stdout)
+
+    # make -j3 gives 2 tokens, run takes one.
+    check("free tokens for unknown", run(), 1)
+    check("recorded", len(history.History(path).entries), 1)
+
+    # Pretend it kept 3 cores busy last time.
+    h = history.History(path)
+    sig = history.signature(child, os.path.abspath(cwd))
+    h.entries = {}
+    h._runs = []
+    h.record(sig, 1.0, 3.0, 1000)
+    h.save()
+    check("free tokens for weight 3", run(), 0)
+
+
+def test_xargs(directory):
+    path = os.path.join(directory, "xargs.json")
+    cwd = os.path.join(os.path.dirname(__file__), "..", "..")
+    h = history.History(path)
+    for line, wall in (("a", 1.0), ("b", 3.0), ("c", 2.0)):
+        sig = history.signature(["echo", line], os.path.abspath(cwd))
+        h.record(sig, wall, wall, 1000)
+    h.save()
+
+    env = dict(os.environ, MAKE_JOBSERVER_HISTORY=path)
+    # Without a jobserver xargs runs them one at a time.
+    env.pop("MAKEFLAGS", None)
+    output = subprocess.check_output(
+        [sys.executable, "-m", "make.jobserver", "xargs", "--learn", "--",
+         "echo"], input=b"a\nb\nc\nd\n", env=env, cwd=cwd)
+    check("xargs order", output.split(), [b"d", b"b", b"c", b"a"])
+    check("recorded", len(history.History(path).entries), 4)
+
+
+def main(args):
+    if args[1:] == ["free"]:
+        return free_tokens()
+
+    with tempfile.TemporaryDirectory() as directory:
+        test_history(directory)
+        test_charge()
+        test_run(directory)
+        test_xargs(directory)
+    log("All good")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
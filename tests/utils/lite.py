@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import lite
+
+
+def main(args):
+    count = int(args[1])
+    cmd = args[2:]
+
+    if not lite.should_run():
+        return 0
+
+    jobs = [lite.start(cmd) for i in range(count)]
+    print("{} - Started {} jobs, {} in parallel".format(
+        os.getpid(), count, sum(job.token is not None for job in jobs)),
+        flush=True)
+    return max(job.wait() for job in jobs)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -36,7 +36,8 @@ def main(args):
     for i in range(4):
         childid, pass_fds = jobserver.create_client()
         env = dict(os.environ)
-        env["MAKEFLAGS"] = utils.get_make_flags() + jobserver.flags(pass_fds)
+        env["MAKEFLAGS"] = utils.replace_jobserver(
+            utils.get_make_flags(), pass_fds)
         cmd = " ".join(args[1:])
 
         log(
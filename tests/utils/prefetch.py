@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import utils
+from make.jobserver import client
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def main(args):
+    name = " ".join(args[1:]) or "prefetch"
+
+    # Should run things?
+    if not utils.should_run_submake():
+        return 0
+
+    if not utils.has_jobserver():
+        log("ERROR: No jobserver!")
+        return -1
+
+    jobserver = client.JobServerClient(prefetch=2, idle_timeout=0.05)
+    log("{} - Got jobserver: {}".format(name, jobserver))
+
+    # A stream of short tasks, each run as soon as there is a token for it.
+    queued = 30
+    running = []
+    while queued or running:
+        jobserver.prefetch_tokens(queued)
+        while queued:
+            token = jobserver.get_token()
+            if token is None:
+                break
+            queued -= 1
+            running.append((token, subprocess.Popen(["sleep", "0.02"])))
+
+        for token, p in list(running):
+            if p.poll() is not None:
+                running.remove((token, p))
+                jobserver.return_token(token)
+
+    # Nothing is queued any more, so nothing is kept for later.
+    if jobserver._reserve:
+        log("ERROR: Tokens kept with nothing queued: {}".format(
+            jobserver._reserve))
+        return -1
+
+    # More work turns up and is then dropped, the reserve for it goes back
+    # without us calling into the client again.
+    jobserver.prefetch_tokens(2)
+    log("{} - Reserved {} tokens for work which never ran".format(
+        name, len(jobserver._reserve)))
+    time.sleep(jobserver.idle_timeout * 4)
+    if jobserver._reserve:
+        log("ERROR: Idle tokens not given back: {}".format(
+            jobserver._reserve))
+        return -1
+
+    jobserver.cleanup()
+    log("{} - Prefetched {} tokens, {} unused".format(
+        name, jobserver.prefetched, jobserver.prefetch_unused))
+    if jobserver.tokens or jobserver._reserve:
+        log("ERROR: Tokens not returned!")
+        return -1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Check children started from Python get the jobserver, with and without
+make.jobserver.spawn, and that tokens are held for children run with a
+client."""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import client
+from make.jobserver import lite
+from make.jobserver import spawn
+from make.jobserver import utils
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def check():
+    """Run in the child, exits 0 if a token can be taken from the
+    jobserver."""
+    flags = utils.parse_make_flags()
+    log("Child MAKEFLAGS='{}'".format(flags))
+    if not flags.has_jobserver:
+        return 1
+    try:
+        for fd in flags.jobserver_fds or ():
+            os.fstat(fd)
+    except OSError as e:
+        log("Jobserver not passed on: {}".format(e))
+        return 1
+
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        token = lite.acquire(block=False)
+        if token is not None:
+            lite.release(token)
+            return 0
+        time.sleep(0.01)
+    log("No token turned up")
+    return 1
+
+
+def main(args):
+    if args[1:] == ["check"]:
+        return check()
+    if args[1:] == ["sleep"]:
+        time.sleep(0.2)
+        return 0
+
+    child = [sys.executable, __file__, "check"]
+
+    retcode = subprocess.call(child)
+    log("subprocess.call: {}".format(retcode))
+    if retcode == 0 and utils.parse_make_flags().jobserver_fds:
+        # A fifo jobserver (make 4.4) only needs MAKEFLAGS.
+        log("ERROR: Expected plain subprocess to lose the jobserver")
+        return -1
+
+    retcode = spawn.run(child).returncode
+    log("spawn.run: {}".format(retcode))
+    if retcode != 0:
+        log("ERROR: spawn.run child didn't get the jobserver")
+        return -1
+
+    with spawn.propagate():
+        retcode = subprocess.call(child)
+
+        class Subclass(subprocess.Popen):
+            pass
+
+        p = Subclass(child)
+        p.wait()
+    log("subprocess.call under propagate: {}, subclass: {}".format(
+        retcode, p.returncode))
+    if retcode != 0 or p.returncode != 0:
+        log("ERROR: propagate child didn't get the jobserver")
+        return -1
+    if not isinstance(p, subprocess.Popen):
+        log("ERROR: propagate Popen isn't a subprocess.Popen")
+        return -1
+
+    env = dict(os.environ)
+    env.pop("MAKEFLAGS", None)
+    if spawn.jobserver_env(env)[0].get("MAKEFLAGS", None) is not None:
+        log("ERROR: Jobserver added to an env without MAKEFLAGS")
+        return -1
+    if subprocess.Popen is not spawn._Popen:
+        log("ERROR: subprocess.Popen not restored")
+        return -1
+
+    # One child on our own job slot, the others on tokens from make.
+    jobclient = client.JobServerClient()
+    sleep = [sys.executable, __file__, "sleep"]
+    children = [spawn.Popen(sleep, client=jobclient) for i in range(3)]
+    held = list(jobclient.tokens)
+    log("Holding {} for 3 children".format(held))
+    retcodes = [p.wait() for p in children]
+    log("Children finished with {}, holding {}".format(
+        retcodes, jobclient.tokens))
+    jobclient.cleanup()
+    if len(held) != 3 or jobclient.tokens or any(retcodes):
+        log("ERROR: Tokens not held for the children")
+        return -1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -41,10 +41,8 @@ def main(args):
     childid, pass_fds = jobproxy.create_client()
 
     env = dict(os.environ)
-    # FIXME: This isn't quite right?
     env["MAKEFLAGS"] = utils.replace_jobserver(
-        utils.get_make_flags(), jobproxy.flags(pass_fds)
-    )
+        utils.get_make_flags(), pass_fds)
     cmd = " ".join(args[2:])
     log("Running '{}' with MAKEFLAGS='{}'".format(cmd, env["MAKEFLAGS"]))
     p = subprocess.Popen(args[2:], shell=False, env=env, pass_fds=pass_fds)
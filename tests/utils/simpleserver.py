@@ -35,8 +35,8 @@ def main(args):
     childid, pass_fds = jobserver.create_client()
 
     env = dict(os.environ)
-    # FIXME: This isn't quite right?
-    env["MAKEFLAGS"] = utils.get_make_flags() + jobserver.flags(pass_fds)
+    env["MAKEFLAGS"] = utils.replace_jobserver(
+        utils.get_make_flags(), pass_fds)
     cmd = " ".join(args[1:])
     log("Running '{}' with MAKEFLAGS='{}'".format(cmd, env["MAKEFLAGS"]))
     p = subprocess.Popen(args[1:], shell=False, env=env, pass_fds=pass_fds)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Check the simulator against graphs with known results."""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import sim
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def check(name, value, expected):
+    if abs(value - expected) > 1e-9:
+        log("ERROR: {} was {} expected {}".format(name, value, expected))
+        return 1
+    return 0
+
+
+def work(graph, jobs):
+    return sum(work(j, jobs) if j.jobs else j.duration * min(j.weight, jobs)
+               for j in graph.jobs)
+
+
+def main(args):
+    errors = 0
+    fds = len(os.listdir("/proc/self/fd"))
+
+    flat = sim.job("all", jobs=[
+        sim.job("job{}".format(i), duration=1.0) for i in range(4)])
+    for jobs, makespan in ((1, 4.0), (2, 2.0), (4, 1.0), (8, 1.0)):
+        result = sim.simulate(flat, jobs)
+        log("-j{} {}".format(jobs, result))
+        errors += check("makespan", result["makespan"], makespan)
+
+    chain = sim.load({"name": "all", "jobs": [
+        {"name": "a", "duration": 1.0},
+        {"name": "b", "duration": 1.0, "after": ["a"]},
+        {"name": "sub", "after": ["a"], "jobs": [
+            {"name": "c", "duration": 2.0},
+            {"name": "d", "duration": 1.0, "weight": 2},
+        ]},
+    ]})
+    result = sim.simulate(chain, 4)
+    log("chain {}".format(result))
+    errors += check("makespan", result["makespan"], 3.0)
+
+    for seed in range(10):
+        graph = sim.synthetic(seed, weight=(1, 2))
+        for result in sim.sweep(graph, (1, 3, 8)):
+            log("seed {} {}".format(seed, result))
+            if result != sim.simulate(graph, result["jobs"],
+                                      proxy=result["proxy"]):
+                log("ERROR: Not deterministic")
+                errors += 1
+            if result["deadlocked"]:
+                log("ERROR: Deadlocked")
+                errors += 1
+            if result["proxy"]:
+                # The proxy's free token lets each level go one over.
+                continue
+            if result["peak"] > result["jobs"]:
+                log("ERROR: More than {} tokens used".format(result["jobs"]))
+                errors += 1
+            bound = work(graph, result["jobs"]) / result["jobs"]
+            if result["makespan"] < bound - 1e-9:
+                log("ERROR: Makespan shorter than possible")
+                errors += 1
+
+    if len(os.listdir("/proc/self/fd")) > fds:
+        log("ERROR: Leaked fds")
+        errors += 1
+    return errors
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
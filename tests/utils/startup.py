@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Check the import time of make.jobserver.lite stays within budget.
+
+The budget (in microseconds) can be changed with STARTUP_BUDGET_US.
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# Nothing heavier than os should be pulled in by the lite client.
+FORBIDDEN = [
+    "re",
+    "select",
+    "signal",
+    "subprocess",
+    "make.jobserver.utils",
+    "make.jobserver.server",
+]
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def python_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = TOP
+    env["PYTHONDONTWRITEBYTECODE"] = ""
+    return env
+
+
+def imports(module):
+    """Return the modules importing module pulls in."""
+    code = ("import sys; before = set(sys.modules); import {}; "
+            "print(\"\\n\".join(set(sys.modules) - before))").format(module)
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], env=python_env(),
+        universal_newlines=True)
+    return output.split()
+
+
+def importtime(module, runs=10):
+    """Return (best cumulative import time in us, modules imported).
+
+    Both are empty when the python doesn't have -X importtime (before 3.7).
+    """
+    env = python_env()
+    best = None
+    imported = []
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            env=env, stderr=subprocess.STDOUT, universal_newlines=True)
+        imported = []
+        for line in output.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            name = name.strip()
+            imported.append(name)
+            if name == module:
+                cumulative = int(cumulative)
+                if best is None or cumulative < best:
+                    best = cumulative
+    return best, imported
+
+
+def main(args):
+    budget = int(os.environ.get("STARTUP_BUDGET_US", "5000"))
+
+    lite_us, imported = importtime("make.jobserver.lite")
+    client_us, _ = importtime("make.jobserver.client")
+    if not imported:
+        imported = imports("make.jobserver.lite")
+
+    bad = [name for name in FORBIDDEN if name in imported]
+    if bad:
+        log("ERROR: make.jobserver.lite imports {}".format(bad))
+        return -1
+    if lite_us is None:
+        log("No import times from python {}, not checking the budget".format(
+            sys.version.split()[0]))
+        return 0
+
+    log("Import time: make.jobserver.lite {}us, make.jobserver.client {}us"
+        " (budget {}us)".format(lite_us, client_us, budget))
+    if lite_us > budget:
+        log("ERROR: make.jobserver.lite is over budget!")
+        return -1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Check the jobserver Pool and pytest plugin only run as much at once as
+there are tokens, and run serially without a jobserver.
+
+    workers.py          - Under make -j3.
+    workers.py serial   - Under make without a jobserver.
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import lite
+from make.jobserver import pool
+from make.jobserver import pytest_plugin
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def check(what, got, expected):
+    log("{}: {} (expected {})".format(what, got, expected))
+    if got != expected:
+        raise AssertionError("{} was {}, not {}".format(what, got, expected))
+
+
+def square(x):
+    return x * x
+
+
+def add(x, y):
+    return x + y
+
+
+def fail(x):
+    if x == 3:
+        raise ValueError(x)
+    return x
+
+
+def span(x):
+    start = time.time()
+    time.sleep(0.3)
+    return os.getpid(), start, time.time()
+
+
+def overlap(spans):
+    """Most spans running at the same time."""
+    events = []
+    for _, start, end in spans:
+        events.append((start, 1))
+        events.append((end, -1))
+    running = most = 0
+    for _, change in sorted(events):
+        running += change
+        most = max(most, running)
+    return most
+
+
+def test_results(p):
+    check("map", p.map(square, range(10)), [x * x for x in range(10)])
+    check("starmap", p.starmap(add, [(1, 2), (3, 4)]), [3, 7])
+    check("apply", p.apply(add, (1,), {"y": 2}), 3)
+    got = []
+    p.apply_async(square, (4,), callback=got.append).wait()
+    check("callback", got, [16])
+    check("imap", list(p.imap(square, range(5))), [0, 1, 4, 9, 16])
+    check("imap_unordered", sorted(p.imap_unordered(square, range(5))),
+          [0, 1, 4, 9, 16])
+    try:
+        p.map(fail, range(5))
+    except ValueError as e:
+        check("map error", e.args, (3,))
+    else:
+        raise AssertionError("No error from map")
+
+
+def test_imap_closed():
+    # Like multiprocessing.Pool, the work is queued before iterating.
+    p = pool.Pool()
+    ordered = p.imap(square, range(3))
+    unordered = p.imap_unordered(square, range(3))
+    p.close()
+    p.join()
+    check("imap after join", list(ordered), [0, 1, 4])
+    check("imap_unordered after join", sorted(unordered), [0, 1, 4])
+
+
+def test_pool():
+    with pool.Pool() as p:
+        check("serial", p.serial, False)
+        test_results(p)
+
+        spans = p.map(span, range(6), chunksize=1)
+        most = overlap(spans)
+        log("Workers {}, most at once {}".format(
+            len(set(pid for pid, _, _ in spans)), most))
+        if not 2 <= most <= 3:
+            raise AssertionError("{} ran at once with make -j3".format(most))
+
+        # Tokens go back once there is nothing left to run.
+        deadline = time.time() + 2
+        while p._client.tokens and time.time() < deadline:
+            time.sleep(0.01)
+        check("tokens held when idle", p._client.tokens, [])
+        check("workers parked", len(p._parked) > 0, True)
+
+    # Everything but our own job slot is in use.
+    tokens = [lite.acquire(), lite.acquire()]
+    with pool.Pool() as p:
+        check("most at once without tokens",
+              overlap(p.map(span, range(3), chunksize=1)), 1)
+    for token in tokens:
+        lite.release(token)
+
+
+def run_pytest(worker, expected_free):
+    test = (
+        "import os\n"
+        "from make.jobserver import _support, utils\n"
+        "def test_tokens():\n"
+        "    rd, wr = utils.parse_make_flags().jobserver_fds\n"
+        "    with open(rd, 'rb', 0, closefd=False) as f:\n"
+        "        assert _support.output_waiting(f) == {}\n".format(
+            expected_free))
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test_tokens.py")
+        with open(path, "w") as f:
+            f.write(test)
+        env = dict(os.environ, PYTHONPATH=root, PYTEST_XDIST_WORKER=worker)
+        env[pytest_plugin.CONTROLLER_ENV] = str(os.getpid())
+        # Like xdist, without passing the jobserver on.
+        return subprocess.call(
+            [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider",
+             "-p", "make.jobserver.pytest_plugin", path],
+            env=env, cwd=directory)
+
+
+def test_pytest():
+    check("auto workers", pytest_plugin.pytest_xdist_auto_num_workers(None),
+          min(3, os.cpu_count()))
+    # Two tokens free, the second worker takes one for its test.
+    check("gw0 test", run_pytest("gw0", 2), 0)
+    check("gw1 test", run_pytest("gw1", 1), 0)
+
+
+def test_serial():
+    with pool.Pool() as p:
+        check("serial", p.serial, True)
+        test_results(p)
+        check("run in process",
+              set(pid for pid, _, _ in p.map(span, range(2))),
+              {os.getpid()})
+    check("auto workers", pytest_plugin.pytest_xdist_auto_num_workers(None),
+          0)
+
+
+def main(args):
+    if args[1:] == ["serial"]:
+        test_serial()
+        test_imap_closed()
+    else:
+        test_pool()
+        test_imap_closed()
+        test_pytest()
+    log("All good")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
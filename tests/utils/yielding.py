@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Jobs lending their job slot while blocked.
+
+    yielding.py unit    - JobServer / JobServerProxy accounting, async and
+                          automatic yielding, in process.
+    yielding.py lend    - Lend our job slot for a while.
+    yielding.py borrow  - Fail unless a token turns up (from the lender).
+    yielding.py free N  - Fail unless N tokens end up free.
+"""
+
+from __future__ import print_function
+
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from make.jobserver import _support
+from make.jobserver import aio
+from make.jobserver import client
+from make.jobserver import lite
+from make.jobserver import proxy
+from make.jobserver import server
+from make.jobserver import utils
+
+
+def log(msg):
+    print(
+        "\n".join("{} - {}".format(os.getpid(), l) for l in msg.split("\n")),
+        end="\n",
+        flush=True,
+    )
+
+
+def check(what, got, expected):
+    log("{}: {} (expected {})".format(what, got, expected))
+    if got != expected:
+        raise AssertionError("{} was {}, not {}".format(what, got, expected))
+
+
+def total(jobserver):
+    return len(jobserver._tokens) + len(jobserver.token2cid)
+
+
+class Clients:
+    """Clients of jobserver used in process."""
+
+    def __init__(self, jobserver, count):
+        self.jobserver = jobserver
+        self.cids = []
+        self.clients = []
+        for i in range(count):
+            cid, pass_fds = jobserver.create_client()
+            self.cids.append(cid)
+            self.clients.append(
+                client.JobServerClient(jobserver.flags(pass_fds)))
+
+    def cleanup(self):
+        for cid, c in zip(self.cids, self.clients):
+            c.cleanup()
+            # Closes the pass_fds too.
+            c.tokens_in.close()
+            c.tokens_out.close()
+            self.jobserver.cleanup_client(cid)
+
+
+def test_server():
+    jobserver = server.JobServer(0)
+    clients = Clients(jobserver, 2)
+    a, b = clients.clients
+    check("a free token", a.get_token(), b"")
+    check("b free token", b.get_token(), b"")
+
+    check("a yields", a.yield_token(), True)
+    jobserver.poll(timeout=0)
+    check("lent", jobserver.cid2lent, {clients.cids[0]: 1})
+    check("a yields again", a.yield_token(), False)
+    # Giving back more than it has doesn't make up a token.
+    a.tokens_out.write(b"+")
+    jobserver.poll(timeout=0)
+    check("over returned", jobserver.over_returned, 1)
+    check("lent after over return", jobserver.cid2lent, {clients.cids[0]: 1})
+    check("b borrows", b.get_token(), b"+")
+
+    b.return_token(b"+")
+    jobserver.poll(timeout=0)
+    check("a reclaims", a.reclaim(timeout=1), True)
+    check("a yielded", a.yielded, 0)
+    check("lent after reclaim", jobserver.cid2lent, {})
+    check("tokens after reclaim", total(jobserver), 0)
+
+    # Lender exits without taking its slot back.
+    a.yield_token()
+    a.yielded = 0
+    jobserver.poll(timeout=0)
+    clients.cleanup()
+    check("tokens after lender exits", total(jobserver), 0)
+    check("loans", jobserver._loans, set())
+    jobserver.close()
+
+
+def test_charge():
+    """Loans held back for another client's charge (see --learn)."""
+    jobserver = server.JobServer(1)
+    holder = Clients(jobserver, 1)
+    a = holder.clients[0]
+    # a's token waits in its pipe.
+    jobserver.poll(timeout=0)
+    clients = Clients(jobserver, 2)
+    b, c = clients.clients
+    charged = clients.cids[1]
+
+    b.get_token()
+    b.yield_token()
+    jobserver.charge(charged, 3)
+    jobserver.poll(timeout=0)
+    check("loan charged", jobserver.cid2charged[charged],
+          [min(jobserver._loans)])
+
+    # A real token comes back and repays the loan held by the charge.
+    a.get_token()
+    a.return_token(a.get_token())
+    jobserver.poll(timeout=0)
+    check("b reclaims", b.reclaim(timeout=1), True)
+    check("charged after repay", jobserver.cid2charged[charged], [0])
+    check("loans after repay", jobserver._loans, set())
+
+    # The lender goes away while its loan is held by the charge.
+    holder.cleanup()
+    b.yield_token()
+    b.yielded = 0
+    jobserver.poll(timeout=0)
+    check("loan charged again", len(jobserver.cid2charged[charged]), 2)
+    clients.cleanup()
+    check("tokens after lender exits", total(jobserver), 1)
+    check("loans", jobserver._loans, set())
+    jobserver.close()
+
+
+def settle(*jobservers):
+    for i in range(5):
+        for jobserver in jobservers:
+            jobserver.poll(timeout=0.01)
+
+
+def test_proxy():
+    upstream = server.JobServer(1)
+    upcid, up_fds = upstream.create_client()
+    upclient = client.JobServerClient(upstream.flags(up_fds))
+    jobproxy = proxy.JobServerProxy(upclient)
+    clients = Clients(jobproxy, 2)
+    a, b = clients.clients
+
+    check("a free token", a.get_token(), b"")
+    check("b free token", b.get_token(), b"")
+    settle(upstream, jobproxy)
+    check("b token", b.get_token(), b"+")
+    settle(upstream, jobproxy)
+
+    a.yield_token()
+    settle(upstream, jobproxy)
+    check("b borrows", b.get_token(), b"+")
+    b.return_token(b"+")
+    b.return_token(b"+")
+    settle(upstream, jobproxy)
+    check("a reclaims", a.reclaim(timeout=1), True)
+
+    clients.cleanup()
+    jobproxy.close()
+    upclient.cleanup()
+    check("proxy loans", jobproxy._loans, set())
+    upclient.tokens_in.close()
+    upclient.tokens_out.close()
+    upstream.cleanup_client(upcid)
+    check("upstream tokens", upstream._tokens, [0])
+    upstream.close()
+
+
+def test_async():
+    jobserver = server.JobServer(0)
+    clients = Clients(jobserver, 1)
+    a = clients.clients[0]
+    a.get_token()
+
+    async def blocked():
+        async with aio.yielding(a):
+            await asyncio.sleep(0.05)
+            jobserver.poll(timeout=0)
+            # Nobody else wants it, so it's straight back in our pipe.
+            check("repaid", _support.output_waiting(a.tokens_in), 1)
+        return a.yielded
+
+    loop = asyncio.new_event_loop()
+    try:
+        yielded = loop.run_until_complete(blocked())
+    finally:
+        loop.close()
+    check("yielded after async block", yielded, 0)
+    check("tokens", total(jobserver), 0)
+    clients.cleanup()
+    jobserver.close()
+
+
+BUSY = """
+import time
+end = time.time() + 0.5
+while time.time() < end:
+    pass
+"""
+
+
+def test_auto():
+    jobserver = server.JobServer(0)
+    clients = Clients(jobserver, 1)
+    a = clients.clients[0]
+    a.get_token()
+
+    auto = client.AutoYield(a, interval=0.05)
+    with auto:
+        # Idle, blocked on "I/O".
+        deadline = time.time() + 2
+        while time.time() < deadline and not auto.lent:
+            time.sleep(0.05)
+            jobserver.poll(timeout=0)
+        check("lent while idle", auto.lent, True)
+
+        # Busy, the slot should come back.
+        deadline = time.time() + 2
+        while time.time() < deadline and auto.lent:
+            busy = time.time() + 0.05
+            while time.time() < busy:
+                pass
+            jobserver.poll(timeout=0)
+        check("lent while busy", auto.lent, False)
+
+    # Waiting on a busy child isn't being idle.
+    auto = client.AutoYield(a, interval=0.05).start()
+    child = subprocess.Popen([sys.executable, "-c", BUSY])
+    lent = False
+    while child.poll() is None:
+        lent = lent or auto.lent
+        time.sleep(0.01)
+        jobserver.poll(timeout=0)
+    # Taking back a lent slot needs the server.
+    stopping = threading.Thread(target=auto.stop)
+    stopping.start()
+    while stopping.is_alive():
+        jobserver.poll(timeout=0.01)
+    check("lent while child busy", lent, False)
+
+    check("tokens", total(jobserver), 0)
+    clients.cleanup()
+    jobserver.close()
+
+
+def lend(seconds=1.5):
+    jobclient = client.JobServerClient()
+    token = jobclient.get_token()
+    start = time.time()
+    with jobclient.yielding():
+        log("Lent our job slot")
+        time.sleep(seconds)
+    log("Took it back after {:.2f}s".format(time.time() - start))
+    jobclient.return_token(token)
+    jobclient.cleanup()
+    return 0
+
+
+def borrow():
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        token = lite.acquire(block=False)
+        if token is not None:
+            log("Borrowed a token")
+            time.sleep(0.3)
+            lite.release(token)
+            return 0
+        time.sleep(0.01)
+    log("ERROR: No token was lent")
+    return -1
+
+
+def free(expected):
+    rd, wr = utils.fds_for_jobserver()
+    deadline = time.time() + 2
+    while True:
+        count = _support.output_waiting(rd)
+        if count > expected:
+            log("ERROR: {} tokens free, expected {}".format(count, expected))
+            return -1
+        if count == expected:
+            log("{} tokens free".format(count))
+            return 0
+        if time.time() > deadline:
+            log("ERROR: {} tokens free, expected {}".format(count, expected))
+            return -1
+        time.sleep(0.01)
+
+
+def main(args):
+    mode = args[1]
+    if mode == "unit":
+        test_server()
+        test_charge()
+        test_proxy()
+        test_async()
+        test_auto()
+        log("All good")
+        return 0
+    if mode == "lend":
+        return lend()
+    if mode == "borrow":
+        return borrow()
+    if mode == "free":
+        return free(int(args[2]))
+    raise SystemExit(__doc__)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))